@@ -0,0 +1,136 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from drchrono import events
+from drchrono.endpoints import AppointmentEndpoint
+from drchrono.joins import index_by
+from drchrono.models import Appointment, Patient, SyncState, Visit
+
+
+class AppointmentSchedule(object):
+    """
+    A local copy of each day's drchrono appointments, so request handlers read the database instead of calling the API.
+
+    `manage.py sync_appointments` keeps it up to date in the background. Each sync only asks the API for
+    appointments changed since the previous one (the `since` filter, on any day, so appointments rescheduled to
+    another day are seen to leave this one), compares them to the local rows, and writes only what changed, in bulk.
+    Changes are published to open dashboards.
+
+    If nothing has synced the day for longer than `ttl` seconds (e.g. the worker isn't running), the first reader
+    syncs inline instead; readers that come along meanwhile use the local copy as it is.
+    """
+    # overlap between syncs, so an appointment changed while we were syncing isn't missed
+    WATERMARK_OVERLAP = timedelta(minutes=1)
+
+    def __init__(self, access_token=None, ttl=None):
+        self.client = AppointmentEndpoint(access_token)
+        self.ttl = settings.APPOINTMENT_CACHE_TTL if ttl is None else ttl
+
+    def _state(self, day):
+        state, _ = SyncState.objects.get_or_create(resource=f"appointments:{day.isoformat()}")
+        return state
+
+    def _diff(self, records):
+        """
+        Splits API records into new and changed Appointment rows. Unchanged records are left out.
+        """
+        existing = index_by(Appointment.objects.filter(appointment_id__in=[record['id'] for record in records]),
+                            'appointment_id')
+        created, changed = [], []
+        for record in records:
+            appointment = existing.get(record['id'])
+            if appointment is None:
+                appointment = Appointment(appointment_id=record['id'])
+                appointment.load(record)
+                created.append(appointment)
+            elif appointment.as_dict() != record:
+                appointment.load(record)
+                changed.append(appointment)
+        return created, changed
+
+    def _update_visits(self, appointments):
+        """
+        Copies the scheduled time and doctor of changed appointments onto their visits, where they differ
+        """
+        by_id = {appointment.appointment_id: appointment for appointment in appointments}
+        visits = []
+        for visit in Visit.objects.filter(appointment_id__in=list(by_id)):
+            appointment = by_id[visit.appointment_id]
+            if (visit.scheduled_time, visit.doctor_id) != (appointment.scheduled_time, appointment.doctor_id):
+                visit.scheduled_time, visit.doctor_id = appointment.scheduled_time, appointment.doctor_id
+                visits.append(visit)
+        Visit.objects.bulk_update(visits, ['scheduled_time', 'doctor_id'], batch_size=500)
+
+    def _publish(self, appointments):
+        patients = index_by(Patient.objects.filter(
+            patient_id__in=[appointment.patient_id for appointment in appointments]), 'patient_id')
+        for appointment in appointments:
+            patient = patients.get(appointment.patient_id)
+            events.appointment_event(appointment.as_dict(), patient.as_dict() if patient else None)
+
+    def sync(self, day=None, full=False):
+        """
+        Brings the local copy of a day's appointments up to date. Appointments moved to another day are dropped, and
+        a full sync also drops appointments that no longer exist upstream. Returns the number of new and changed
+        appointments.
+        """
+        day = day or timezone.localdate()
+        state = self._state(day)
+        started = timezone.now()
+        full = full or not state.watermark
+        params = {'date': day.isoformat()} if full else {'since': state.watermark}
+
+        records, moved = [], []
+        for record in self.client.list(params):
+            # scheduled times are the practice's local time, as the API's date filter compares them
+            if str(record.get('scheduled_time') or '')[:10] == day.isoformat():
+                records.append(record)
+            else:
+                moved.append(record['id'])
+        with transaction.atomic():
+            # lock with a write before comparing with the local rows, as VisitTimerView.toggle_timer does for
+            # SQLite, so syncs running at once write one after the other and the second only writes what's left
+            SyncState.objects.filter(pk=state.pk).update(synced_at=started)
+            created, changed = self._diff(records)
+            Appointment.objects.bulk_create(created, batch_size=500)
+            Appointment.objects.bulk_update(changed, Appointment.SYNCED_FIELDS, batch_size=500)
+            self._update_visits(created + changed)
+            Appointment.objects.filter(appointment_id__in=moved, scheduled_time__date=day).delete()
+            if full:
+                Appointment.objects.filter(scheduled_time__date=day).exclude(
+                    appointment_id__in=[record['id'] for record in records]).delete()
+            state.synced_at = started
+            state.watermark = (started - self.WATERMARK_OVERLAP).strftime('%Y-%m-%dT%H:%M:%S')
+            state.save()
+            self._publish(created + changed)
+        return len(created) + len(changed)
+
+    def refresh(self, day=None):
+        """
+        Syncs the day inline if it hasn't been synced within the TTL. Returns True if it synced.
+        """
+        day = day or timezone.localdate()
+        state = self._state(day)
+        if state.synced_at and timezone.now() - state.synced_at <= timedelta(seconds=self.ttl):
+            return False
+        # claim a day synced before, so only one reader syncs it. A day never synced has nothing to serve yet, so
+        # every reader syncs it; sync() keeps them from writing the same rows twice.
+        if state.synced_at and not SyncState.objects.filter(pk=state.pk, synced_at=state.synced_at).update(
+                synced_at=timezone.now()):
+            return False
+        self.sync(day)
+        return True
+
+    def for_day(self, day=None, **filters):
+        """
+        Returns a day's appointments as API records (dicts), in scheduled order
+        """
+        day = day or timezone.localdate()
+        self.refresh(day)
+        appointments = Appointment.objects.filter(scheduled_time__date=day, **filters).order_by('scheduled_time')
+        return [appointment.as_dict() for appointment in appointments]
+
+    def for_patient(self, patient_id, day=None):
+        return self.for_day(day, patient_id=patient_id)
@@ -0,0 +1,104 @@
+import asyncio
+import functools
+import itertools
+
+from drchrono.endpoints import (AppointmentEndpoint, AppointmentProfileEndpoint, BaseEndpoint, DoctorEndpoint,
+                                PatientEndpoint, TaskEndpoint)
+from drchrono.instrumentation import in_current_context
+
+
+class AsyncBaseEndpoint(object):
+    """
+    An asyncio flavour of BaseEndpoint, with the same methods, arguments and exceptions (see ERROR_CODES).
+
+    Calls are handed to the wrapped synchronous endpoint on an executor, so they share its pooled Transport, and
+    independent calls can run together:
+
+        doctor, patients = await asyncio.gather(AsyncDoctorEndpoint(token).first(),
+                                                AsyncPatientEndpoint(token).list_all())
+
+    Subclasses only need to name the synchronous endpoint they mirror.
+    """
+    sync_class = BaseEndpoint
+    # how many results list() pulls from the synchronous iterator per executor call
+    chunk_size = 100
+
+    def __init__(self, access_token=None, executor=None, **kwargs):
+        """
+        executor defaults to the event loop's default executor. Other kwargs go to the synchronous endpoint.
+        """
+        self.sync = self.sync_class(access_token, **kwargs)
+        self.executor = executor
+
+    @property
+    def logger(self):
+        return self.sync.logger
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        # run_in_executor doesn't carry context variables over, and the call needs the current practice, the
+        # request's token scope and its metrics
+        call = in_current_context(functools.partial(func, *args, **kwargs))
+        return await loop.run_in_executor(self.executor, call)
+
+    async def list(self, *args, **kwargs):
+        """
+        Asynchronously iterates over all objects at the specified resource:
+
+            async for patient in AsyncPatientEndpoint(token).list():
+                ...
+        """
+        results = self.sync.list(*args, **kwargs)
+        try:
+            while True:
+                chunk = await self._run(list, itertools.islice(results, self.chunk_size))
+                if not chunk:
+                    break
+                for result in chunk:
+                    yield result
+        finally:
+            results.close()
+
+    async def list_all(self, *args, **kwargs):
+        """
+        Returns a list of all objects at the specified resource
+        """
+        return await self._run(lambda: list(self.sync.list(*args, **kwargs)))
+
+    async def first(self, *args, **kwargs):
+        """
+        Returns the first object at the specified resource, or None if there aren't any
+        """
+        return await self._run(lambda: next(self.sync.list(*args, **kwargs), None))
+
+    async def fetch(self, *args, **kwargs):
+        return await self._run(self.sync.fetch, *args, **kwargs)
+
+    async def create(self, *args, **kwargs):
+        return await self._run(self.sync.create, *args, **kwargs)
+
+    async def update(self, *args, **kwargs):
+        return await self._run(self.sync.update, *args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        return await self._run(self.sync.delete, *args, **kwargs)
+
+
+class AsyncPatientEndpoint(AsyncBaseEndpoint):
+    sync_class = PatientEndpoint
+
+
+class AsyncAppointmentEndpoint(AsyncBaseEndpoint):
+    sync_class = AppointmentEndpoint
+
+
+class AsyncDoctorEndpoint(AsyncBaseEndpoint):
+    sync_class = DoctorEndpoint
+
+
+class AsyncAppointmentProfileEndpoint(AsyncBaseEndpoint):
+    sync_class = AppointmentProfileEndpoint
+
+
+class AsyncTaskEndpoint(AsyncBaseEndpoint):
+    sync_class = TaskEndpoint
@@ -0,0 +1,115 @@
+"""
+The dashboard's wait/visit duration chart.
+
+Charts are plain Vega-Lite specs (dicts), rendered in the browser by vega-embed. By default the spec is written out by
+hand, so building it needs neither pandas nor altair. Set DASHBOARD_CHART_BACKEND = 'altair' to build it with altair
+instead; altair and pandas are then imported the first time a chart is built, not when the URLconf loads.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from drchrono import tenancy
+from drchrono.instrumentation import section
+from drchrono.stats import chart_points, latest_visit_change
+
+VEGA_LITE_SCHEMA = 'https://vega.github.io/schema/vega-lite/v3.4.0.json'
+
+
+def chart_cache_key():
+    """
+    Cache key for the current practice's dashboard chart. Changes whenever one of its Visits is saved.
+    """
+    latest = latest_visit_change()
+    return "dashboard-chart:{}:{}".format(tenancy.current_id(), latest.timestamp() if latest else 0)
+
+
+def _duration_chart(field, title, selection=None):
+    chart = {
+        'mark': 'bar',
+        'width': 300,
+        'height': 150,
+        'encoding': {
+            'x': {'field': 'start_time', 'type': 'temporal', 'axis': {'title': 'Time the visit started'}},
+            'y': {'field': field, 'type': 'quantitative', 'axis': {'title': title}},
+            'color': {'condition': {'selection': 'brush', 'value': 'black'}, 'value': 'lightgray'},
+        },
+    }
+    if selection:
+        chart['selection'] = selection
+    return chart
+
+
+def build_vega_lite_chart(points):
+    """
+    Builds the Vega-Lite spec for the wait duration and visit duration charts, without pandas or altair
+    """
+    # the brush lives on the wait chart, and highlights the same visits on the visit chart
+    brush = {'brush': {'type': 'interval', 'encodings': ['x']}}
+    return {
+        '$schema': VEGA_LITE_SCHEMA,
+        'datasets': {'visits': points},
+        'data': {'name': 'visits'},
+        'hconcat': [
+            _duration_chart('wait_duration', 'Wait Duration', selection=brush),
+            _duration_chart('visit_duration', 'Visit Duration'),
+        ],
+        'resolve': {'scale': {'y': 'shared'}},
+    }
+
+
+def build_altair_chart(points):
+    """
+    Builds the same spec with altair, from a pandas DataFrame
+    """
+    import altair as alt
+    import pandas as pd
+
+    visit_data_df = pd.DataFrame(points, columns=['start_time', 'count', 'wait_duration', 'visit_duration'])
+
+    # https://altair-viz.github.io/user_guide/interactions.html#selections-building-blocks-of-interactions
+    brush = alt.selection_interval(encodings=['x'])
+    chart = alt.Chart(visit_data_df).mark_bar().properties(
+        width=300,
+        height=150
+    ).add_selection(
+        brush
+    )
+
+    # combine two charts one with wait duration and one with visit duration
+    return alt.hconcat(chart.encode(
+        x=alt.X('start_time:T', axis=alt.Axis(title='Time the visit started')),
+        y=alt.Y('wait_duration:Q', axis=alt.Axis(title='Wait Duration')),
+        color=alt.condition(brush, alt.value('black'), alt.value('lightgray'))
+    ), chart.encode(
+        x=alt.X('start_time:T', axis=alt.Axis(title='Time the visit started')),
+        y=alt.Y('visit_duration:Q', axis=alt.Axis(title='Visit Duration')),
+        color=alt.condition(brush, alt.value('black'), alt.value('lightgray'))
+    )).resolve_scale(
+        y='shared'
+    ).to_dict()
+
+
+BACKENDS = {
+    'vega-lite': build_vega_lite_chart,
+    'altair': build_altair_chart,
+}
+
+
+def build_chart(points):
+    return BACKENDS[settings.DASHBOARD_CHART_BACKEND](points)
+
+
+def dashboard_chart():
+    """
+    Returns the dashboard chart spec, from the cache unless a Visit changed since it was built. The data is binned
+    beyond DASHBOARD_CHART_MAX_POINTS points, so the spec stays small however long the visit history gets.
+    """
+    with section('chart-cache'):
+        key = chart_cache_key()
+        chart = cache.get(key)
+    if chart is None:
+        with section('chart-points'):
+            points = chart_points(settings.DASHBOARD_CHART_MAX_POINTS)
+        with section('chart-build'):
+            chart = build_chart(points)
+        cache.set(key, chart, settings.DASHBOARD_CHART_CACHE_TIMEOUT)
+    return chart
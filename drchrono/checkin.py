@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.utils import timezone
+from drchrono.joins import index_by
+from drchrono.models import Appointment, OutboxMutation, Visit
+from drchrono.outbox import mutation
+
+ARRIVED = Visit.Status.ARRIVED.label
+
+
+class AlreadyCheckedIn(Exception):
+    pass
+
+
+class CheckInService(object):
+    """
+    Checks a patient in for their appointments today.
+
+    The local Visit rows (and the local copy of the appointments) are written in one transaction, in bulk, together
+    with one queued status change for each appointment not yet marked Arrived on drchrono. `manage.py process_outbox`
+    sends those in the background, so checking in doesn't wait on the API at all.
+    """
+
+    @staticmethod
+    def pending(appointments):
+        """
+        The appointments (API records) the patient hasn't checked in for yet
+        """
+        visits = index_by(Visit.objects.filter(appointment_id__in=[appointment['id'] for appointment in appointments]),
+                          'appointment_id')
+        return [appointment for appointment in appointments
+                if appointment['id'] not in visits or visits[appointment['id']].arrival_time is None]
+
+    def _save(self, patient_id, appointments, now):
+        ids = [appointment['id'] for appointment in appointments]
+        with transaction.atomic():
+            # lock the rows with a write before reading them, as VisitTimerView.toggle_timer does for SQLite
+            Visit.objects.filter(appointment_id__in=ids).update(updated_at=now)
+            visits = index_by(Visit.objects.filter(appointment_id__in=ids), 'appointment_id')
+            if any(visit.arrival_time is not None for visit in visits.values()):
+                raise AlreadyCheckedIn(patient_id)
+
+            local = index_by(Appointment.objects.filter(appointment_id__in=ids), 'appointment_id')
+            created, changed = [], []
+            for appointment in appointments:
+                visit = visits.get(appointment['id'])
+                if visit is None:
+                    visit = Visit(appointment_id=appointment['id'], patient_id=patient_id)
+                    created.append(visit)
+                else:
+                    changed.append(visit)
+                row = local.get(appointment['id'])
+                visit.doctor_id = appointment.get('doctor')
+                visit.scheduled_time = row.scheduled_time if row else None
+                visit.status = Visit.Status.ARRIVED
+                visit.arrival_time = now
+            Visit.objects.bulk_create(created)
+            Visit.objects.bulk_update(changed, ['doctor_id', 'scheduled_time', 'status', 'arrival_time'])
+
+            # tell drchrono, and keep the local copy of the appointments in step until the next sync
+            OutboxMutation.objects.bulk_create([
+                mutation('appointments', appointment['id'], patient_id, {'status': ARRIVED})
+                for appointment in appointments if appointment.get('status') != ARRIVED])
+            updated = [row for row in local.values() if row.status != ARRIVED]
+            for row in updated:
+                row.load(dict(row.as_dict(), status=ARRIVED))
+            Appointment.objects.bulk_update(updated, Appointment.SYNCED_FIELDS)
+        return created + changed
+
+    def check_in(self, patient_id, appointments):
+        """
+        Checks the patient in for the given appointments (API records), skipping those they already checked in for.
+        Returns the Visits checked in. Raises AlreadyCheckedIn if there's nothing left to check in for.
+        """
+        appointments = self.pending(appointments)
+        if not appointments:
+            raise AlreadyCheckedIn(patient_id)
+        return self._save(patient_id, appointments, timezone.now())
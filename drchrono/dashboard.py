@@ -0,0 +1,134 @@
+"""
+The dashboard's sections as JSON, for pages and clients that refresh one section at a time.
+
+Each section has a version: a cheap query whose result changes whenever the section's content may have. A section's
+JSON is cached under its version, along with an ETag computed from the JSON itself, so a client polling a section
+that didn't change costs the version query and a cache lookup, and gets an empty 304 back.
+
+Durations that grow by the second (how long someone has been waiting, how long the current visit has lasted) aren't
+part of the JSON; it gives the times they started from, and the page keeps counting.
+"""
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max
+from django.utils import timezone
+from drchrono import tenancy
+from drchrono.appointments import AppointmentSchedule
+from drchrono.charts import chart_cache_key, dashboard_chart
+from drchrono.joins import enrich
+from drchrono.models import Appointment, Patient, Visit
+from drchrono.patients import PATIENT_DETAIL_FIELDS, PATIENT_NAME_FIELDS, PatientDirectory
+from drchrono.stats import daily_statistics, latest_visit_change, recent_statistics, rolling_statistics
+
+VISIT_FIELDS = ('appointment_id', 'patient_id', 'scheduled_time', 'arrival_time', 'start_time')
+
+
+def _visit(visit, patients, fields):
+    row = {field: getattr(visit, field) for field in VISIT_FIELDS}
+    enrich([row], patients, 'patient_id', fields)
+    return row
+
+
+def appointments_version(access_token=None):
+    """
+    Changes whenever today's appointments, or the patients they're for, are synced
+    """
+    # sync first if the background worker has fallen behind, so the version is up to date
+    AppointmentSchedule(access_token).refresh()
+    appointments = Appointment.objects.filter(scheduled_time__date=timezone.localdate())
+    totals = appointments.aggregate(count=Count('id'), synced=Max('synced_at'))
+    patients = Patient.objects.filter(patient_id__in=appointments.values('patient_id')).aggregate(
+        count=Count('id'), synced=Max('synced_at'))
+    return [totals['count'], totals['synced'], patients['count'], patients['synced']]
+
+
+def appointments_section(access_token=None):
+    appointments = AppointmentSchedule(access_token).for_day()
+    patients = PatientDirectory(access_token).fetch_many(appointment.get('patient') for appointment in appointments)
+    enrich(appointments, patients, 'patient', PATIENT_NAME_FIELDS)
+    return {'appointments': appointments}
+
+
+def visits_version(access_token=None):
+    """
+    Changes whenever a visit is saved. Visits and the rolling statistics are updated together.
+    """
+    return [latest_visit_change()]
+
+
+def arrivals_section(access_token=None):
+    visits = list(Visit.objects.filter(status=Visit.Status.ARRIVED, arrival_time__isnull=False,
+                                       start_time__isnull=True))
+    patients = PatientDirectory(access_token).fetch_many(visit.patient_id for visit in visits)
+    return {'arrivals': [_visit(visit, patients, PATIENT_NAME_FIELDS) for visit in visits]}
+
+
+def current_visit_section(access_token=None):
+    visit = Visit.objects.filter(status=Visit.Status.IN_SESSION, arrival_time__isnull=False,
+                                 start_time__isnull=False).first()
+    if visit is None:
+        return {'current_visit': None}
+    patients = PatientDirectory(access_token).fetch_many([visit.patient_id])
+    return {'current_visit': _visit(visit, patients, PATIENT_DETAIL_FIELDS)}
+
+
+def statistics_version(access_token=None):
+    """
+    Changes whenever a visit is saved, and every hour, as the recent statistics' window of days moves on
+    """
+    return visits_version(access_token) + [timezone.now().replace(minute=0, second=0, microsecond=0)]
+
+
+def statistics_section(access_token=None):
+    statistics = rolling_statistics()
+    return {
+        'statistics': statistics,
+        # medians and 90th percentiles need the visits themselves, so they only cover recent ones
+        'recent': recent_statistics(settings.DASHBOARD_PERCENTILE_DAYS),
+        'recent_days': settings.DASHBOARD_PERCENTILE_DAYS,
+        'daily': daily_statistics(settings.DASHBOARD_PERCENTILE_DAYS),
+        'avg_wait_duration': math.ceil(statistics['wait']['avg'] or 0),
+        'avg_visit_duration': math.ceil(statistics['visit']['avg'] or 0),
+    }
+
+
+def chart_version(access_token=None):
+    return [chart_cache_key()]
+
+
+def chart_section(access_token=None):
+    return {'chart': dashboard_chart()}
+
+
+# name -> (version, builder)
+SECTIONS = {
+    'appointments': (appointments_version, appointments_section),
+    'arrivals': (visits_version, arrivals_section),
+    'current-visit': (visits_version, current_visit_section),
+    'statistics': (statistics_version, statistics_section),
+    'chart': (chart_version, chart_section),
+}
+
+
+def section_cache_key(name, version):
+    digest = hashlib.sha1(json.dumps(version, cls=DjangoJSONEncoder).encode('utf-8')).hexdigest()
+    return "dashboard-section:{}:{}:{}".format(tenancy.current_id(), name, digest)
+
+
+def render_section(name, access_token=None):
+    """
+    Returns a section's (JSON, ETag), from the cache unless the section's version changed since it was built
+    """
+    version, build = SECTIONS[name]
+    key = section_cache_key(name, version(access_token))
+    entry = cache.get(key)
+    if entry is None:
+        content = json.dumps(build(access_token), cls=DjangoJSONEncoder)
+        entry = (content, '"{}"'.format(hashlib.sha1(content.encode('utf-8')).hexdigest()))
+        cache.set(key, entry, settings.DASHBOARD_SECTION_CACHE_TIMEOUT)
+    return entry
@@ -1,11 +1,22 @@
+import copy
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+from drchrono import instrumentation
+from drchrono.ratelimit import get_rate_limiter, retry_after
+from drchrono.response_cache import get_response_cache
+from drchrono.transport import get_transport
 
 
 class APIException(Exception): pass
 
 
+class Unauthorized(APIException): pass
+
+
 class Forbidden(APIException): pass
 
 
@@ -15,13 +26,78 @@ class NotFound(APIException): pass
 class Conflict(APIException): pass
 
 
+class TooManyRequests(APIException): pass
+
+
 ERROR_CODES = {
+    401: Unauthorized,
     403: Forbidden,
     404: NotFound,
     409: Conflict,
+    429: TooManyRequests,
 }
 
 
+class PagePrefetcher(object):
+    """
+    Iterates over `pages` (any iterator) while a background thread retrieves up to `size` items ahead of the caller.
+
+    Items come out in their original order. An exception raised while retrieving is re-raised to the caller at the
+    point it happened. Call close() if you stop iterating early, so the background thread can stop as well.
+    """
+    _DONE = object()
+
+    def __init__(self, pages, size):
+        self._pages = pages
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._finished = False
+
+    def _put(self, item):
+        # waits for room in the queue, but gives up once the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for page in self._pages:
+                if not self._put((page, None)):
+                    return
+        except Exception as e:
+            self._put((None, e))
+        else:
+            self._put((self._DONE, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        if self._thread is None:
+            # the thread reports its API calls into the metrics of the request iterating, if any
+            self._thread = threading.Thread(target=instrumentation.in_current_context(self._run), daemon=True)
+            self._thread.start()
+        page, error = self._queue.get()
+        if error is not None:
+            self._finished = True
+            raise error
+        if page is self._DONE:
+            self._finished = True
+            raise StopIteration
+        return page
+
+    def close(self):
+        self._finished = True
+        self._stop.set()
+
+
 # TODO: this API abstraction is included for your convenience. If you don't like it, feel free to change it.
 class BaseEndpoint(object):
     """
@@ -34,6 +110,9 @@ class BaseEndpoint(object):
      - details of authentication
      - list iteration
      - response codes
+     - connection pooling, timeouts and retries (see drchrono.transport)
+     - expired tokens and rate limits (see drchrono.tokens and drchrono.ratelimit)
+     - caching responses of rarely changing endpoints (see drchrono.response_cache)
 
     All return values will be dicts, or lists of dicts.
 
@@ -41,18 +120,47 @@ class BaseEndpoint(object):
     """
     BASE_URL = 'https://drchrono.com/api/'
     endpoint = ''
-
-    def __init__(self, access_token=None):
+    # how many pages list() requests ahead of the caller, and how big we ask those pages to be (None: API default)
+    prefetch_pages = 2
+    page_size = None
+    # how many times a request throttled with 429 is replayed, after waiting out its Retry-After
+    rate_limit_retries = 2
+    # how many fetches fetch_many() keeps in flight at once
+    fetch_many_workers = 8
+    # GET responses are cached for cache_ttl seconds, then revalidated (None: not cached), keeping at most
+    # cache_max_entries of them when cached in process
+    cache_ttl = None
+    cache_max_entries = 128
+
+    def __init__(self, access_token=None, transport=None, base_url=None):
         """
-        Creates an API client which will act on behalf of a specific user
+        Creates an API client which will act on behalf of a specific user.
+
+        access_token is the token itself, or a callable returning it. Without one, every request asks the
+        process-wide TokenManager (drchrono.tokens), which keeps the token refreshed.
+
+        All clients share one pooled Transport unless a specific one is passed in. base_url points the client at
+        another server, e.g. drchrono.fake_api.FakeDrchronoAPI.
         """
-        self.access_token = access_token
+        self._access_token = access_token
+        self.transport = transport or get_transport()
+        if base_url:
+            self.BASE_URL = base_url
 
     @property
     def logger(self):
         name = "{}.{}".format(__name__, self.endpoint)
         return logging.getLogger(name)
 
+    @property
+    def access_token(self):
+        token = self._access_token
+        if token is None:
+            # imported here, since the token manager needs Django and the rest of this module doesn't
+            from drchrono.tokens import get_token_manager
+            token = get_token_manager().get_token
+        return token() if callable(token) else token
+
     def _url(self, id=""):
         if id:
             id = "/{}".format(id)
@@ -81,33 +189,170 @@ class BaseEndpoint(object):
             exe = ERROR_CODES.get(response.status_code, APIException)
             raise exe(response.content)
 
+    def refresh_token(self, rejected):
+        """
+        Returns a new access token to use instead of `rejected`, which the API turned down. None if there isn't one.
+        """
+        from drchrono.tokens import get_token_manager
+        try:
+            return get_token_manager().refresh(rejected=rejected)
+        except Exception as e:
+            self.logger.warning("couldn't refresh the access token: {!r}".format(e))
+            return None
+
+    def _replace_token(self, kwargs):
+        """
+        Swaps the rejected token in kwargs['headers'] for a refreshed one. Returns False if there's no new token.
+        """
+        headers = kwargs.get('headers', {})
+        rejected = headers.get('Authorization', '')[len('Bearer '):]
+        token = self.refresh_token(rejected)
+        if not token or token == rejected:
+            return False
+        if isinstance(self._access_token, str):
+            self._access_token = token
+        headers['Authorization'] = 'Bearer {}'.format(token)
+        return True
+
+    def _send(self, method, url, *args, **kwargs):
+        """
+        Sends a request over the shared, pooled transport, once the rate limiter lets it through.
+
+        On 401 the access token is refreshed and the request replayed, once. On 429 every client sharing the rate
+        limiter waits for as long as the Retry-After header asks, then the request is replayed (a throttled request
+        wasn't processed, so this is safe for POST and PATCH too), up to `rate_limit_retries` times.
+        """
+        limiter = get_rate_limiter()
+        refreshed = False
+        throttled = 0
+        metrics = instrumentation.current()
+        while True:
+            if limiter:
+                start = time.perf_counter()
+                limiter.acquire()
+                if metrics is not None:
+                    metrics.api_throttled(self.endpoint, time.perf_counter() - start)
+            start = time.perf_counter()
+            response = self.transport.request(method, url, *args, **kwargs)
+            if metrics is not None:
+                metrics.api_call(self.endpoint, method, response.status_code, len(response.content),
+                                 time.perf_counter() - start, page=instrumentation.api_page())
+            if response.status_code == 401 and not refreshed:
+                refreshed = True
+                if self._replace_token(kwargs):
+                    self.logger.info("replaying {} {} with a refreshed token".format(method, url))
+                    continue
+            elif response.status_code == 429 and throttled < self.rate_limit_retries:
+                throttled += 1
+                wait = retry_after(response)
+                self.logger.warning("throttled on {} {}, waiting {:.1f}s".format(method, url, wait))
+                if limiter:
+                    limiter.pause(wait)
+                else:
+                    time.sleep(wait)
+                continue
+            return response
+
     def _request(self, method, *args, **kwargs):
-        # dirty, universal way to use the requests library directly for debugging
-        url = self._url(kwargs.pop(id, ''))
+        # dirty, universal way to use the transport directly for debugging
+        url = self._url(kwargs.pop('id', ''))
         self._auth_headers(kwargs)
-        return getattr(requests, method)(url, *args, **kwargs)
+        return self._send(method, url, *args, **kwargs)
 
-    def list(self, params=None, **kwargs):
+    def _get(self, url, params=None, **kwargs):
         """
-        Returns an iterator to retrieve all objects at the specified resource. Waits to exhaust the current page before
-        retrieving the next, which might result in choppy responses.
+        Sends a GET, through the endpoint's response cache if it has one
         """
-        self.logger.debug("list()")
-        url = self._url()
-        self._auth_headers(kwargs)
-        # Response will be one page out of a paginated results list
-        response = requests.get(url, params=params, **kwargs)
-        if response.ok:
-            self.logger.debug("list got page {}".format('url'))
-            while url:
-                data = response.json()
-                url = data['next']  # Same as the resource URL, but with the page query parameter present
-                for result in data['results']:
-                    yield result
-        else:
+        cache = get_response_cache(self)
+        if cache is None:
+            return self._send('get', url, params=params, **kwargs)
+
+        key = cache.key(url, params)
+        entry = cache.get(key)
+        if entry is not None and cache.is_fresh(entry):
+            cache.stats.count('hits')
+            metrics = instrumentation.current()
+            if metrics is not None:
+                metrics.api_cached(self.endpoint)
+            return cache.as_response(entry)
+        if entry is not None:
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **cache.conditional_headers(entry))
+
+        response = self._send('get', url, params=params, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            cache.stats.count('revalidated')
+            return cache.as_response(cache.renew(key, entry))
+        cache.stats.count('misses')
+        cache.store(key, response)
+        return response
+
+    def _clear_cache(self):
+        """
+        Drops the endpoint's cached responses, after we changed something through it
+        """
+        cache = get_response_cache(self)
+        if cache is not None:
+            cache.clear()
+
+    def _get_page(self, url, params=None, **kwargs):
+        """
+        Retrieves a single page out of a paginated results list
+        """
+        response = self._get(url, params=params, **kwargs)
+        if not response.ok:
             exe = ERROR_CODES.get(response.status_code, APIException)
             self.logger.debug("list exception {}".format(exe))
             raise exe(response.content)
+        self.logger.debug("list got page {}".format(url))
+        return response.json()
+
+    def _walk_pages(self, url, params, kwargs):
+        number = 1
+        while url:
+            with instrumentation.listing_page(number):
+                data = self._get_page(url, params, **kwargs)
+            number += 1
+            # data['next'] is the resource URL with the page query parameters already present
+            url = data['next']
+            params = None
+            yield data['results']
+
+    def pages(self, params=None, page_size=None, prefetch=None, **kwargs):
+        """
+        Returns an iterator over the pages (lists of dicts) at the specified resource, in order.
+
+        While the caller works on one page, up to `prefetch` following pages are requested in a background thread, so
+        at most prefetch + 2 pages are held in memory. prefetch=0 waits to exhaust each page before retrieving the next.
+
+        page_size is passed to the API as a hint, so fewer round trips are needed.
+        """
+        params = dict(params or {})
+        page_size = page_size or self.page_size
+        if page_size:
+            params['page_size'] = page_size
+        if prefetch is None:
+            prefetch = self.prefetch_pages
+        self._auth_headers(kwargs)
+
+        pages = self._walk_pages(self._url(), params, kwargs)
+        if prefetch > 0:
+            pages = PagePrefetcher(pages, prefetch)
+        return pages
+
+    def list(self, params=None, page_size=None, prefetch=None, **kwargs):
+        """
+        Returns an iterator to retrieve all objects at the specified resource, in order. See pages() for how
+        page_size and prefetch affect the requests made.
+        """
+        self.logger.debug("list()")
+        pages = self.pages(params, page_size=page_size, prefetch=prefetch, **kwargs)
+        try:
+            for page in pages:
+                for result in page:
+                    yield result
+        finally:
+            # stops the background fetching when the caller doesn't exhaust the iterator, e.g. next(endpoint.list())
+            pages.close()
         self.logger.debug("list() complete")
 
     def fetch(self, id, params=None, **kwargs):
@@ -116,10 +361,46 @@ class BaseEndpoint(object):
         """
         url = self._url(id)
         self._auth_headers(kwargs)
-        response = requests.get(url, params=params, **kwargs)
+        response = self._get(url, params=params, **kwargs)
         self.logger.info("fetch {}".format(response.status_code))
         return self._json_or_exception(response)
 
+    def fetch_many(self, ids, cache=None, max_workers=None, params=None):
+        """
+        Retrieve several objects by ID. Returns a dict of id -> object; IDs that don't exist are left out.
+
+        Each ID is fetched once, however often it's listed. If a `cache` is given (anything with get_many(ids) and
+        set_many({id: object}), like a Django cache or drchrono.patients.PatientDirectory), objects it has are
+        served from it and fetched ones are added to it. The rest are fetched concurrently, at most `max_workers`
+        (default fetch_many_workers) at a time.
+        """
+        ids = list(dict.fromkeys(id for id in ids if id is not None))
+        found = dict(cache.get_many(ids)) if cache is not None and ids else {}
+        misses = [id for id in ids if id not in found]
+        if not misses:
+            return found
+
+        # resolve the token once, here, instead of in every worker thread
+        client = copy.copy(self)
+        client._access_token = self.access_token
+
+        def fetch(id):
+            try:
+                return id, client.fetch(id, params=params)
+            except NotFound:
+                return id, None
+
+        workers = min(max_workers or self.fetch_many_workers, len(misses))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = {id: obj for id, obj in executor.map(instrumentation.in_current_context(fetch), misses)
+                       if obj is not None}
+        self.logger.info("fetch_many {} cached, {} fetched, {} missing".format(
+            len(found), len(fetched), len(misses) - len(fetched)))
+        if cache is not None and fetched:
+            cache.set_many(fetched)
+        found.update(fetched)
+        return found
+
     def create(self, data=None, json=None, **kwargs):
         """
         Used to create an object at a resource with the included values.
@@ -134,8 +415,10 @@ class BaseEndpoint(object):
         """
         url = self._url()
         self._auth_headers(kwargs)
-        response = requests.post(url, data=data, json=json, **kwargs)
-        return self._json_or_exception(response)
+        response = self._send('post', url, data=data, json=json, **kwargs)
+        result = self._json_or_exception(response)
+        self._clear_cache()
+        return result
 
     def update(self, id, data, partial=True, **kwargs):
         """
@@ -156,10 +439,12 @@ class BaseEndpoint(object):
         url = self._url(id)
         self._auth_headers(kwargs)
         if partial:
-            response = requests.patch(url, data, **kwargs)
+            response = self._send('patch', url, data=data, **kwargs)
         else:
-            response = requests.put(url, data, **kwargs)
-        return self._json_or_exception(response)
+            response = self._send('put', url, data=data, **kwargs)
+        result = self._json_or_exception(response)
+        self._clear_cache()
+        return result
 
     def delete(self, id, **kwargs):
         """
@@ -174,12 +459,15 @@ class BaseEndpoint(object):
         """
         url = self._url(id)
         self._auth_headers(kwargs)
-        response = requests.delete(url)
-        return self._json_or_exception(response)
+        response = self._send('delete', url, **kwargs)
+        result = self._json_or_exception(response)
+        self._clear_cache()
+        return result
 
 
 class PatientEndpoint(BaseEndpoint):
     endpoint = "patients"
+    page_size = 250
 
 
 class AppointmentEndpoint(BaseEndpoint):
@@ -188,7 +476,7 @@ class AppointmentEndpoint(BaseEndpoint):
     # Special parameter requirements for a given resource should be explicitly called out
     def list(self, params=None, date=None, start=None, end=None, **kwargs):
         """
-        List appointments on a given date, or between two dates
+        List appointments on a given date, or between two dates, or (with params['since']) those changed since then
         """
         # Just parameter parsing & checking
         params = params or {}
@@ -198,8 +486,8 @@ class AppointmentEndpoint(BaseEndpoint):
         elif date:
             params['date'] = date
 
-        if 'date' not in params and 'date_range' not in params:
-            raise Exception("Must provide either start & end, or date argument")
+        if 'date' not in params and 'date_range' not in params and 'since' not in params:
+            raise Exception("Must provide either start & end, date or since argument")
 
         return super(AppointmentEndpoint, self).list(params, **kwargs)
 
@@ -242,6 +530,7 @@ class AppointmentEndpoint(BaseEndpoint):
 
 class DoctorEndpoint(BaseEndpoint):
     endpoint = "doctors"
+    cache_ttl = 300
 
     def update(self, id, data, partial=True, **kwargs):
         raise NotImplementedError("the API does not allow updating doctors")
@@ -255,6 +544,7 @@ class DoctorEndpoint(BaseEndpoint):
 
 class AppointmentProfileEndpoint(BaseEndpoint):
     endpoint = "appointment_profiles"
+    cache_ttl = 3600
 
 class TaskEndpoint(BaseEndpoint):
     endpoint = "tasks"
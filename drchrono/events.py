@@ -0,0 +1,102 @@
+"""
+Live dashboard updates, pushed to the browser as server-sent events.
+
+Views publish small JSON deltas (see the *_event helpers) into the DashboardEvent table; every open dashboard long-polls
+that table by id: its request returns as soon as there are new rows, or after DASHBOARD_EVENTS_STREAM_DURATION seconds
+without any, and the browser reconnects. An idle dashboard costs one indexed query per poll interval, and no API calls
+at all. Each open dashboard still ties up a web server worker (and its database connection) while it waits, so run
+enough workers, or threaded ones (gunicorn --threads), for the dashboards you expect.
+
+Old events are forgotten by prune(), which `manage.py sync_appointments` runs on every sync.
+"""
+import json
+import math
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from drchrono.models import DashboardEvent
+from drchrono.patients import PATIENT_DETAIL_FIELDS
+from drchrono.stats import rolling_statistics
+
+ARRIVAL = 'arrival'
+VISIT_STARTED = 'visit_started'
+VISIT_FINISHED = 'visit_finished'
+APPOINTMENT = 'appointment'
+
+
+def publish(kind, **data):
+    """
+    Records an event for the open dashboards
+    """
+    return DashboardEvent.objects.create(kind=kind, data=json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def prune():
+    """
+    Forgets events older than DASHBOARD_EVENTS_RETENTION seconds. Returns how many were deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.DASHBOARD_EVENTS_RETENTION)
+    deleted, _ = DashboardEvent.objects.filter(created__lt=cutoff).delete()
+    return deleted
+
+
+def arrival_event(visit, patient):
+    return publish(ARRIVAL, appointment_id=visit.appointment_id, patient_id=visit.patient_id,
+                   first_name=patient.get('first_name'), last_name=patient.get('last_name'),
+                   arrival_time=visit.arrival_time)
+
+
+def visit_started_event(visit, patient):
+    return publish(VISIT_STARTED, appointment_id=visit.appointment_id, patient_id=visit.patient_id,
+                   start_time=visit.start_time, **{field: patient.get(field) for field in PATIENT_DETAIL_FIELDS})
+
+
+def visit_finished_event(visit):
+    statistics = rolling_statistics()
+    return publish(VISIT_FINISHED, appointment_id=visit.appointment_id, end_time=visit.end_time,
+                   avg_wait_duration=math.ceil(statistics['wait']['avg'] or 0),
+                   avg_visit_duration=math.ceil(statistics['visit']['avg'] or 0))
+
+
+def appointment_event(appointment, patient=None):
+    patient = patient or {}
+    return publish(APPOINTMENT, appointment_id=appointment.get('id'), patient_id=appointment.get('patient'),
+                   scheduled_time=appointment.get('scheduled_time'), status=appointment.get('status'),
+                   first_name=patient.get('first_name'), last_name=patient.get('last_name'))
+
+
+def latest_event_id():
+    return DashboardEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def format_event(event):
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {event.data}\n\n"
+
+
+def stream(last_id, poll_interval=None, duration=None, heartbeat=15):
+    """
+    Yields server-sent events published after `last_id`, polling every `poll_interval` seconds.
+
+    Ends as soon as it has sent some events, or after `duration` seconds without any, so the worker is handed back;
+    the browser's EventSource reconnects on its own and sends the last id it saw, so nothing is missed. A comment line
+    goes out every `heartbeat` seconds to keep proxies from closing an idle connection.
+    """
+    poll_interval = poll_interval or settings.DASHBOARD_EVENTS_POLL_INTERVAL
+    duration = duration or settings.DASHBOARD_EVENTS_STREAM_DURATION
+    # ask the browser to wait a moment before reconnecting
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+
+    started = last_beat = time.monotonic()
+    while time.monotonic() - started < duration:
+        events = list(DashboardEvent.objects.filter(id__gt=last_id).order_by('id')[:100])
+        for event in events:
+            yield format_event(event)
+        if events:
+            return
+        if time.monotonic() - last_beat >= heartbeat:
+            last_beat = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(poll_interval)
@@ -0,0 +1,115 @@
+"""
+Streams Visit history out as NDJSON or CSV, for analysis elsewhere.
+
+Rows are read with QuerySet.iterator() as plain tuples (chunked database cursors, no model instances), and written out
+a chunk of lines at a time, so memory use stays flat however many visits there are.
+"""
+import csv
+import io
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from drchrono.models import Visit
+
+VISIT_COLUMNS = ('appointment_id', 'patient_id', 'doctor_id', 'status', 'scheduled_time', 'arrival_time',
+                 'start_time', 'end_time')
+EXPORT_COLUMNS = VISIT_COLUMNS + ('wait_duration', 'visit_duration')
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# rows per database round trip, and per chunk of output
+CHUNK_SIZE = 2000
+
+_STATUS_LABELS = dict(Visit.Status.choices)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def visits_to_export(start=None, end=None, statuses=None):
+    """
+    Visits that arrived between the start and end days (inclusive), optionally only those with the given statuses
+    """
+    visits = Visit.objects.all()
+    if start:
+        visits = visits.filter(arrival_time__gte=_day_start(start))
+    if end:
+        visits = visits.filter(arrival_time__lt=_day_start(end + timedelta(days=1)))
+    if statuses:
+        visits = visits.filter(status__in=statuses)
+    return visits.order_by('pk')
+
+
+def _seconds_between(earlier, later):
+    if earlier is None or later is None:
+        return None
+    return (later - earlier).total_seconds()
+
+
+def export_rows(visits):
+    """
+    Yields a dict per visit, with its status label and its wait and visit durations in seconds
+    """
+    for values in visits.values_list(*VISIT_COLUMNS).iterator(chunk_size=CHUNK_SIZE):
+        row = dict(zip(VISIT_COLUMNS, values))
+        row['status'] = _STATUS_LABELS.get(row['status'])
+        row['wait_duration'] = _seconds_between(row['arrival_time'], row['start_time'])
+        row['visit_duration'] = _seconds_between(row['start_time'], row['end_time'])
+        yield row
+
+
+def _chunked(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _ndjson_lines(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _csv_lines(rows):
+    # csv only writes to files, so each line goes through a small buffer
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({column: _csv_value(value) for column, value in row.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # only the header, if there were no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+WRITERS = {
+    'ndjson': _ndjson_lines,
+    'csv': _csv_lines,
+}
+
+
+def export_visits(format='ndjson', start=None, end=None, statuses=None):
+    """
+    Yields the export as text, a chunk of lines at a time
+    """
+    rows = export_rows(visits_to_export(start, end, statuses))
+    return _chunked(WRITERS[format](rows))
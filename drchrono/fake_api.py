@@ -0,0 +1,194 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+class FakeDrchronoAPI(object):
+    """
+    A local stand-in for the drchrono API, served from a background thread. Meant for tests and benchmarks.
+
+    Serves the resources the endpoint classes use (patients, appointments, doctors, tasks, appointment_profiles)
+    with the same paginated list format, and keeps writes in memory:
+
+        with FakeDrchronoAPI(patients=[{'id': 1, 'first_name': 'Ann'}]) as api:
+            PatientEndpoint('token', base_url=api.base_url).fetch(1)
+
+    List requests can be filtered by any field (?patient=3), by `since` (compared to updated_at), and appointments
+    by date or date_range. GET responses carry an ETag, and If-None-Match is answered with 304. Writes carrying an
+    Idempotency-Key are applied once per key.
+
+    `latency` (seconds) is added to every response, to stand in for the round trip to drchrono.com.
+
+    Tests can make it misbehave: with `accepted_tokens` set, requests carrying any other bearer token are answered 401,
+    as for an expired token, and each (status, headers) in `faults` answers one request, in order, before the
+    resources are served again:
+
+        api.faults.append((429, {'Retry-After': '1'}))
+    """
+    RESOURCES = ('patients', 'appointments', 'doctors', 'tasks', 'appointment_profiles')
+
+    def __init__(self, page_size=100, latency=0, **resources):
+        self.page_size = page_size
+        self.latency = latency
+        self.resources = {}
+        for name in self.RESOURCES:
+            self.resources[name] = {record['id']: dict(record) for record in resources.get(name, ())}
+        self.lock = threading.RLock()
+        self.request_log = []
+        self.idempotent_responses = {}
+        self.accepted_tokens = None
+        self.faults = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return "http://{}:{}/api/".format(*self.server.server_address)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _handler_for(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _next_id(self, resource):
+        return max(self.resources[resource] or [0]) + 1
+
+    def _filter(self, resource, params):
+        records = sorted(self.resources[resource].values(), key=lambda record: record['id'])
+        for key, value in params.items():
+            if key in ('page_size', 'cursor'):
+                continue
+            if key == 'date':
+                records = [r for r in records if str(r.get('scheduled_time', ''))[:10] == value]
+            elif key == 'date_range':
+                start, _, end = value.partition('/')
+                records = [r for r in records if start <= str(r.get('scheduled_time', ''))[:10] <= end]
+            elif key == 'since':
+                records = [r for r in records if str(r.get('updated_at', '')) >= value]
+            else:
+                records = [r for r in records if str(r.get(key)) == value]
+        return records
+
+    def list(self, resource, params):
+        page_size = int(params.get('page_size', self.page_size))
+        cursor = int(params.get('cursor', 0))
+        with self.lock:
+            records = self._filter(resource, params)
+        page = records[cursor:cursor + page_size]
+        next_url = None
+        if cursor + page_size < len(records):
+            next_params = dict(params, cursor=cursor + page_size, page_size=page_size)
+            next_url = "{}{}?{}".format(self.base_url, resource, urlencode(next_params))
+        return 200, {'previous': None, 'next': next_url, 'results': page}
+
+    def handle(self, method, resource, id, params, body):
+        if resource not in self.resources:
+            return 404, {'detail': 'Not found.'}
+        with self.lock:
+            records = self.resources[resource]
+            if id is None:
+                if method == 'GET':
+                    return self.list(resource, params)
+                if method == 'POST':
+                    record = dict(body, id=self._next_id(resource))
+                    records[record['id']] = record
+                    return 201, record
+                return 405, {'detail': 'Method not allowed.'}
+            if id not in records:
+                return 404, {'detail': 'Not found.'}
+            if method == 'GET':
+                return 200, records[id]
+            if method == 'PATCH':
+                records[id].update(body)
+                return 204, None
+            if method == 'PUT':
+                records[id] = dict(body, id=id)
+                return 204, None
+            if method == 'DELETE':
+                del records[id]
+                return 204, None
+            return 405, {'detail': 'Method not allowed.'}
+
+
+def _handler_for(api):
+    class FakeDrchronoHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+        def _dispatch(self):
+            url = urlparse(self.path)
+            parts = [part for part in url.path.split('/') if part]
+            if len(parts) < 2 or parts[0] != 'api':
+                return self._respond(404, {'detail': 'Not found.'})
+            resource = parts[1]
+            id = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else None
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            body = self._read_body()
+            with api.lock:
+                api.request_log.append((self.command, url.path))
+                fault = api.faults.pop(0) if api.faults else None
+            if fault is not None:
+                status, headers = fault
+                return self._respond(status, {'detail': 'Injected fault.'}, headers)
+            token = self.headers.get('Authorization', '')[len('Bearer '):]
+            if api.accepted_tokens is not None and token not in api.accepted_tokens:
+                return self._respond(401, {'detail': 'Invalid token.'})
+            key = self.headers.get('Idempotency-Key')
+            with api.lock:
+                # a write repeated with the same Idempotency-Key gets the first answer again, and isn't reapplied
+                if key and key in api.idempotent_responses:
+                    status, payload = api.idempotent_responses[key]
+                else:
+                    status, payload = api.handle(self.command, resource, id, params, body)
+                    if key and self.command != 'GET':
+                        api.idempotent_responses[key] = status, payload
+            if api.latency:
+                time.sleep(api.latency)
+            self._respond(status, payload)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if not length:
+                return {}
+            raw = self.rfile.read(length).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                return json.loads(raw)
+            return {key: values[-1] for key, values in parse_qs(raw).items()}
+
+        def _respond(self, status, payload, headers=None):
+            body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+            etag = None
+            if self.command == 'GET' and status == 200:
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+        def log_message(self, *args):
+            pass
+
+    return FakeDrchronoHandler
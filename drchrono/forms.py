@@ -1,63 +1,56 @@
 from django import forms
-from django.utils import timezone
-from drchrono.endpoints import AppointmentEndpoint, PatientEndpoint
+from drchrono import tenancy
+from drchrono.appointments import AppointmentSchedule
+from drchrono.checkin import CheckInService
 from drchrono.models import Visit
+from drchrono.patients import AmbiguousPatient, PatientDirectory
+from drchrono.tokens import get_token_manager
 from social_django.models import UserSocialAuth
 
 
 class CheckInForm(forms.Form):
     first_name = forms.CharField(max_length=150, required=True)
     last_name = forms.CharField(max_length=150, required=True)
+    date_of_birth = forms.DateField(required=False, help_text="Only needed if we can't tell you apart by name.")
 
     def clean(self):
         try:
-            oauth_provider = UserSocialAuth.objects.get(provider='drchrono')
-            access_token = oauth_provider.extra_data['access_token']
-        except UserSocialAuth.DoesNotExist: 
+            access_token = get_token_manager().get_token()
+        except (UserSocialAuth.DoesNotExist, UserSocialAuth.MultipleObjectsReturned, tenancy.NoPractice):
             raise forms.ValidationError("We had a problem authenticating with the drchrono API.")
 
-        full_name = f"{self.cleaned_data.get('first_name')} {self.cleaned_data.get('last_name')}"
-
-        appointments_client = AppointmentEndpoint(access_token)
-        patient_client = PatientEndpoint(access_token)
         self.cleaned_data['appointment_id'] = None
         self.cleaned_data['patient_id'] = None
 
-        # get a list of patients, make a list of their full names to search through
-        patients = list(patient_client.list())
-        patients_full_names = [f"{patient.get('first_name')} {patient.get('last_name')}" for patient in
-                               list(patient_client.list())]
-        patient_found = full_name in patients_full_names 
-        if not patient_found:
+        # look the patient up by name (and date of birth, if given) in the local directory
+        date_of_birth = self.cleaned_data.get('date_of_birth')
+        try:
+            patient = PatientDirectory(access_token).lookup(self.cleaned_data.get('first_name'),
+                                                            self.cleaned_data.get('last_name'),
+                                                            date_of_birth.isoformat() if date_of_birth else None)
+        except AmbiguousPatient:
+            if date_of_birth:
+                raise forms.ValidationError("More than one patient matches your name and date of birth, "
+                                            "please check in at the front desk.")
+            raise forms.ValidationError("More than one patient has your name, please enter your date of birth too.")
+        if patient is None:
             raise forms.ValidationError("Couldn't find a patient matching your name.")
 
-        patient = patients[patients_full_names.index(full_name)]
         self.cleaned_data['patient_id'] = patient.get('id')
 
         # okay, we found them. do they have an appt. ?
-        today = timezone.now()
-        today_str = today.strftime('%m-%d-%y')
-        appointments = list(
-            appointments_client.list({'patient': self.cleaned_data.get('patient_id')}, start=today_str, end=today_str)) 
+        appointments = AppointmentSchedule(access_token).for_patient(self.cleaned_data.get('patient_id'))
         patient_has_appointment_today = len(appointments) > 0
         if not patient_has_appointment_today: 
             raise forms.ValidationError("Couldn't find an appointment for you today.")
 
-        # if they have any appointments set their status to Arrived
-        for appointment in appointments:
-            self.cleaned_data['appointment_id'] = appointment.get('id')
-            import random
-            if random.randrange(20) % 4:
-                appointments_client.update(self.cleaned_data['appointment_id'], {'status': 'Arrived'})  
-
-            # create a Visit object
-            visit, created = Visit.objects.get_or_create(appointment_id=self.cleaned_data['appointment_id'], 
-                                                         patient_id=self.cleaned_data['patient_id'])
-
-            # if there was already a Visit object and it is set to Arrived, they already checked in!
-            if not created and visit.status == 'Arrived':
-                raise forms.ValidationError("You already checked in for your appointment today.")
-
+        # the check-in itself is done by the view, for the appointments they haven't checked in for yet
+        appointments = CheckInService.pending(appointments)
+        if not appointments:
+            raise forms.ValidationError("You already checked in for your appointment today.")
+        self.cleaned_data['patient'] = patient
+        self.cleaned_data['appointments'] = appointments
+        self.cleaned_data['appointment_id'] = appointments[-1].get('id')
 
 
 RACE_CHOICES = (
@@ -91,3 +84,25 @@ class DemographicForm(forms.Form):
 
 class TimerForm(forms.Form):
     appointment_id = forms.CharField(max_length=150, required=True)
+
+
+class VisitExportForm(forms.Form):
+    FORMAT_CHOICES = (('ndjson', 'NDJSON'), ('csv', 'CSV'))
+    STATUS_CHOICES = [(status.name.lower(), status.label) for status in Visit.Status]
+
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False)
+    start = forms.DateField(required=False, help_text="First day of arrivals to export (YYYY-MM-DD)")
+    end = forms.DateField(required=False, help_text="Last day of arrivals to export (YYYY-MM-DD)")
+    status = forms.MultipleChoiceField(choices=STATUS_CHOICES, required=False)
+
+    def clean_format(self):
+        return self.cleaned_data.get('format') or 'ndjson'
+
+    def clean_status(self):
+        return [Visit.Status[name.upper()] for name in self.cleaned_data.get('status', [])]
+
+    def clean(self):
+        start, end = self.cleaned_data.get('start'), self.cleaned_data.get('end')
+        if start and end and start > end:
+            raise forms.ValidationError("The start date has to come before the end date.")
+        return self.cleaned_data
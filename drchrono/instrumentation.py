@@ -0,0 +1,174 @@
+"""
+Per-request timings: drchrono API calls, database queries and named sections of code.
+
+drchrono.middleware.RequestMetricsMiddleware starts a RequestMetrics for every request. While it's active
+ - BaseEndpoint records each API call it sends: endpoint, method, page of a list, status, bytes and wall time,
+ - every query on the default database connection is counted and timed,
+ - code wrapped in `with section('name'):` is timed,
+and when the response goes out, the totals are added to its Server-Timing header (shown by the browser's dev tools)
+and logged as one JSON line on the `drchrono.middleware` logger.
+
+Outside a request (management commands, workers) nothing is recorded, and each hook costs one context variable
+lookup. Worker threads started on behalf of a request only report into it if they run in a copy of its context, see
+in_current_context().
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+_metrics = contextvars.ContextVar('drchrono_request_metrics', default=None)
+_page = contextvars.ContextVar('drchrono_api_page', default=None)
+
+
+class RequestMetrics(object):
+    """
+    What one request spent its time on. Thread-safe, since API calls may be made from worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.api = {}  # endpoint -> {'calls', 'bytes', 'seconds', 'cached', 'throttled'}
+        self.calls = []  # one dict per API call, in the order they finished
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.sections = {}  # name -> seconds
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self.api:
+            self.api[endpoint] = {'calls': 0, 'bytes': 0, 'seconds': 0.0, 'cached': 0, 'throttled': 0.0}
+        return self.api[endpoint]
+
+    def api_call(self, endpoint, method, status, size, seconds, page=None):
+        with self._lock:
+            totals = self._endpoint(endpoint)
+            totals['calls'] += 1
+            totals['bytes'] += size
+            totals['seconds'] += seconds
+            self.calls.append({'endpoint': endpoint, 'method': method.upper(), 'page': page, 'status': status,
+                               'bytes': size, 'ms': round(seconds * 1000, 1)})
+
+    def api_cached(self, endpoint):
+        with self._lock:
+            self._endpoint(endpoint)['cached'] += 1
+
+    def api_throttled(self, endpoint, seconds):
+        with self._lock:
+            self._endpoint(endpoint)['throttled'] += seconds
+
+    def query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+
+    def section(self, name, seconds):
+        with self._lock:
+            self.sections[name] = self.sections.get(name, 0.0) + seconds
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        The metrics as a Server-Timing header value. API durations are summed over calls, so calls made concurrently
+        can add up to more than the request's total.
+        """
+        with self._lock:
+            api_seconds = sum(totals['seconds'] for totals in self.api.values())
+            api_calls = sum(totals['calls'] for totals in self.api.values())
+            entries = [
+                'total;dur={:.1f}'.format(self.elapsed * 1000),
+                'db;dur={:.1f};desc="{} queries"'.format(self.query_seconds * 1000, self.queries),
+                'api;dur={:.1f};desc="{} calls"'.format(api_seconds * 1000, api_calls),
+            ]
+            for endpoint, totals in sorted(self.api.items()):
+                entries.append('api-{};dur={:.1f};desc="{} calls, {} bytes, {} cached"'.format(
+                    endpoint, totals['seconds'] * 1000, totals['calls'], totals['bytes'], totals['cached']))
+            for name, seconds in self.sections.items():
+                entries.append('{};dur={:.1f}'.format(name, seconds * 1000))
+        return ', '.join(entries)
+
+    def as_dict(self, max_calls=None):
+        """
+        The metrics as a JSON-serializable dict. Only the first `max_calls` individual API calls are listed; the
+        per-endpoint totals count them all.
+        """
+        with self._lock:
+            return {
+                'ms': round(self.elapsed * 1000, 1),
+                'db': {'queries': self.queries, 'ms': round(self.query_seconds * 1000, 1)},
+                'api': {endpoint: {'calls': totals['calls'], 'bytes': totals['bytes'],
+                                   'ms': round(totals['seconds'] * 1000, 1), 'cached': totals['cached'],
+                                   'throttled_ms': round(totals['throttled'] * 1000, 1)}
+                        for endpoint, totals in self.api.items()},
+                'api_calls': self.calls[:max_calls],
+                'sections': {name: round(seconds * 1000, 1) for name, seconds in self.sections.items()},
+            }
+
+
+def current():
+    """
+    The RequestMetrics of the request being served, or None
+    """
+    return _metrics.get()
+
+
+def api_page():
+    """
+    The page of a list being retrieved, if any; see `listing_page`
+    """
+    return _page.get()
+
+
+@contextmanager
+def listing_page(number):
+    """
+    Marks the API calls made inside the block as retrieving page `number` of a list
+    """
+    token = _page.set(number)
+    try:
+        yield
+    finally:
+        _page.reset(token)
+
+
+@contextmanager
+def section(name):
+    """
+    Times the block as `name` in the current request's metrics, if there is one
+    """
+    metrics = _metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.section(name, time.perf_counter() - start)
+
+
+def in_current_context(func):
+    """
+    Wraps `func` so that, whichever thread calls it, it runs in a copy of the caller's current context, and so
+    reports into the same request's metrics
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a context can only be entered by one thread at a time, so each call gets a copy of its own
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def activate(metrics):
+    """
+    Makes `metrics` the current request's, until deactivate() is called with the token returned
+    """
+    return _metrics.set(metrics)
+
+
+def deactivate(token):
+    _metrics.reset(token)
@@ -0,0 +1,44 @@
+"""
+Helpers for joining API records (dicts) and model instances in memory.
+
+Build one id -> record map per request with index_by(), then enrich() each set of rows in a single pass, instead of
+searching the whole record list once per row.
+"""
+
+
+def _get(row, name):
+    if isinstance(row, dict):
+        return row.get(name)
+    return getattr(row, name, None)
+
+
+def _set(row, name, value):
+    if isinstance(row, dict):
+        row[name] = value
+    else:
+        setattr(row, name, value)
+
+
+def index_by(records, key='id'):
+    """
+    Returns a {record[key]: record} dict. Works for dicts and objects alike.
+    """
+    return {_get(record, key): record for record in records}
+
+
+def enrich(rows, index, ref, fields, default=None):
+    """
+    For every row, looks up the record it references (row[ref]) in `index` and copies `fields` from that record onto
+    the row. Rows can be dicts or objects, and are modified in place.
+
+    Rows whose reference is missing from the index get `default` for every field. They are returned as a list, so the
+    caller can decide whether that deserves a warning or an error.
+    """
+    missing = []
+    for row in rows:
+        record = index.get(_get(row, ref))
+        if record is None:
+            missing.append(row)
+        for field in fields:
+            _set(row, field, default if record is None else _get(record, field))
+    return missing
@@ -0,0 +1,48 @@
+"""
+Shared helpers for the bench_* management commands
+"""
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+def best_of(func, repeat=5):
+    """
+    Calls func() `repeat` times and returns the fastest wall time, in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def ms(seconds):
+    return f"{seconds * 1000:10.2f} ms"
+
+
+@contextmanager
+def scratch_database(verbosity=0, on_disk=False):
+    """
+    Runs the block against a throwaway copy of the default database, created the same way the test runner does, so
+    benchmarks can fill it with data without touching real rows.
+
+    SQLite test databases live in memory, where a write locks whole tables for every other connection. Pass
+    on_disk=True when several threads write at once, to use a temporary file instead.
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    with tempfile.TemporaryDirectory() as directory:
+        if on_disk and connection.vendor == 'sqlite' and not old_test_name:
+            test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+        try:
+            yield connection
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+            test_settings['NAME'] = old_test_name
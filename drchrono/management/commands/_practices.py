@@ -0,0 +1,32 @@
+"""
+Shared helpers for the background worker commands
+"""
+import logging
+
+from django.core.management.base import CommandError
+from drchrono import tenancy
+from drchrono.models import Practice
+from drchrono.tokens import get_token_manager
+from social_django.models import UserSocialAuth
+
+logger = logging.getLogger(__name__)
+
+
+def signed_in_practices():
+    """
+    Yields each practice whose drchrono account is still there, making it the current one until the next (see
+    tenancy.each). A practice whose account is gone is logged and skipped, so the others are still served.
+
+    Raises CommandError if nobody has signed in at all.
+    """
+    for practice in tenancy.each(Practice.objects.all()):
+        try:
+            get_token_manager().get_token()
+        except UserSocialAuth.DoesNotExist:
+            if practice is None:
+                raise CommandError("No drchrono account is set up yet, sign in through /setup/ first.")
+            logger.warning("skipping %s, its drchrono account is gone; sign in through /setup/ again", practice)
+            continue
+        except UserSocialAuth.MultipleObjectsReturned:
+            raise CommandError("Several drchrono accounts have signed in, run `manage.py setup_practices` first.")
+        yield practice
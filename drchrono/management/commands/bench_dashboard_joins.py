@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from drchrono.joins import enrich, index_by
+from drchrono.patients import PATIENT_NAME_FIELDS
+
+from ._bench import best_of, ms
+
+
+def fake_patients(count):
+    return [{'id': i, 'first_name': f"First{i}", 'last_name': f"Last{i}", 'date_of_birth': '1980-01-01',
+             'date_of_last_appointment': '2020-01-01', 'race': 'declined', 'gender': 'Other', 'ethnicity': 'declined'}
+            for i in range(count)]
+
+
+def fake_appointments(count, patients):
+    step = max(patients // count, 1)
+    return [{'id': i, 'patient': (i * step) % patients} for i in range(count)]
+
+
+def fake_visits(count, patients):
+    step = max(patients // max(count, 1), 1)
+    return [SimpleNamespace(appointment_id=i, patient_id=(i * step + step // 2) % patients) for i in range(count)]
+
+
+def scan_join(patients, appointments, visits):
+    """
+    What the dashboard used to do: search the whole patient list once per row
+    """
+    for appointment in appointments:
+        patient = [patient for patient in patients if patient.get('id') == appointment.get('patient')][0]
+        appointment['first_name'] = patient.get('first_name')
+        appointment['last_name'] = patient.get('last_name')
+    for visit in visits:
+        patient = [patient for patient in patients if patient.get('id') == visit.patient_id][0]
+        visit.first_name = patient.get('first_name')
+        visit.last_name = patient.get('last_name')
+
+
+def map_join(patients, appointments, visits):
+    patients_by_id = index_by(patients)
+    enrich(appointments, patients_by_id, 'patient', PATIENT_NAME_FIELDS)
+    enrich(visits, patients_by_id, 'patient_id', PATIENT_NAME_FIELDS)
+
+
+class Command(BaseCommand):
+    help = "Compares the dashboard's patient/appointment/visit joins: per-row list scans vs. one id -> patient map"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=10000)
+        parser.add_argument('--appointments', type=int, default=500)
+        parser.add_argument('--arrived', type=int, default=50, help="number of checked in visits")
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'patients':>10} {'appointments':>13} {'list scans':>13} {'id map':>13} {'speedup':>8}")
+        sizes = sorted({options['patients'] // 10, options['patients'] // 2, options['patients']})
+        for count in sizes:
+            patients = fake_patients(count)
+            appointments = fake_appointments(options['appointments'], count)
+            visits = fake_visits(options['arrived'], count)
+
+            scanned = best_of(lambda: scan_join(patients, appointments, visits), options['repeat'])
+            mapped = best_of(lambda: map_join(patients, appointments, visits), options['repeat'])
+            self.stdout.write(f"{count:>10} {options['appointments']:>13} {ms(scanned)} {ms(mapped)} "
+                              f"{scanned / mapped:7.0f}x")
@@ -0,0 +1,201 @@
+import contextvars
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from drchrono import tenancy
+from drchrono.appointments import AppointmentSchedule
+from drchrono.endpoints import BaseEndpoint
+from drchrono.fake_api import FakeDrchronoAPI
+from drchrono.models import Practice
+from drchrono.outbox import Outbox
+from drchrono.patients import PatientDirectory
+from drchrono.ratelimit import reset_rate_limiter
+from drchrono.response_cache import reset_response_caches
+from drchrono.tokens import get_token_manager
+from drchrono.transport import Transport, set_transport
+from social_django.models import UserSocialAuth
+
+from ._bench import scratch_database
+
+STEPS = ('check-in', 'demographics', 'demographics-update', 'dashboard', 'start-visit', 'finish-visit')
+
+
+class CountingTransport(Transport):
+    """
+    A Transport that counts the API calls made on behalf of each request, so they can be attributed to it. The count
+    is a context variable, so calls made from worker threads running in the request's context are counted too.
+    """
+
+    def __init__(self, **kwargs):
+        super(CountingTransport, self).__init__(**kwargs)
+        self._count = contextvars.ContextVar('bench_api_calls', default=None)
+        self._count_lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        count = self._count.get()
+        if count is not None:
+            with self._count_lock:
+                count[0] += 1
+        return super(CountingTransport, self).request(method, url, *args, **kwargs)
+
+    def counting(self):
+        """
+        Starts a new count in the current context, and returns it: a one item list
+        """
+        count = [0]
+        self._count.set(count)
+        return count
+
+
+def fake_patients(count):
+    return [{'id': i, 'first_name': f"First{i}", 'last_name': f"Last{i}", 'date_of_birth': '1980-01-01',
+             'gender': 'Other', 'updated_at': '2020-01-01T00:00:00'} for i in range(1, count + 1)]
+
+
+def fake_appointments(count, patients):
+    today = timezone.localdate()
+    step = max(patients // count, 1)
+    return [{'id': i + 1, 'patient': (i * step) % patients + 1, 'doctor': 1, 'status': '',
+             'scheduled_time': f"{today.isoformat()}T{8 + i * 10 // count:02d}:{i % 60:02d}:00",
+             'updated_at': '2020-01-01T00:00:00'} for i in range(count)]
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    return values[min(max(int(math.ceil(fraction * len(values))) - 1, 0), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = ("Drives check-in -> demographics -> dashboard -> start visit -> finish visit against a local fake drchrono "
+            "API and reports latency percentiles, API calls and DB queries per request, and throughput")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=2000)
+        parser.add_argument('--appointments', type=int, default=60, help="appointments today; one flow each")
+        parser.add_argument('--latency', type=float, default=20, help="milliseconds added to every API response")
+        parser.add_argument('--page-size', type=int, default=100, help="page size of the fake API's lists")
+        parser.add_argument('--concurrency', type=int, default=1, help="kiosks/dashboards running flows at once")
+        parser.add_argument('--cold', action='store_true',
+                            help="don't sync patients and appointments before starting; the first requests do it")
+
+    def request(self, client, transport, samples, step, method, path, data=None, expect=(200, 302)):
+        calls = transport.counting()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = getattr(client, method)(path, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+        samples[step].append((elapsed, calls[0], len(queries)))
+        if response.status_code not in expect:
+            raise CommandError(f"{step} {path} answered {response.status_code}")
+        return response
+
+    def flow(self, client, transport, samples, patient, appointment):
+        self.request(client, transport, samples, 'check-in', 'post', '/check-in/',
+                     {'first_name': patient['first_name'], 'last_name': patient['last_name']}, expect=(302,))
+        self.request(client, transport, samples, 'demographics', 'get', f"/demographics/?patient_id={patient['id']}")
+        self.request(client, transport, samples, 'demographics-update', 'post', '/demographics/',
+                     {'patient_id': patient['id'], 'first_name': patient['first_name'],
+                      'last_name': patient['last_name'], 'gender': 'Other'}, expect=(302,))
+        self.request(client, transport, samples, 'dashboard', 'get', '/welcome/')
+        self.request(client, transport, samples, 'start-visit', 'post', '/toggle-timer/',
+                     {'appointment_id': appointment['id']}, expect=(302,))
+        self.request(client, transport, samples, 'finish-visit', 'post', '/toggle-timer/',
+                     {'appointment_id': appointment['id']}, expect=(302,))
+
+    def worker(self, transport, samples, flows, errors):
+        client = Client()
+        try:
+            for patient, appointment in flows:
+                self.flow(client, transport, samples, patient, appointment)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def report(self, samples, elapsed, flows):
+        self.stdout.write(f"{'step':<20} {'requests':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'API calls':>10} "
+                          f"{'queries':>8}")
+        total = 0
+        for step in STEPS:
+            if not samples[step]:
+                continue
+            timings = sorted(sample[0] for sample in samples[step])
+            calls = sum(sample[1] for sample in samples[step]) / len(timings)
+            queries = sum(sample[2] for sample in samples[step]) / len(timings)
+            total += len(timings)
+            self.stdout.write(f"{step:<20} {len(timings):>8} " +
+                              " ".join(f"{percentile(timings, fraction) * 1000:7.1f}ms" for fraction in (.5, .95, .99))
+                              + f" {calls:>10.1f} {queries:>8.1f}")
+        self.stdout.write(f"\n{total} requests, {flows} flows in {elapsed:.2f}s: "
+                          f"{total / elapsed:.1f} requests/s, {flows / elapsed:.2f} flows/s")
+
+    def handle(self, *args, **options):
+        patients = fake_patients(options['patients'])
+        appointments = fake_appointments(options['appointments'], options['patients'])
+        patients_by_id = {patient['id']: patient for patient in patients}
+        flows = [(patients_by_id[appointment['patient']], appointment) for appointment in appointments]
+        concurrency = max(1, min(options['concurrency'], len(flows)))
+
+        api = FakeDrchronoAPI(page_size=options['page_size'], latency=options['latency'] / 1000, patients=patients,
+                              appointments=appointments, doctors=[{'id': 1, 'first_name': 'Bench', 'last_name': 'Doc'}])
+        transport = CountingTransport(pool_maxsize=max(10, concurrency * 2))
+        # the fake API has no quota to respect, and nothing should be cached from an earlier run
+        overrides = override_settings(DRCHRONO_API_RATE_LIMIT=None, ALLOWED_HOSTS=['testserver'])
+        with scratch_database(on_disk=concurrency > 1), api, overrides:
+            base_url, BaseEndpoint.BASE_URL = BaseEndpoint.BASE_URL, api.base_url
+            previous_transport = set_transport(transport)
+            reset_rate_limiter()
+            reset_response_caches()
+            try:
+                user = User.objects.create(username='bench')
+                UserSocialAuth.objects.create(user=user, provider='drchrono', uid='bench', extra_data={
+                    'access_token': 'bench', 'expires_in': 36000, 'auth_time': int(time.time())})
+                # the requests are served for the one practice there is, see TenantMiddleware
+                with tenancy.using(Practice.objects.get(uid='bench')):
+                    get_token_manager().invalidate()
+                    # in production `manage.py sync_patients`/`sync_appointments` keep these up to date, not the
+                    # requests
+                    if not options['cold']:
+                        PatientDirectory().sync(full=True)
+                        AppointmentSchedule().sync(full=True)
+
+                    samples = defaultdict(list)
+                    errors = []
+                    threads = [threading.Thread(target=self.worker, args=(transport, samples, flows[i::concurrency],
+                                                                          errors))
+                               for i in range(concurrency)]
+                    start = time.perf_counter()
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    elapsed = time.perf_counter() - start
+
+                    # what `manage.py process_outbox` would have sent in the background meanwhile
+                    start = time.perf_counter()
+                    sent = Outbox().drain()
+                    outbox_elapsed = time.perf_counter() - start
+            finally:
+                BaseEndpoint.BASE_URL = base_url
+                set_transport(previous_transport)
+                get_token_manager('bench').invalidate()
+                reset_response_caches()
+
+        if errors:
+            raise CommandError(f"{len(errors)} of {concurrency} workers failed, first with: {errors[0]!r}")
+        self.stdout.write(f"{options['patients']} patients, {len(flows)} appointments, {options['latency']:g}ms API "
+                          f"latency, concurrency {concurrency}\n")
+        self.report(samples, elapsed, len(flows))
+        self.stdout.write(f"then {sent} queued API changes sent in {outbox_elapsed:.2f}s")
@@ -0,0 +1,49 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Run in a fresh interpreter, so nothing is imported yet. ru_maxrss is in kilobytes on Linux.
+PROBE = """
+import json, os, resource, sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+import drchrono.wsgi
+from django.urls import get_resolver
+get_resolver().url_patterns  # load the URLconf, like the first request does
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+class Command(BaseCommand):
+    help = ("Measures import time and peak memory of starting a worker (drchrono.wsgi plus the URLconf), with "
+            "charting loaded lazily vs. pandas and altair imported up front, like views.py used to")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+
+    def probe(self, preload, runs):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'drchrono.settings'))
+        results = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', PROBE] + preload, cwd=settings.BASE_DIR, env=env,
+                                    stdout=subprocess.PIPE, check=True).stdout
+            results.append(json.loads(output.decode().strip().splitlines()[-1]))
+        return (statistics.median(result['seconds'] for result in results),
+                statistics.median(result['rss_mb'] for result in results))
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'':<28} {'import time':>12} {'peak RSS':>10}")
+        for name, preload in (('eager (pandas + altair)', ['pandas', 'altair']), ('lazy charting', [])):
+            try:
+                seconds, rss = self.probe(preload, options['runs'])
+            except subprocess.CalledProcessError:
+                self.stderr.write(f"{name}: failed to start, is everything in requirements.txt installed?")
+                continue
+            self.stdout.write(f"{name:<28} {seconds * 1000:>9.0f} ms {rss:>7.1f} MB")
@@ -0,0 +1,81 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from drchrono import tenancy
+from drchrono.models import Practice, Visit
+from drchrono.stats import finished_visits
+
+from ._bench import best_of, ms, scratch_database
+
+
+def fill_visits(count, batch_size=10000):
+    """
+    Inserts `count` visits: almost all finished, a handful waiting and one in session
+    """
+    now = timezone.now()
+    waiting = max(count // 1000, 1)
+    batch = []
+    for i in range(count):
+        arrival = now - timedelta(minutes=count - i)
+        visit = Visit(appointment_id=i, patient_id=i % 10000, doctor_id=1, arrival_time=arrival)
+        if i >= count - waiting:
+            visit.status = Visit.Status.ARRIVED
+        elif i == count - waiting - 1:
+            visit.status, visit.start_time = Visit.Status.IN_SESSION, arrival + timedelta(minutes=5)
+        else:
+            visit.status = Visit.Status.FINISHED
+            visit.start_time, visit.end_time = arrival + timedelta(minutes=5), arrival + timedelta(minutes=20)
+        batch.append(visit)
+        if len(batch) == batch_size:
+            Visit.objects.bulk_create(batch)
+            batch = []
+    Visit.objects.bulk_create(batch)
+
+
+class Command(BaseCommand):
+    help = ("Fills a scratch database with visits and shows the query plan, query count and timing of the "
+            "dashboard and kiosk Visit lookups, as served for one practice")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--visits', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--unassigned', action='store_true',
+                            help="store and look the visits up with no current practice, as a deployment from before "
+                                 "practices does")
+
+    def lookups(self, count):
+        """
+        name -> (lookup, query to explain). Built with the practice current, since the manager filters on it.
+        """
+        return {
+            'arrivals': (
+                lambda: list(Visit.objects.filter(status=Visit.Status.ARRIVED, arrival_time__isnull=False,
+                                                  start_time__isnull=True)),
+                Visit.objects.filter(status=Visit.Status.ARRIVED, arrival_time__isnull=False,
+                                     start_time__isnull=True)),
+            'current visit': (
+                lambda: Visit.objects.filter(status=Visit.Status.IN_SESSION, arrival_time__isnull=False,
+                                             start_time__isnull=False).first(),
+                Visit.objects.filter(status=Visit.Status.IN_SESSION, arrival_time__isnull=False,
+                                     start_time__isnull=False)[:1]),
+            'finished count': (lambda: finished_visits().count(), finished_visits().values('id')),
+            'kiosk check-in': (
+                lambda: Visit.objects.filter(appointment_id=count // 2, patient_id=(count // 2) % 10000).exists(),
+                Visit.objects.filter(appointment_id=count // 2, patient_id=(count // 2) % 10000).values('id')),
+        }
+
+    def handle(self, *args, **options):
+        count = options['visits']
+        with scratch_database() as connection:
+            practice = None if options['unassigned'] else Practice.objects.create(uid='bench')
+            with tenancy.using(practice):
+                self.stdout.write(f"Inserting {count} visits...")
+                fill_visits(count)
+                for name, (lookup, plan) in self.lookups(count).items():
+                    with CaptureQueriesContext(connection) as queries:
+                        lookup()
+                    timing = best_of(lookup, options['repeat'])
+                    self.stdout.write(f"\n{name}: {len(queries)} queries, {ms(timing).strip()}")
+                    self.stdout.write(plan.explain())
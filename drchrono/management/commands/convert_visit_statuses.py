@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from drchrono.models import Visit
+
+
+class Command(BaseCommand):
+    help = ("Converts Visit statuses saved as text ('Arrived', 'In Session', 'Finished'), from before status was "
+            "stored as a number, to their Visit.Status values. Run once, after migrating a database that has visits.")
+
+    def handle(self, *args, **options):
+        table = connection.ops.quote_name(Visit._meta.db_table)
+        column = connection.ops.quote_name(Visit._meta.get_field('status').column)
+        # raw SQL, since the ORM reads the column as a number and so can't see the text, and across every practice
+        with transaction.atomic(), connection.cursor() as cursor:
+            for value, label in Visit.Status.choices:
+                cursor.execute(f"UPDATE {table} SET {column} = %s WHERE {column} = %s", [value, label])
+                if cursor.rowcount:
+                    self.stdout.write(f"Converted {cursor.rowcount} '{label}' visits to {value}")
+            cursor.execute(f"UPDATE {table} SET {column} = NULL WHERE {column} = ''")
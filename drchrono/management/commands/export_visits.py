@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from drchrono import tenancy
+from drchrono.exports import export_visits
+from drchrono.forms import VisitExportForm
+from drchrono.models import Practice
+
+
+class Command(BaseCommand):
+    help = "Exports visit history as NDJSON or CSV, streaming it so memory use stays flat"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=[choice for choice, _ in VisitExportForm.FORMAT_CHOICES],
+                            default='ndjson')
+        parser.add_argument('--start', help="first day of arrivals to export (YYYY-MM-DD)")
+        parser.add_argument('--end', help="last day of arrivals to export (YYYY-MM-DD)")
+        parser.add_argument('--status', action='append', default=[],
+                            choices=[choice for choice, _ in VisitExportForm.STATUS_CHOICES],
+                            help="only export visits with this status; can be repeated")
+        parser.add_argument('--output', '-o', help="file to write to, instead of stdout")
+        parser.add_argument('--practice', help="the practice whose visits to export (its drchrono account's uid); "
+                                               "required when several practices have signed in")
+
+    def handle(self, *args, **options):
+        form = VisitExportForm({key: options[key] for key in ('format', 'start', 'end', 'status')})
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+
+        # as for requests (see TenantMiddleware): the only practice there is, or the one asked for. With no practices
+        # at all, the visits from before there were any.
+        practices = Practice.objects.all()
+        if options['practice']:
+            practices = practices.filter(uid=options['practice'])
+            if not practices:
+                raise CommandError(f"No practice with uid {options['practice']}")
+        elif len(practices) > 1:
+            uids = ', '.join(practice.uid for practice in practices)
+            raise CommandError(f"Several practices have signed in, pick one with --practice ({uids})")
+        practice = practices[0] if practices else None
+
+        # the practice has to be current when the query is built, not just while it's read
+        with tenancy.using(practice):
+            chunks = export_visits(form.cleaned_data['format'], form.cleaned_data['start'], form.cleaned_data['end'],
+                                   form.cleaned_data['status'])
+            if not options['output']:
+                for chunk in chunks:
+                    self.stdout.write(chunk, ending='')
+                return
+            with open(options['output'], 'w', newline='') as output:
+                for chunk in chunks:
+                    output.write(chunk)
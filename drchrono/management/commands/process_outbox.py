@@ -0,0 +1,47 @@
+import logging
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from drchrono.endpoints import APIException
+from drchrono.outbox import Outbox
+
+from ._practices import signed_in_practices
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Sends the changes queued by the kiosk (appointment statuses, patient demographics) to the drchrono API, "
+            "polling for new ones. Run one or more of these alongside the web server; each serves every practice in "
+            "turn.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.OUTBOX_POLL_INTERVAL,
+                            help="seconds between checks for new changes")
+        parser.add_argument('--once', action='store_true', help="send what's due and exit")
+        parser.add_argument('--batch', type=int, default=100, help="changes to send at a time")
+
+    def handle(self, *args, **options):
+        while True:
+            for practice in signed_in_practices():
+                name = practice or 'the drchrono account'
+                try:
+                    outbox = Outbox()
+                    sent = outbox.drain(options['batch'])
+                    outbox.prune()
+                except Exception as e:
+                    # keep going for the other practices, and try this one again on the next poll
+                    if isinstance(e, (APIException, requests.RequestException)):
+                        logger.warning("sending changes failed for %s: %r", name, e)
+                    else:
+                        logger.exception("sending changes failed for %s", name)
+                    if options['once']:
+                        raise CommandError(f"sending changes failed for {name}: {e!r}")
+                else:
+                    if sent:
+                        self.stdout.write(f"Sent {sent} changes for {name}")
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from drchrono import tenancy
+from drchrono.models import Practice
+from drchrono.stats import rebuild_daily_statistics
+
+
+class Command(BaseCommand):
+    help = "Recomputes each practice's per doctor, per day wait and visit statistics from Visit history"
+
+    def handle(self, *args, **options):
+        for practice in tenancy.each(Practice.objects.all()):
+            name = practice or 'the drchrono account'
+            count = rebuild_daily_statistics()
+            self.stdout.write(f"Wrote statistics for {count} doctor-days for {name}")
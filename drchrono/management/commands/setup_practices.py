@@ -0,0 +1,25 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from drchrono.models import Practice, TenantModel
+from social_django.models import UserSocialAuth
+
+
+class Command(BaseCommand):
+    help = ("Adds a practice for every drchrono account signed in before practices existed. If there's only one, the "
+            "rows saved before then are given to it.")
+
+    def handle(self, *args, **options):
+        for uid in UserSocialAuth.objects.filter(provider='drchrono').values_list('uid', flat=True):
+            practice, created = Practice.objects.get_or_create(uid=uid)
+            if created:
+                self.stdout.write(f"Added practice {practice}")
+
+        practices = list(Practice.objects.all()[:2])
+        if len(practices) != 1:
+            self.stdout.write("Rows without a practice are left alone, since there's more than one practice.")
+            return
+        for model in apps.get_app_config('drchrono').get_models():
+            if issubclass(model, TenantModel):
+                count = model.objects.filter(practice__isnull=True).update(practice=practices[0])
+                if count:
+                    self.stdout.write(f"Gave {count} {model.__name__} rows to {practices[0]}")
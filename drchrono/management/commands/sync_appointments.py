@@ -0,0 +1,52 @@
+import logging
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from drchrono import events
+from drchrono.appointments import AppointmentSchedule
+from drchrono.endpoints import APIException
+
+from ._practices import signed_in_practices
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Keeps the local copy of today's appointments in sync with the drchrono API, polling on a schedule. "
+            "Syncs every practice in turn, and forgets old dashboard events.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.APPOINTMENT_SYNC_INTERVAL,
+                            help="seconds between syncs")
+        parser.add_argument('--once', action='store_true', help="sync once and exit")
+        parser.add_argument('--full-every', type=int, default=20,
+                            help="do a full sync (catching deleted and rescheduled appointments) every N syncs")
+
+    def handle(self, *args, **options):
+        syncs = 0
+        while True:
+            full = syncs % options['full_every'] == 0
+            for practice in signed_in_practices():
+                name = practice or 'the drchrono account'
+                try:
+                    # the token manager keeps the token fresh however long the worker runs
+                    changed = AppointmentSchedule().sync(full=full)
+                except Exception as e:
+                    # keep polling whatever went wrong: the API or network may be back by the next sync
+                    if isinstance(e, (APIException, requests.RequestException)):
+                        logger.warning("appointment sync failed for %s: %r", name, e)
+                    else:
+                        logger.exception("appointment sync failed for %s", name)
+                    if options['once']:
+                        raise CommandError(f"appointment sync failed for {name}: {e!r}")
+                else:
+                    self.stdout.write(f"{'Full' if full else 'Incremental'} sync for {name}: "
+                                      f"{changed} appointments changed")
+                # the dashboards' old events go too, rather than on every publish
+                events.prune()
+            syncs += 1
+            if options['once']:
+                return
+            time.sleep(options['interval'])
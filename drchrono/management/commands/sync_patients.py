@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from drchrono.patients import PatientDirectory
+
+from ._practices import signed_in_practices
+
+
+class Command(BaseCommand):
+    help = "Brings each practice's local patient directory up to date with the drchrono API"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="reload every patient instead of only recent changes")
+
+    def handle(self, *args, **options):
+        for practice in signed_in_practices():
+            name = practice or 'the drchrono account'
+            directory = PatientDirectory()
+            count = directory.sync(full=options['full'])
+            self.stdout.write(f"Synced {count} patients for {name}")
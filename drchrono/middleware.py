@@ -0,0 +1,92 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from drchrono import instrumentation, tenancy, tokens
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Records the metrics of each request, and reports them in the Server-Timing header (if
+    REQUEST_METRICS_SERVER_TIMING) and on the `drchrono.middleware` logger
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def _time_query(self, metrics):
+        def execute(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                metrics.query(time.perf_counter() - start)
+        return execute
+
+    def __call__(self, request):
+        metrics = instrumentation.RequestMetrics()
+        token = instrumentation.activate(metrics)
+        try:
+            with connection.execute_wrapper(self._time_query(metrics)):
+                response = self.get_response(request)
+        finally:
+            instrumentation.deactivate(token)
+
+        if settings.REQUEST_METRICS_SERVER_TIMING:
+            timing = metrics.server_timing()
+            if response.has_header('Server-Timing'):
+                timing = '{}, {}'.format(response['Server-Timing'], timing)
+            response['Server-Timing'] = timing
+        if logger.isEnabledFor(logging.INFO):
+            record = dict(metrics.as_dict(settings.REQUEST_METRICS_LOGGED_CALLS),
+                          method=request.method, path=request.path, status=response.status_code)
+            logger.info(json.dumps(record, sort_keys=True))
+        return response
+
+
+class CredentialsMiddleware(object):
+    """
+    Lets each request read the drchrono access token from the database at most once, see drchrono.tokens
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with tokens.request_scope():
+            return self.get_response(request)
+
+
+class TenantMiddleware(object):
+    """
+    Serves each request for the practice of the drchrono account its user signed in with, see drchrono.tenancy. With
+    a single practice, requests from users who haven't signed in (the kiosk before /setup/) are served for it too.
+    With several, those are served for NOBODY, and see no practice's data.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def practice(self, request):
+        # imported here, since the models can only be imported once the app registry is ready
+        from drchrono.models import Practice
+        from social_django.models import UserSocialAuth
+
+        if request.user.is_authenticated:
+            accounts = UserSocialAuth.objects.filter(user_id=request.user.pk, provider='drchrono')
+            practice = Practice.objects.filter(uid__in=accounts.values('uid')).first()
+            if practice is not None:
+                return practice
+        practices = list(Practice.objects.all()[:2])
+        if not practices:
+            # a deployment from before practices, see `manage.py setup_practices`
+            return None
+        return practices[0] if len(practices) == 1 else tenancy.NOBODY
+
+    def __call__(self, request):
+        with tenancy.using(self.practice(request)):
+            return self.get_response(request)
@@ -1,20 +1,128 @@
+import json
+import unicodedata
+import uuid
 from datetime import timezone
 
 from django.db import models
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from drchrono import tenancy
 
 
-class Visit(models.Model):
+class Practice(models.Model):
+    """
+    A practice using the app: one drchrono account, signed in through /setup/. Every tenant model row belongs to one.
+    """
+    # the drchrono account's Social Auth uid
+    uid = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name or self.uid
+
+    def __repr__(self):
+        return f"<Practice {self.uid}>"
+
+
+class TenantQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        if tenancy.denied():
+            raise tenancy.NoPractice("can't create {} rows for nobody".format(self.model.__name__))
+        practice_id = tenancy.current_id()
+        for obj in objs:
+            if obj.practice_id is None:
+                obj.practice_id = practice_id
+        return super(TenantQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+
+class TenantManager(models.Manager.from_queryset(TenantQuerySet)):
+    """
+    Only sees the current practice's rows; with no current practice, the rows that belong to none; and nothing while
+    NOBODY is current (see drchrono.tenancy). Filtering on the practice either way lets every query use the indexes,
+    which all lead with it.
+    """
+
+    def get_queryset(self):
+        queryset = super(TenantManager, self).get_queryset()
+        if tenancy.denied():
+            return queryset.none()
+        practice_id = tenancy.current_id()
+        if practice_id is None:
+            return queryset.filter(practice__isnull=True)
+        return queryset.filter(practice_id=practice_id)
+
+
+class TenantModel(models.Model):
+    """
+    A model whose rows belong to a practice. Rows saved (or bulk created) while a practice is current belong to it,
+    and the default manager only sees the current practice's rows (or, with none current, the unassigned rows).
+    Unique fields are unique per practice, and indexes lead with the practice.
+    """
+    # null for rows from before the deployment served several practices
+    practice = models.ForeignKey(Practice, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+
+    objects = TenantManager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if tenancy.denied():
+            raise tenancy.NoPractice("can't save {!r} for nobody".format(self))
+        if self.practice_id is None:
+            self.practice_id = tenancy.current_id()
+        super(TenantModel, self).save(*args, **kwargs)
+
+
+def unique_per_practice(*fields, name):
+    """
+    Constraints making `fields` unique within each practice, and among rows that belong to no practice
+    """
+    return [
+        models.UniqueConstraint(fields=['practice', *fields], name=name),
+        models.UniqueConstraint(fields=list(fields), condition=models.Q(practice__isnull=True),
+                                name=f'{name}_unassigned'),
+    ]
+
+
+class Visit(TenantModel):
     """
     Used to keep track of length of visit
     """
-    appointment_id = models.IntegerField(unique=True)
+
+    class Status(models.IntegerChoices):
+        # labels match the drchrono appointment statuses
+        ARRIVED = 1, 'Arrived'
+        IN_SESSION = 2, 'In Session'
+        FINISHED = 3, 'Finished'
+
+    appointment_id = models.IntegerField()
     patient_id = models.IntegerField()
-    status = models.CharField(max_length=50, blank=True, null=True)
+    doctor_id = models.IntegerField(blank=True, null=True)
+    status = models.PositiveSmallIntegerField(choices=Status.choices, blank=True, null=True)
     scheduled_time = models.DateTimeField(blank=True, null=True)
     arrival_time = models.DateTimeField(null=True)
     start_time = models.DateTimeField(null=True)
     end_time = models.DateTimeField(null=True)
+    # bumped on every save, so caches built from visits can tell when they're out of date
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+
+    class Meta:
+        constraints = unique_per_practice('appointment_id', name='visit_appointment')
+        indexes = [
+            # the dashboard's arrivals, current visit and finished visits all filter on status and whether
+            # arrival_time/start_time/end_time are set. Covers counting finished visits.
+            models.Index(fields=['practice', 'status', 'arrival_time', 'start_time', 'end_time'],
+                         name='visit_status_times'),
+            # people waiting to be seen: a small, hot subset of all visits
+            models.Index(fields=['practice', 'status', 'arrival_time'], name='visit_waiting',
+                         condition=models.Q(start_time__isnull=True)),
+            # the latest change, which cache keys are built from
+            models.Index(fields=['practice', 'updated_at'], name='visit_updated'),
+            # kiosk lookups by (appointment_id, patient_id) are served by the visit_appointment unique index
+        ]
 
     def get_wait_duration(self):
         if not self.arrival_time:
@@ -32,3 +140,204 @@ class Visit(models.Model):
 
     def __repr__(self):
         return f"<Visit {self.appointment_id}>"
+
+
+def normalize_name(*parts):
+    """
+    Joins name parts into a lookup key that ignores case, extra whitespace and accents:
+    normalize_name(' José ', 'DE  la Cruz') == normalize_name('jose', 'de la cruz') == 'jose de la cruz'
+    """
+    name = unicodedata.normalize('NFKD', ' '.join(part or '' for part in parts))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return ' '.join(name.casefold().split())
+
+
+class Patient(TenantModel):
+    """
+    Local copy of a drchrono patient, kept up to date by drchrono.patients.PatientDirectory
+    """
+    patient_id = models.IntegerField()
+    first_name = models.CharField(max_length=150, blank=True, default='')
+    last_name = models.CharField(max_length=150, blank=True, default='')
+    # first and last name, case, whitespace and accent folded. See normalize_name
+    name_key = models.CharField(max_length=301, blank=True, default='')
+    date_of_birth = models.CharField(max_length=10, blank=True, null=True)
+    # the full record, as returned by the API
+    data = models.TextField(default='{}')
+    # set when we know our copy is out of date, e.g. after updating the patient through the API
+    stale = models.BooleanField(default=False)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    SYNCED_FIELDS = ('first_name', 'last_name', 'name_key', 'date_of_birth', 'data', 'stale', 'synced_at')
+
+    class Meta:
+        constraints = unique_per_practice('patient_id', name='patient_id')
+        indexes = [
+            # kiosk check-in looks patients up by name, and date of birth when the name is ambiguous
+            models.Index(fields=['practice', 'name_key', 'date_of_birth'], name='patient_name_lookup'),
+        ]
+
+    def load(self, record):
+        """
+        Copies an API record onto this patient. Doesn't save.
+        """
+        self.first_name = record.get('first_name') or ''
+        self.last_name = record.get('last_name') or ''
+        self.name_key = normalize_name(self.first_name, self.last_name)
+        self.date_of_birth = record.get('date_of_birth') or None
+        self.data = json.dumps(record)
+        self.stale = False
+        self.synced_at = timezone.now()
+
+    def as_dict(self):
+        return json.loads(self.data)
+
+    def __repr__(self):
+        return f"<Patient {self.patient_id}>"
+
+
+class SyncState(TenantModel):
+    """
+    Keeps track of when a resource was last synced from the drchrono API, and where the next incremental sync
+    should pick up from
+    """
+    resource = models.CharField(max_length=50)
+    synced_at = models.DateTimeField(null=True)
+    # passed to the API as `since`
+    watermark = models.CharField(max_length=50, blank=True, null=True)
+
+    class Meta:
+        constraints = unique_per_practice('resource', name='sync_state_resource')
+
+    def __repr__(self):
+        return f"<SyncState {self.resource}>"
+
+
+class DailyVisitStatistics(TenantModel):
+    """
+    Running count, sum and sum of squares of wait and visit durations (in seconds), per doctor and day of arrival.
+
+    Kept up to date as visits start and finish (see drchrono.stats.record_visit_transition), so averages and standard
+    deviations can be read without scanning Visit rows. `manage.py rebuild_visit_statistics` recomputes them.
+    """
+    # 0 when the visit's doctor isn't known
+    doctor_id = models.IntegerField(default=0)
+    day = models.DateField()
+    wait_count = models.PositiveIntegerField(default=0)
+    wait_sum = models.FloatField(default=0)
+    wait_sum_squares = models.FloatField(default=0)
+    visit_count = models.PositiveIntegerField(default=0)
+    visit_sum = models.FloatField(default=0)
+    visit_sum_squares = models.FloatField(default=0)
+
+    class Meta:
+        constraints = unique_per_practice('doctor_id', 'day', name='daily_visit_statistics_day')
+
+    def __repr__(self):
+        return f"<DailyVisitStatistics {self.doctor_id} {self.day}>"
+
+
+class DashboardEvent(TenantModel):
+    """
+    A change open dashboards should hear about: an arrival, a visit starting or finishing, an appointment changing.
+
+    Written by drchrono.events.publish, and streamed to dashboards by id, so every worker process sees every event.
+    """
+    kind = models.CharField(max_length=30)
+    # JSON payload
+    data = models.TextField(default='{}')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # dashboards poll for their practice's events after the last one they saw
+            models.Index(fields=['practice', 'id'], name='dashboard_event_practice'),
+        ]
+
+    def __repr__(self):
+        return f"<DashboardEvent {self.id} {self.kind}>"
+
+
+class Appointment(TenantModel):
+    """
+    Local copy of a drchrono appointment, kept up to date by drchrono.appointments.AppointmentSchedule
+    """
+    appointment_id = models.IntegerField()
+    patient_id = models.IntegerField(blank=True, null=True)
+    doctor_id = models.IntegerField(blank=True, null=True)
+    scheduled_time = models.DateTimeField(blank=True, null=True)
+    status = models.CharField(max_length=50, blank=True, default='')
+    # the full record, as returned by the API
+    data = models.TextField(default='{}')
+    synced_at = models.DateTimeField(auto_now=True)
+
+    SYNCED_FIELDS = ('patient_id', 'doctor_id', 'scheduled_time', 'status', 'data', 'synced_at')
+
+    class Meta:
+        constraints = unique_per_practice('appointment_id', name='appointment_id')
+        indexes = [
+            models.Index(fields=['practice', 'scheduled_time'], name='appointment_schedule'),
+        ]
+
+    def load(self, record):
+        """
+        Copies an API record onto this appointment. Doesn't save.
+        """
+        scheduled_time = parse_datetime(record.get('scheduled_time') or '')
+        if scheduled_time and timezone.is_naive(scheduled_time):
+            scheduled_time = timezone.make_aware(scheduled_time)
+        self.patient_id = record.get('patient')
+        self.doctor_id = record.get('doctor')
+        self.scheduled_time = scheduled_time
+        self.status = record.get('status') or ''
+        self.data = json.dumps(record)
+        self.synced_at = timezone.now()
+
+    def as_dict(self):
+        return json.loads(self.data)
+
+    def __repr__(self):
+        return f"<Appointment {self.appointment_id}>"
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
+class OutboxMutation(TenantModel):
+    """
+    A change to send to the drchrono API, queued by the kiosk and applied in the background by `manage.py
+    process_outbox` (see drchrono.outbox). Changes for the same patient are applied in the order they were queued.
+    """
+
+    class Status(models.IntegerChoices):
+        PENDING = 1, 'Pending'
+        SENT = 2, 'Sent'
+        FAILED = 3, 'Failed'
+
+    # the endpoint, e.g. 'appointments' or 'patients', and the id of the object to update there
+    resource = models.CharField(max_length=50)
+    object_id = models.IntegerField()
+    patient_id = models.IntegerField()
+    # JSON: the fields to update
+    data = models.TextField(default='{}')
+    # sent as the Idempotency-Key header, so a retried request isn't applied twice
+    idempotency_key = models.CharField(max_length=32, unique=True, default=new_idempotency_key)
+    status = models.PositiveSmallIntegerField(choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # the worker looks for the oldest pending change of each patient
+            models.Index(fields=['practice', 'status', 'patient_id', 'id'], name='outbox_pending'),
+        ]
+
+    def as_dict(self):
+        return json.loads(self.data)
+
+    def __repr__(self):
+        return f"<OutboxMutation {self.id} {self.resource} {self.object_id}>"
@@ -0,0 +1,162 @@
+"""
+A durable queue of changes for the drchrono API, so the kiosk doesn't wait on the API to answer.
+
+Views write the change locally and queue it with enqueue(), in the same transaction, then respond. `manage.py
+process_outbox` sends queued changes in the background:
+ - changes for the same patient are sent one at a time, in the order they were queued; different patients' changes
+   are sent concurrently,
+ - a worker claims the changes it's about to send, so several workers can run without sending a change twice. A claim
+   runs out after OUTBOX_CLAIM_TIMEOUT seconds, so a change whose worker died is picked up again,
+ - every request carries the change's Idempotency-Key, so a request retried after a timeout isn't applied twice,
+ - a change that fails is retried with exponential backoff, up to OUTBOX_MAX_ATTEMPTS times; one the API refuses
+   outright (403, 404, 409) is marked failed straight away. Either way the patient's later changes then go ahead,
+   and a patient whose change failed is fetched from the API again on next use.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Min
+from django.utils import timezone
+from drchrono.endpoints import (AppointmentEndpoint, Conflict, Forbidden,
+                                NotFound, PatientEndpoint)
+from drchrono.instrumentation import in_current_context
+from drchrono.models import OutboxMutation
+from drchrono.patients import PatientDirectory
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = {
+    'appointments': AppointmentEndpoint,
+    'patients': PatientEndpoint,
+}
+
+# the API won't accept these however often we retry
+PERMANENT_ERRORS = (Forbidden, NotFound, Conflict)
+
+
+def mutation(resource, object_id, patient_id, data):
+    """
+    An unsaved change, for queueing several at once with OutboxMutation.objects.bulk_create()
+    """
+    return OutboxMutation(resource=resource, object_id=object_id, patient_id=patient_id,
+                          data=json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def enqueue(resource, object_id, patient_id, data):
+    """
+    Queues an update of `data` to the object at resource/object_id, on behalf of a patient. Returns the queued change.
+    """
+    queued = mutation(resource, object_id, patient_id, data)
+    queued.save()
+    return queued
+
+
+class Outbox(object):
+    """
+    Sends queued changes to the API. See the module docstring.
+    """
+
+    def __init__(self, access_token=None, max_workers=None, max_attempts=None):
+        self.access_token = access_token
+        self.max_workers = max_workers or AppointmentEndpoint.fetch_many_workers
+        self.max_attempts = settings.OUTBOX_MAX_ATTEMPTS if max_attempts is None else max_attempts
+
+    def due(self, limit=100):
+        """
+        The changes to send now, claimed for this worker: each patient's oldest pending change, if it isn't waiting
+        to be retried or claimed by another worker
+        """
+        now = timezone.now()
+        pending = OutboxMutation.objects.filter(status=OutboxMutation.Status.PENDING)
+        heads = pending.values('patient_id').annotate(head=Min('id')).values('head')
+        candidates = list(pending.filter(id__in=heads, next_attempt_at__lte=now).order_by('id')[:limit])
+        return [queued for queued in candidates if self._claim(queued, now)]
+
+    @staticmethod
+    def _claim(queued, now):
+        """
+        Pushes a pending change's next attempt past the claim timeout, unless another worker changed it since it was
+        read. The conditional update is atomic, so only one worker gets each change.
+        """
+        claimed_until = now + timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT)
+        claimed = OutboxMutation.objects.filter(pk=queued.pk, status=OutboxMutation.Status.PENDING,
+                                                next_attempt_at=queued.next_attempt_at)
+        if not claimed.update(next_attempt_at=claimed_until):
+            return False
+        queued.next_attempt_at = claimed_until
+        return True
+
+    def send(self, queued):
+        """
+        Sends one change to the API. Returns None, or the exception it failed with.
+        """
+        client = ENDPOINTS[queued.resource](self.access_token)
+        try:
+            client.update(queued.object_id, queued.as_dict(), headers={'Idempotency-Key': queued.idempotency_key})
+        except Exception as e:
+            return e
+
+    def retry_delay(self, attempts):
+        return min(settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
+
+    def _record(self, queued, error):
+        queued.attempts += 1
+        if error is None:
+            queued.status = OutboxMutation.Status.SENT
+            queued.sent_at = timezone.now()
+            queued.last_error = ''
+            if queued.resource == 'patients':
+                # the local copy has our change, but the API's record may have more; pick it up on next use
+                PatientDirectory(self.access_token).invalidate(queued.object_id)
+        else:
+            queued.last_error = repr(error)
+            if isinstance(error, PERMANENT_ERRORS) or queued.attempts >= self.max_attempts:
+                queued.status = OutboxMutation.Status.FAILED
+                logger.error("giving up on %r after %d attempts: %r", queued, queued.attempts, error)
+                if queued.resource == 'patients':
+                    # the local copy has a change the API never got; go back to the API's record on next use
+                    PatientDirectory(self.access_token).invalidate(queued.object_id)
+            else:
+                queued.next_attempt_at = timezone.now() + timedelta(seconds=self.retry_delay(queued.attempts))
+                logger.warning("%r failed (attempt %d), retrying: %r", queued, queued.attempts, error)
+        queued.save(update_fields=['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+
+    def _send_all(self, due):
+        # worker threads only talk to the API, on behalf of the current practice; the results are written from this
+        # thread
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due))) as executor:
+            errors = list(executor.map(in_current_context(self.send), due))
+        for queued, error in zip(due, errors):
+            self._record(queued, error)
+        return sum(error is None for error in errors)
+
+    def process(self, limit=100):
+        """
+        Sends the changes that are due, concurrently (at most one per patient). Returns how many were sent.
+        """
+        due = self.due(limit)
+        return self._send_all(due) if due else 0
+
+    def drain(self, limit=100):
+        """
+        Sends changes until none are due, e.g. until each patient's changes have all been sent. Returns how many
+        were sent.
+        """
+        sent = 0
+        due = self.due(limit)
+        while due:
+            sent += self._send_all(due)
+            due = self.due(limit)
+        return sent
+
+    @staticmethod
+    def prune():
+        """
+        Forgets changes sent more than OUTBOX_RETENTION seconds ago. Failed changes are kept for inspection.
+        """
+        cutoff = timezone.now() - timedelta(seconds=settings.OUTBOX_RETENTION)
+        OutboxMutation.objects.filter(status=OutboxMutation.Status.SENT, sent_at__lt=cutoff).delete()
@@ -0,0 +1,205 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from drchrono.endpoints import NotFound, PatientEndpoint
+from drchrono.joins import index_by
+from drchrono.models import Patient, SyncState, normalize_name
+
+# patient fields shown next to appointments and arrivals, and for the patient currently being seen
+PATIENT_NAME_FIELDS = ('first_name', 'last_name')
+PATIENT_DETAIL_FIELDS = PATIENT_NAME_FIELDS + ('date_of_birth', 'date_of_last_appointment', 'race', 'gender',
+                                               'ethnicity')
+
+
+class AmbiguousPatient(Exception):
+    """
+    More than one patient matched a lookup. The matching records are in `matches`.
+    """
+
+    def __init__(self, matches):
+        super(AmbiguousPatient, self).__init__(f"{len(matches)} patients match")
+        self.matches = matches
+
+
+class PatientDirectory(object):
+    """
+    A local copy of the drchrono patient list, so page loads and kiosk check-ins are a database lookup instead of a
+    full API crawl.
+
+    The first lookup loads every patient, once (`manage.py sync_patients` can do it ahead of time, and keeps the copy
+    fresh in the background). After that, whenever the copy is older than `ttl` seconds, the next lookup requests only
+    the patients changed since the last sync (the API's `since` filter). Patients we change ourselves should be
+    invalidated, so they are re-fetched on their next lookup.
+    """
+    resource = 'patients'
+    # overlap between syncs, so a patient updated while we were syncing isn't missed
+    WATERMARK_OVERLAP = timedelta(minutes=1)
+
+    def __init__(self, access_token=None, ttl=None):
+        self.client = PatientEndpoint(access_token)
+        self.ttl = settings.PATIENT_CACHE_TTL if ttl is None else ttl
+
+    def _state(self):
+        state, _ = SyncState.objects.get_or_create(resource=self.resource)
+        return state
+
+    def is_stale(self, state=None):
+        state = state or self._state()
+        if state.synced_at is None:
+            return True
+        return timezone.now() - state.synced_at > timedelta(seconds=self.ttl)
+
+    def _store(self, records):
+        """
+        Inserts or updates the given API records
+        """
+        records = {record['id']: record for record in records}
+        existing = index_by(Patient.objects.filter(patient_id__in=list(records)), 'patient_id')
+        to_create, to_update = [], []
+        for patient_id, record in records.items():
+            patient = existing.get(patient_id) or Patient(patient_id=patient_id)
+            patient.load(record)
+            (to_update if patient.pk else to_create).append(patient)
+        Patient.objects.bulk_create(to_create, batch_size=500)
+        Patient.objects.bulk_update(to_update, Patient.SYNCED_FIELDS, batch_size=500)
+
+    def sync(self, full=False):
+        """
+        Brings the local copy up to date. A full sync also drops patients that no longer exist upstream.
+
+        Each page is written in a transaction of its own once it has arrived, so the database isn't locked while we
+        wait on the API. A sync that fails part way leaves the watermark where it was, and the next one starts over.
+        """
+        state = self._state()
+        started = timezone.now()
+        full = full or not state.watermark
+        params = {} if full else {'since': state.watermark}
+
+        seen = set()
+        for page in self.client.pages(params):
+            with transaction.atomic():
+                self._store(page)
+            seen.update(record['id'] for record in page)
+        with transaction.atomic():
+            if full:
+                Patient.objects.exclude(patient_id__in=seen).delete()
+            state.synced_at = started
+            state.watermark = (started - self.WATERMARK_OVERLAP).strftime('%Y-%m-%dT%H:%M:%S')
+            state.save()
+        return len(seen)
+
+    def _claim(self, state):
+        """
+        Marks a stale copy as being brought up to date, unless another request or worker already did. Returns True
+        if this one should sync.
+        """
+        return bool(SyncState.objects.filter(pk=state.pk, synced_at=state.synced_at).update(synced_at=timezone.now()))
+
+    def refresh(self, force=False):
+        """
+        Syncs the changes since the last sync if the local copy is older than the TTL (or when forced), unless
+        someone else is already at it. Returns True if it synced.
+
+        A directory that was never loaded is loaded in full, by whichever request or worker claims it first. If that
+        fails, the claim is released, so the next lookup tries again.
+        """
+        state = self._state()
+        if force:
+            self.sync()
+            return True
+        if not (self.is_stale(state) and self._claim(state)):
+            return False
+        if state.watermark:
+            self.sync()
+            return True
+        try:
+            self.sync(full=True)
+        except Exception:
+            SyncState.objects.filter(pk=state.pk).update(synced_at=None)
+            raise
+        return True
+
+    def all(self):
+        """
+        Returns every patient, as API records (dicts)
+        """
+        self.refresh()
+        return [patient.as_dict() for patient in Patient.objects.all()]
+
+    def get(self, patient_id):
+        """
+        Returns a single patient as an API record, re-fetching it if it was invalidated. None if it doesn't exist.
+        """
+        self.refresh()
+        patient = Patient.objects.filter(patient_id=patient_id).first()
+        if patient and not patient.stale:
+            return patient.as_dict()
+        try:
+            record = self.client.fetch(patient_id)
+        except NotFound:
+            Patient.objects.filter(patient_id=patient_id).delete()
+            return None
+        self._store([record])
+        return record
+
+    def get_many(self, patient_ids):
+        """
+        Returns {patient_id: record} for the patients we have an up-to-date local copy of. Together with set_many(),
+        this lets the directory serve as the cache for PatientEndpoint.fetch_many().
+        """
+        patients = Patient.objects.filter(patient_id__in=list(patient_ids), stale=False)
+        return {patient.patient_id: patient.as_dict() for patient in patients}
+
+    def set_many(self, records):
+        self._store(records.values())
+
+    def fetch_many(self, patient_ids):
+        """
+        Returns {patient_id: record} for just the given patients: from the local copy where it's up to date, the
+        rest fetched from the API concurrently (and stored). Patients that don't exist are left out.
+
+        The local copy is brought up to date first (see refresh()).
+        """
+        self.refresh()
+        return self.client.fetch_many(patient_ids, cache=self)
+
+    def lookup(self, first_name, last_name, date_of_birth=None):
+        """
+        Finds a patient by name, and date of birth (YYYY-MM-DD) if given, through an indexed lookup.
+
+        Returns the API record, or None if nobody matches. Raises AmbiguousPatient if several patients match.
+        """
+        self.refresh()
+        patients = Patient.objects.filter(name_key=normalize_name(first_name, last_name))
+        if date_of_birth:
+            patients = patients.filter(date_of_birth=date_of_birth)
+        # two rows are enough to tell whether the match is ambiguous
+        matches = [patient.as_dict() for patient in patients[:2]]
+        if len(matches) > 1:
+            raise AmbiguousPatient([patient.as_dict() for patient in patients])
+        return matches[0] if matches else None
+
+    def apply(self, patient_id, changes):
+        """
+        Applies changes made here, and queued for the API, to the local copy of a patient, so they're visible before
+        the API has them. Does nothing if there is no local copy yet.
+        """
+        with transaction.atomic():
+            # lock the row with a write before reading it, as VisitTimerView.toggle_timer does for SQLite
+            if not Patient.objects.filter(patient_id=patient_id).update(stale=F('stale')):
+                return
+            patient = Patient.objects.get(patient_id=patient_id)
+            patient.load(dict(patient.as_dict(), **changes))
+            patient.save()
+
+    def invalidate(self, patient_id=None):
+        """
+        Marks a patient as out of date. Without a patient_id, the whole directory is reloaded on next use.
+        """
+        if patient_id is None:
+            SyncState.objects.filter(resource=self.resource).update(synced_at=None, watermark=None)
+        else:
+            Patient.objects.filter(patient_id=patient_id).update(stale=True)
@@ -0,0 +1,155 @@
+"""
+Client-side rate limiting for the drchrono API.
+
+Every request takes a token from a bucket that refills at `rate` tokens a second and holds at most `burst`, so the
+kiosk, the dashboard and the background workers together stay under the API quota instead of bursting into it. When
+the API throttles us anyway (429), the whole bucket is paused for as long as its Retry-After header asks. Each practice
+has a bucket of its own, since each has its own drchrono account and quota.
+"""
+import fcntl
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from drchrono import tenancy
+
+
+def retry_after(response, default=1.0, maximum=60.0):
+    """
+    How many seconds a 429/503 response asks us to wait, from its Retry-After header (seconds or an HTTP date)
+    """
+    value = response.headers.get('Retry-After')
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            seconds = default
+    return min(max(seconds, 0.0), maximum)
+
+
+class TokenBucket(object):
+    """
+    A token bucket shared by the threads of one process
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._bucket = self._full()
+
+    def _full(self):
+        return {'tokens': float(self.burst), 'updated': time.time(), 'paused_until': 0.0}
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            yield self._bucket
+
+    def _take(self):
+        """
+        Takes a token if one is available and returns None. Otherwise returns how long to wait before trying again.
+        """
+        with self._state() as state:
+            now = time.time()
+            if now < state['paused_until']:
+                return state['paused_until'] - now
+            elapsed = max(0.0, now - state['updated'])
+            state['tokens'] = min(float(self.burst), state['tokens'] + elapsed * self.rate)
+            state['updated'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return None
+            return (1 - state['tokens']) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent
+        """
+        wait = self._take()
+        while wait is not None:
+            time.sleep(wait)
+            wait = self._take()
+
+    def pause(self, seconds):
+        """
+        Holds back every request for `seconds`, e.g. after the API answered 429
+        """
+        with self._state() as state:
+            state['paused_until'] = max(state['paused_until'], time.time() + seconds)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket shared by every process on the host, kept in a small file under an exclusive lock
+    """
+
+    def __init__(self, rate, burst, path):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+
+    @contextmanager
+    def _state(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    tokens, updated, paused_until = (float(value) for value in f.read().split())
+                    state = {'tokens': tokens, 'updated': updated, 'paused_until': paused_until}
+                except ValueError:  # a new (or unreadable) file starts out full
+                    state = self._full()
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write("{tokens!r} {updated!r} {paused_until!r}".format(**state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_rate_limiters = {}
+_rate_limiter_lock = threading.Lock()
+
+
+def _configured_options():
+    """
+    Rate limit options from the DRCHRONO_API_RATE_LIMIT setting, if we're running under Django. None disables it.
+    """
+    try:
+        from django.conf import settings
+        return getattr(settings, 'DRCHRONO_API_RATE_LIMIT', None)
+    except Exception:  # django isn't installed, or settings aren't configured
+        return None
+
+
+def get_rate_limiter():
+    """
+    Returns the current practice's token bucket, shared by the process (or by every process on the host, if the
+    setting has a `path`), creating it on first use. None if rate limiting is switched off.
+    """
+    practice_id = tenancy.current_id()
+    if practice_id not in _rate_limiters:
+        with _rate_limiter_lock:
+            if practice_id not in _rate_limiters:
+                options = _configured_options()
+                if not options:
+                    return None
+                if options.get('path'):
+                    path = options['path'] if practice_id is None else "{}.{}".format(options['path'], practice_id)
+                    _rate_limiters[practice_id] = SharedTokenBucket(options['rate'], options['burst'], path)
+                else:
+                    _rate_limiters[practice_id] = TokenBucket(options['rate'], options['burst'])
+    return _rate_limiters[practice_id]
+
+
+def reset_rate_limiter():
+    """
+    Forgets the token buckets. The next call to get_rate_limiter() builds one from the current settings.
+    """
+    with _rate_limiter_lock:
+        _rate_limiters.clear()
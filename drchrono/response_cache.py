@@ -0,0 +1,239 @@
+"""
+An HTTP response cache for the drchrono API endpoints that hardly ever change (doctors, appointment profiles).
+
+Endpoints opt in by setting `cache_ttl`. A cached GET younger than that is answered without a request. An older one is
+revalidated with If-None-Match/If-Modified-Since, so an unchanged resource costs a 304 instead of the whole body.
+
+Entries are plain dicts, kept by a pluggable backend: in process (LocalBackend, an LRU of `cache_max_entries` per
+endpoint) or in a Django cache (DjangoCacheBackend, shared by every process using that cache; its size is limited by
+the cache's own settings). Pick one with the DRCHRONO_API_RESPONSE_CACHE setting. Each practice has its own caches,
+since each sees its own drchrono account.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import requests
+from drchrono import tenancy
+
+
+class CacheStats(object):
+    """
+    Thread-safe hit/miss counters for one endpoint's cache
+     - hits: answered from the cache without a request
+     - revalidated: the API answered 304 Not Modified, and the cached body was used
+     - misses: the response had to be downloaded
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+
+    def count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses}
+
+
+class LocalBackend(object):
+    """
+    An in-process LRU of at most `max_entries` responses
+    """
+
+    def __init__(self, namespace, max_entries=128, **kwargs):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend(object):
+    """
+    Responses kept in a Django cache (by alias), for `keep` seconds past when they were stored so they can still be
+    revalidated. clear() moves the endpoint to a new key generation rather than deleting keys one by one.
+    """
+
+    def __init__(self, namespace, alias='default', keep=86400, **kwargs):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.namespace = namespace
+        self.keep = keep
+
+    def _generation_key(self):
+        return "drchrono-api:{}:generation".format(self.namespace)
+
+    def _key(self, key):
+        generation = self.cache.get_or_set(self._generation_key(), 1, None)
+        # URLs can be longer than, or contain characters not allowed in, memcached keys
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return "drchrono-api:{}:{}:{}".format(self.namespace, generation, digest)
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, entry):
+        self.cache.set(self._key(key), entry, self.keep)
+
+    def clear(self):
+        try:
+            self.cache.incr(self._generation_key())
+        except ValueError:  # no generation yet, so nothing to clear
+            pass
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'django': DjangoCacheBackend,
+}
+
+
+class ResponseCache(object):
+    """
+    The response cache of one endpoint: its backend, its TTL and its stats
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    @staticmethod
+    def key(url, params=None):
+        if params:
+            url = "{}?{}".format(url, urlencode(sorted(params.items()), doseq=True))
+        return url
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def conditional_headers(self, entry):
+        """
+        Headers asking the API to answer 304 if the cached entry is still current
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key, response):
+        """
+        Caches a successful response, if it has a body
+        """
+        if response.status_code != 200:
+            return
+        self.backend.set(key, {
+            'url': response.url,
+            'content': response.content,
+            'content_type': response.headers.get('Content-Type'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'stored_at': time.time(),
+        })
+
+    def renew(self, key, entry):
+        """
+        The API confirmed the entry is still current (304), so it's fresh for another TTL
+        """
+        entry = dict(entry, stored_at=time.time())
+        self.backend.set(key, entry)
+        return entry
+
+    @staticmethod
+    def as_response(entry):
+        """
+        Rebuilds a requests.Response from a cached entry, for code that expects one
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response._content = entry['content']
+        if entry.get('content_type'):
+            response.headers['Content-Type'] = entry['content_type']
+        return response
+
+    def clear(self):
+        self.backend.clear()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _configured_options():
+    """
+    Options from the DRCHRONO_API_RESPONSE_CACHE setting, if we're running under Django
+    """
+    try:
+        from django.conf import settings
+        return dict(getattr(settings, 'DRCHRONO_API_RESPONSE_CACHE', {}))
+    except Exception:  # django isn't installed, or settings aren't configured
+        return {}
+
+
+def get_response_cache(endpoint):
+    """
+    Returns the current practice's response cache for an endpoint class (or instance), creating it on first use. None
+    if the endpoint doesn't cache, i.e. has no `cache_ttl`.
+    """
+    if not endpoint.cache_ttl:
+        return None
+    practice_id = tenancy.current_id()
+    namespace = endpoint.endpoint if practice_id is None else "{}:{}".format(practice_id, endpoint.endpoint)
+    if namespace not in _caches:
+        with _caches_lock:
+            if namespace not in _caches:
+                options = _configured_options()
+                backend_class = BACKENDS[options.pop('backend', 'local')]
+                options.setdefault('max_entries', endpoint.cache_max_entries)
+                _caches[namespace] = ResponseCache(backend_class(namespace, **options), endpoint.cache_ttl)
+    return _caches[namespace]
+
+
+def response_cache_stats():
+    """
+    Hit/miss counts for every endpoint cache used so far, by endpoint (prefixed with the practice id, if any)
+    """
+    return {namespace: cache.stats.as_dict() for namespace, cache in _caches.items()}
+
+
+def reset_response_caches():
+    """
+    Empties and forgets every endpoint cache. The next use builds them again from the current settings.
+    """
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
+        _caches.clear()
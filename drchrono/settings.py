@@ -40,14 +40,18 @@ INSTALLED_APPS = (
     'drchrono',
     'social_django',
     'crispy_forms',
-    'django_altair',
 )
 
 MIDDLEWARE = (
+    # first, so the timings it reports cover the rest of the middleware too
+    'drchrono.middleware.RequestMetricsMiddleware',
+    'drchrono.middleware.CredentialsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # after authentication, since the practice is that of the signed in user's drchrono account
+    'drchrono.middleware.TenantMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -127,6 +131,85 @@ LOGIN_URL = 'login/drchrono'
 SHELL_PLUS = "ipython"
 
 
+# Connection pooling for the drchrono API client, see drchrono.transport.Transport for what each option does.
+DRCHRONO_API_TRANSPORT = {
+    'pool_connections': 10,
+    'pool_maxsize': 20,
+    'pool_block': False,
+    'timeout': (3.05, 30),
+    'retries': 3,
+    'backoff_factor': 0.5,
+}
+
+# Client-side limit on drchrono API requests: `rate` requests a second on average, in bursts of up to `burst`. With a
+# `path`, the limit is shared by every process on the host through that file (one per practice, with the practice id
+# appended); without one, it's per process. Set to None to switch it off.
+DRCHRONO_API_RATE_LIMIT = {
+    'rate': 5,
+    'burst': 20,
+    # absolute, so the web server and the workers share it whatever directory they're started from
+    'path': os.path.join(BASE_DIR, 'drchrono-api-ratelimit.state'),
+}
+
+# Where endpoints with a `cache_ttl` (doctors, appointment profiles) cache their responses, see drchrono.response_cache:
+# 'local' for an LRU per process, or 'django' for the Django cache named by 'alias', shared between processes.
+DRCHRONO_API_RESPONSE_CACHE = {
+    'backend': 'local',
+}
+
+# The OAuth access token is kept in memory by drchrono.tokens.TokenManager. It's refreshed in the background once it's
+# within DRCHRONO_TOKEN_REFRESH_AHEAD seconds of expiring, and re-read from the database every
+# DRCHRONO_TOKEN_CACHE_TIMEOUT seconds to pick up refreshes done by other processes.
+DRCHRONO_TOKEN_REFRESH_AHEAD = 300
+DRCHRONO_TOKEN_CACHE_TIMEOUT = 60
+
+# How long, in seconds, the local patient directory is trusted before it's incrementally re-synced with the API.
+PATIENT_CACHE_TTL = 300
+
+# Seconds between polls of `manage.py sync_appointments`, and how old, in seconds, the local copy of today's
+# appointments may get before a request syncs it inline (e.g. when the worker isn't running).
+APPOINTMENT_SYNC_INTERVAL = 30
+APPOINTMENT_CACHE_TTL = 120
+
+# The dashboard chart shows at most this many points; longer visit histories are binned by day.
+DASHBOARD_CHART_MAX_POINTS = 500
+# Seconds to keep a built chart around. It's rebuilt early whenever a visit changes.
+DASHBOARD_CHART_CACHE_TIMEOUT = 60 * 60 * 24
+# 'vega-lite' writes the chart spec out directly; 'altair' builds it with altair and pandas, imported on first use.
+DASHBOARD_CHART_BACKEND = 'vega-lite'
+
+# Live dashboard updates: how often an open dashboard's event request checks for new events, how long it waits for
+# some before returning empty and letting the browser reconnect (keep it under the web server's worker timeout), and
+# how long events are kept (all in seconds).
+DASHBOARD_EVENTS_POLL_INTERVAL = 2
+DASHBOARD_EVENTS_STREAM_DURATION = 25
+DASHBOARD_EVENTS_RETENTION = 60 * 60 * 24
+
+# Seconds to keep each dashboard section's JSON (/welcome/sections/<section>/). It's rebuilt early whenever the
+# section's data changes.
+DASHBOARD_SECTION_CACHE_TIMEOUT = 60 * 10
+# The dashboard's median and 90th percentile wait and visit durations are over visits from the last this many days.
+DASHBOARD_PERCENTILE_DAYS = 30
+
+
+# Changes the kiosk queues for the drchrono API (drchrono.outbox), sent by `manage.py process_outbox`: how often the
+# worker polls, how often a failing change is tried before it's marked failed, the backoff between tries (doubling
+# from OUTBOX_RETRY_DELAY up to OUTBOX_MAX_RETRY_DELAY), how long a worker's claim on a change lasts before another
+# worker may send it (longer than a send can take, retries and rate limiting included) and how long sent changes are
+# kept (all in seconds).
+OUTBOX_POLL_INTERVAL = 1
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_DELAY = 2
+OUTBOX_MAX_RETRY_DELAY = 5 * 60
+OUTBOX_CLAIM_TIMEOUT = 5 * 60
+OUTBOX_RETENTION = 60 * 60 * 24 * 7
+
+# Per-request API call, query and section timings (drchrono.middleware.RequestMetricsMiddleware). They're always logged
+# on the drchrono.middleware logger, listing at most REQUEST_METRICS_LOGGED_CALLS individual API calls per request;
+# REQUEST_METRICS_SERVER_TIMING also sends them to the browser in the Server-Timing header.
+REQUEST_METRICS_SERVER_TIMING = True
+REQUEST_METRICS_LOGGED_CALLS = 50
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -138,6 +221,11 @@ LOGGING = {
         },
     },
     'loggers': {
+        'drchrono.middleware': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': True,
+        },
         'drchrono.endpoints.*': {
             'handlers': ['file'],
             'level': 'DEBUG',
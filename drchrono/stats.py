@@ -0,0 +1,224 @@
+"""
+Wait and visit duration statistics, either computed by the database or read from the running totals in
+DailyVisitStatistics, so their cost doesn't grow with visit history.
+
+All durations are returned in seconds.
+"""
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Sum
+from django.utils import timezone
+from drchrono.models import DailyVisitStatistics, Visit
+
+WAIT_DURATION = ExpressionWrapper(F('start_time') - F('arrival_time'), output_field=DurationField())
+VISIT_DURATION = ExpressionWrapper(F('end_time') - F('start_time'), output_field=DurationField())
+
+
+def finished_visits():
+    return Visit.objects.filter(status=Visit.Status.FINISHED, arrival_time__isnull=False, start_time__isnull=False,
+                                end_time__isnull=False)
+
+
+def _seconds(duration):
+    return None if duration is None else duration.total_seconds()
+
+
+def percentile(queryset, duration, fraction, count=None):
+    """
+    Nearest-rank percentile of a duration expression. The database sorts and hands back a single row.
+    """
+    count = queryset.count() if count is None else count
+    if not count:
+        return None
+    rank = min(max(int(math.ceil(fraction * count)) - 1, 0), count - 1)
+    values = queryset.annotate(duration=duration).order_by('duration').values_list('duration', flat=True)
+    return _seconds(values[rank])
+
+
+def visit_statistics(queryset=None):
+    """
+    Count, average, median and 90th percentile of wait and visit durations
+    """
+    queryset = finished_visits() if queryset is None else queryset
+    totals = queryset.aggregate(count=Count('id'), avg_wait=Avg(WAIT_DURATION), avg_visit=Avg(VISIT_DURATION))
+    count = totals['count']
+    return {
+        'count': count,
+        'wait': {
+            'avg': _seconds(totals['avg_wait']),
+            'median': percentile(queryset, WAIT_DURATION, 0.5, count),
+            'p90': percentile(queryset, WAIT_DURATION, 0.9, count),
+        },
+        'visit': {
+            'avg': _seconds(totals['avg_visit']),
+            'median': percentile(queryset, VISIT_DURATION, 0.5, count),
+            'p90': percentile(queryset, VISIT_DURATION, 0.9, count),
+        },
+    }
+
+
+def recent_statistics(days):
+    """
+    visit_statistics() of the visits that arrived in the last `days` days, so the percentiles sort a bounded number
+    of rows however long the visit history gets
+    """
+    return visit_statistics(finished_visits().filter(arrival_time__gte=timezone.now() - timedelta(days=days)))
+
+
+def daily_statistics(days=None):
+    """
+    Per-day count and average wait and visit durations of finished visits, oldest day first, read from the
+    DailyVisitStatistics totals. Days are by arrival, and only those of the last `days` days if given.
+    """
+    rows = DailyVisitStatistics.objects.filter(visit_count__gt=0)
+    if days is not None:
+        rows = rows.filter(day__gt=timezone.localdate() - timedelta(days=days))
+    rows = rows.values('day').annotate(wait_count=Sum('wait_count'), wait_sum=Sum('wait_sum'),
+                                       visit_count=Sum('visit_count'), visit_sum=Sum('visit_sum')).order_by('day')
+    return [{
+        'day': row['day'].isoformat(),
+        'count': row['visit_count'],
+        'avg_wait': row['wait_sum'] / row['wait_count'] if row['wait_count'] else None,
+        'avg_visit': row['visit_sum'] / row['visit_count'],
+    } for row in rows]
+
+
+def _moments(count, total, squares):
+    if not count:
+        return {'count': 0, 'avg': None, 'stddev': None}
+    avg = total / count
+    return {'count': count, 'avg': avg, 'stddev': math.sqrt(max(squares / count - avg * avg, 0))}
+
+
+def _transition(visit):
+    """
+    Which running totals a visit belongs in right now, and with what duration: ('wait', seconds) once it started,
+    ('visit', seconds) once it finished. None if it doesn't count (yet).
+    """
+    if not (visit.arrival_time and visit.start_time):
+        return None
+    if visit.status == Visit.Status.FINISHED and visit.end_time:
+        return 'visit', (visit.end_time - visit.start_time).total_seconds()
+    if visit.status == Visit.Status.IN_SESSION:
+        return 'wait', (visit.start_time - visit.arrival_time).total_seconds()
+    return None
+
+
+def record_visit_transition(visit):
+    """
+    Adds a visit that just started (its wait) or just finished (its visit duration) to the DailyVisitStatistics
+    of its doctor and day of arrival. Safe to call concurrently: the totals are incremented by the database.
+    """
+    transition = _transition(visit)
+    if transition is None:
+        return
+    prefix, seconds = transition
+    with transaction.atomic():
+        row, _ = DailyVisitStatistics.objects.get_or_create(doctor_id=visit.doctor_id or 0,
+                                                            day=timezone.localdate(visit.arrival_time))
+        DailyVisitStatistics.objects.filter(pk=row.pk).update(**{
+            f'{prefix}_count': F(f'{prefix}_count') + 1,
+            f'{prefix}_sum': F(f'{prefix}_sum') + seconds,
+            f'{prefix}_sum_squares': F(f'{prefix}_sum_squares') + seconds * seconds,
+        })
+
+
+def rolling_statistics(doctor_id=None):
+    """
+    Count, average and standard deviation of wait and visit durations, read from the DailyVisitStatistics totals
+    """
+    rows = DailyVisitStatistics.objects.all()
+    if doctor_id is not None:
+        rows = rows.filter(doctor_id=doctor_id)
+    totals = rows.aggregate(*[Sum(f'{prefix}_{total}') for prefix in ('wait', 'visit')
+                              for total in ('count', 'sum', 'sum_squares')])
+    return {prefix: _moments(totals[f'{prefix}_count__sum'], totals[f'{prefix}_sum__sum'],
+                             totals[f'{prefix}_sum_squares__sum'])
+            for prefix in ('wait', 'visit')}
+
+
+def rebuild_daily_statistics():
+    """
+    Recomputes every DailyVisitStatistics row from Visit history. Visits are streamed, so memory use stays flat.
+    Returns the number of rows written.
+    """
+    totals = defaultdict(lambda: defaultdict(float))
+    visits = Visit.objects.filter(arrival_time__isnull=False, start_time__isnull=False).only(
+        'doctor_id', 'status', 'arrival_time', 'start_time', 'end_time')
+    for visit in visits.iterator(chunk_size=2000):
+        row = totals[(visit.doctor_id or 0, timezone.localdate(visit.arrival_time))]
+        wait = (visit.start_time - visit.arrival_time).total_seconds()
+        row['wait_count'] += 1
+        row['wait_sum'] += wait
+        row['wait_sum_squares'] += wait * wait
+        if visit.status == Visit.Status.FINISHED and visit.end_time:
+            duration = (visit.end_time - visit.start_time).total_seconds()
+            row['visit_count'] += 1
+            row['visit_sum'] += duration
+            row['visit_sum_squares'] += duration * duration
+
+    rows = [DailyVisitStatistics(doctor_id=doctor_id, day=day, wait_count=int(row['wait_count']),
+                                 visit_count=int(row['visit_count']),
+                                 **{key: value for key, value in row.items() if not key.endswith('_count')})
+            for (doctor_id, day), row in totals.items()]
+    with transaction.atomic():
+        DailyVisitStatistics.objects.all().delete()
+        DailyVisitStatistics.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def _merge(points, size):
+    """
+    Merges `points` (consecutive days, oldest first) into at most `size` points, weighting averages by visit count
+    """
+    per_bin = math.ceil(len(points) / size)
+    merged = []
+    for start in range(0, len(points), per_bin):
+        group = points[start:start + per_bin]
+        count = sum(point['count'] for point in group) or 1
+        merged.append({
+            'start_time': group[0]['start_time'],
+            'count': sum(point['count'] for point in group),
+            'wait_duration': sum(point['wait_duration'] * point['count'] for point in group) / count,
+            'visit_duration': sum(point['visit_duration'] * point['count'] for point in group) / count,
+        })
+    return merged
+
+
+def chart_points(max_points):
+    """
+    Data points for the dashboard's wait/visit duration chart, never more than `max_points` of them.
+
+    Up to max_points finished visits are returned as they are. Beyond that, visits are binned: per-day averages from
+    DailyVisitStatistics, merged further into wider bins if there are more days than max_points.
+    """
+    visits = finished_visits().annotate(wait=WAIT_DURATION, visit=VISIT_DURATION).values_list(
+        'start_time', 'wait', 'visit')[:max_points + 1]
+    visits = list(visits)
+    if len(visits) <= max_points:
+        return [{
+            'start_time': start_time.isoformat(),
+            'count': 1,
+            'wait_duration': wait.total_seconds(),
+            'visit_duration': visit.total_seconds(),
+        } for start_time, wait, visit in visits]
+
+    points = [{
+        'start_time': day['day'],
+        'count': day['count'],
+        'wait_duration': day['avg_wait'] or 0,
+        'visit_duration': day['avg_visit'],
+    } for day in daily_statistics()]
+    if len(points) > max_points:
+        points = _merge(points, max_points)
+    return points
+
+
+def latest_visit_change():
+    """
+    When a Visit was last saved. Cheap, thanks to the index on updated_at.
+    """
+    return Visit.objects.aggregate(latest=Max('updated_at'))['latest']
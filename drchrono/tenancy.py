@@ -0,0 +1,98 @@
+"""
+The practice (tenant) being served.
+
+One deployment serves many practices, each with its own drchrono account. drchrono.middleware.TenantMiddleware picks
+the practice of each request, and background workers go through the practices one by one with `using(practice)`.
+While a practice is current
+ - every query through a tenant model's default manager only sees that practice's rows, and new rows belong to it
+   (see drchrono.models.TenantModel),
+ - API clients use the practice's access token, rate limit and response caches,
+ - the dashboard caches (chart, sections) are kept per practice.
+
+With no current practice (a single practice deployment that predates tenancy), only the rows that belong to no
+practice are seen; `manage.py setup_practices` hands those to the practice once there is one. A request
+that isn't for any of several practices is served with NOBODY current instead, which sees no rows and has no drchrono
+account to use.
+"""
+import contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('drchrono_practice', default=None)
+
+
+class NoPractice(Exception):
+    """
+    Raised on trying to use a practice's data or account while NOBODY is current
+    """
+
+
+class _Nobody(object):
+    pk = None
+    uid = None
+
+    def __repr__(self):
+        return "<Practice: nobody>"
+
+
+NOBODY = _Nobody()
+
+
+def current():
+    """
+    The current Practice, or None. NOBODY counts as none; see denied().
+    """
+    practice = _current.get()
+    return None if practice is NOBODY else practice
+
+
+def current_id():
+    practice = _current.get()
+    return practice.pk if practice is not None else None
+
+
+def denied():
+    """
+    Whether NOBODY is current, so no practice's data may be used
+    """
+    return _current.get() is NOBODY
+
+
+def each(practices):
+    """
+    Yields each of `practices`, making it the current one until the next. Yields None once if there are none, for a
+    deployment that predates tenancy.
+    """
+    for practice in list(practices) or [None]:
+        with using(practice):
+            yield practice
+
+
+@contextmanager
+def using(practice):
+    """
+    Makes `practice` the current one for the duration of the block
+    """
+    token = _current.set(practice)
+    try:
+        yield practice
+    finally:
+        _current.reset(token)
+
+
+def bind(iterable, practice=None):
+    """
+    Iterates over `iterable` with `practice` (by default the current one) current, whenever the iteration happens. For
+    streaming responses, whose content is produced after the middleware has returned.
+    """
+    # not a generator itself, so the current practice is looked up now rather than on the first next()
+    return _iterate(iter(iterable), practice or _current.get())
+
+
+def _iterate(iterator, practice):
+    while True:
+        with using(practice):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,64 @@
+"""
+Shared set up for tests that talk to drchrono.fake_api instead of the real API
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from drchrono import tenancy
+from drchrono.endpoints import BaseEndpoint
+from drchrono.fake_api import FakeDrchronoAPI
+from drchrono.models import Practice
+from drchrono.ratelimit import reset_rate_limiter
+from drchrono.response_cache import reset_response_caches
+from drchrono.tokens import get_token_manager
+from social_django.models import UserSocialAuth
+
+
+def sign_in(uid, access_token=None, expires_in=36000):
+    """
+    A user signed in with drchrono account `uid`, as after /setup/. Returns the user and the account's Practice.
+    """
+    user = User.objects.create(username=uid)
+    UserSocialAuth.objects.create(user=user, provider='drchrono', uid=uid, extra_data={
+        'access_token': access_token or 'token-' + uid, 'refresh_token': 'refresh-' + uid,
+        'expires_in': expires_in, 'auth_time': int(time.time())})
+    return user, Practice.objects.get(uid=uid)
+
+
+def patient(id, **fields):
+    return dict({'id': id, 'first_name': f"First{id}", 'last_name': f"Last{id}", 'date_of_birth': '1980-01-01',
+                 'updated_at': '2020-01-01T00:00:00'}, **fields)
+
+
+@override_settings(DRCHRONO_API_RATE_LIMIT=None)
+class FakeAPITestCase(TestCase):
+    """
+    Runs each test against a fresh FakeDrchronoAPI (self.api), serving the resources in `resources`, with a practice
+    signed in and current.
+    """
+    resources = {}
+    page_size = 100
+
+    def setUp(self):
+        super(FakeAPITestCase, self).setUp()
+        self.api = FakeDrchronoAPI(page_size=self.page_size, **self.resources)
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        base_url, BaseEndpoint.BASE_URL = BaseEndpoint.BASE_URL, self.api.base_url
+        self.addCleanup(setattr, BaseEndpoint, 'BASE_URL', base_url)
+        reset_rate_limiter()
+        reset_response_caches()
+        self.addCleanup(reset_response_caches)
+
+        self.user, self.practice = sign_in('practice')
+        # worker threads (fetch_many, the outbox) can't read this test's uncommitted rows through their own database
+        # connections, so load the token into the token manager's cache up front
+        get_token_manager('practice').get_token()
+        self.addCleanup(get_token_manager('practice').invalidate)
+        scope = tenancy.using(self.practice)
+        scope.__enter__()
+        self.addCleanup(scope.__exit__, None, None, None)
+
+    def requests_for(self, path, method='GET'):
+        return [request for request in self.api.request_log if request == (method, path)]
@@ -0,0 +1,65 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from drchrono.appointments import AppointmentSchedule
+from drchrono.models import Appointment, DashboardEvent
+
+from .base import FakeAPITestCase
+
+
+def now():
+    return timezone.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def appointment(id, day=None, time='09:00:00', **fields):
+    day = day or timezone.localdate()
+    return dict({'id': id, 'patient': id, 'doctor': 1, 'status': '', 'scheduled_time': f"{day.isoformat()}T{time}",
+                 'updated_at': now()}, **fields)
+
+
+class AppointmentScheduleTests(FakeAPITestCase):
+    resources = {'appointments': [appointment(1), appointment(2, time='10:00:00'),
+                                  appointment(3, day=timezone.localdate() + timedelta(days=1))]}
+
+    def change(self, id, **fields):
+        self.api.resources['appointments'][id].update(fields, updated_at=now())
+
+    def test_full_sync_loads_the_days_appointments(self):
+        self.assertEqual(AppointmentSchedule().sync(full=True), 2)
+        self.assertEqual([record['id'] for record in AppointmentSchedule().for_day()], [1, 2])
+
+    def test_only_changed_appointments_are_written(self):
+        schedule = AppointmentSchedule()
+        schedule.sync(full=True)
+        self.assertEqual(schedule.sync(), 0)
+        self.change(2, status='Arrived')
+        DashboardEvent.objects.all().delete()
+        self.assertEqual(schedule.sync(), 1)
+        self.assertEqual(Appointment.objects.get(appointment_id=2).status, 'Arrived')
+        # open dashboards hear about the change
+        self.assertEqual(DashboardEvent.objects.get().kind, 'appointment')
+
+    def test_full_sync_drops_deleted_appointments(self):
+        schedule = AppointmentSchedule()
+        schedule.sync(full=True)
+        del self.api.resources['appointments'][2]
+        schedule.sync(full=True)
+        self.assertEqual([record['id'] for record in schedule.for_day()], [1])
+
+    def test_appointments_rescheduled_to_another_day_are_dropped(self):
+        schedule = AppointmentSchedule()
+        schedule.sync(full=True)
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        self.change(2, scheduled_time=f"{tomorrow.isoformat()}T10:00:00")
+        schedule.sync()
+        self.assertEqual([record['id'] for record in schedule.for_day()], [1])
+        # and one rescheduled onto today shows up
+        self.change(3, scheduled_time=f"{timezone.localdate().isoformat()}T11:00:00")
+        schedule.sync()
+        self.assertEqual([record['id'] for record in schedule.for_day()], [1, 3])
+
+    def test_readers_sync_a_day_that_is_out_of_date(self):
+        self.assertEqual(len(AppointmentSchedule().for_patient(1)), 1)
+        requests = len(self.requests_for('/api/appointments'))
+        AppointmentSchedule().for_day()
+        self.assertEqual(len(self.requests_for('/api/appointments')), requests)
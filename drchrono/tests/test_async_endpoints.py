@@ -0,0 +1,46 @@
+import asyncio
+
+from drchrono.async_endpoints import AsyncPatientEndpoint
+from drchrono.endpoints import NotFound
+
+from .base import FakeAPITestCase, patient
+
+
+class AsyncEndpointTests(FakeAPITestCase):
+    resources = {'patients': [patient(id) for id in range(1, 6)]}
+
+    def test_list_and_fetch(self):
+        async def fetch():
+            endpoint = AsyncPatientEndpoint()
+            listed = [record['id'] async for record in endpoint.list(page_size=2)]
+            return listed, await endpoint.list_all(), await endpoint.fetch(3)
+
+        listed, records, record = asyncio.run(fetch())
+        self.assertEqual(listed, [1, 2, 3, 4, 5])
+        self.assertEqual(len(records), 5)
+        self.assertEqual(record['first_name'], 'First3')
+
+    def test_calls_run_together(self):
+        self.api.latency = 0.3
+
+        async def fetch_three():
+            endpoint = AsyncPatientEndpoint()
+            return await asyncio.gather(*[endpoint.fetch(id) for id in (1, 2, 3)])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        started = loop.time()
+        records = loop.run_until_complete(fetch_three())
+        self.assertEqual([record['id'] for record in records], [1, 2, 3])
+        # in the time of about one call, not three
+        self.assertLess(loop.time() - started, 0.8)
+
+    def test_errors_are_mapped_as_in_the_sync_client(self):
+        with self.assertRaises(NotFound):
+            asyncio.run(AsyncPatientEndpoint().fetch(99))
+
+    def test_injected_faults_answer_the_next_requests(self):
+        self.api.faults.append((404, {}))
+        with self.assertRaises(NotFound):
+            asyncio.run(AsyncPatientEndpoint().fetch(1))
+        self.assertEqual(asyncio.run(AsyncPatientEndpoint().fetch(1))['id'], 1)
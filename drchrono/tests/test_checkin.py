@@ -0,0 +1,49 @@
+from django.test import TestCase
+from drchrono import tenancy
+from drchrono.checkin import ARRIVED, AlreadyCheckedIn, CheckInService
+from drchrono.models import Appointment, OutboxMutation, Practice, Visit
+
+
+def appointment(id, patient=7, status='Confirmed'):
+    return {'id': id, 'patient': patient, 'doctor': 3, 'status': status, 'scheduled_time': '2020-01-01T09:00:00'}
+
+
+class CheckInServiceTests(TestCase):
+    def setUp(self):
+        scope = tenancy.using(Practice.objects.create(uid='checkin'))
+        scope.__enter__()
+        self.addCleanup(scope.__exit__, None, None, None)
+        self.appointments = [appointment(1), appointment(2, status=ARRIVED)]
+        for record in self.appointments:
+            local = Appointment(appointment_id=record['id'])
+            local.load(record)
+            local.save()
+
+    def test_checks_in_for_every_appointment(self):
+        visits = CheckInService().check_in(7, self.appointments)
+        self.assertEqual(sorted(visit.appointment_id for visit in visits), [1, 2])
+        for visit in Visit.objects.all():
+            self.assertEqual(visit.status, Visit.Status.ARRIVED)
+            self.assertIsNotNone(visit.arrival_time)
+            self.assertEqual(visit.doctor_id, 3)
+            self.assertIsNotNone(visit.scheduled_time)
+
+    def test_queues_a_status_change_for_appointments_not_yet_arrived(self):
+        CheckInService().check_in(7, self.appointments)
+        queued = OutboxMutation.objects.get()
+        self.assertEqual((queued.resource, queued.object_id, queued.patient_id), ('appointments', 1, 7))
+        self.assertEqual(queued.as_dict(), {'status': ARRIVED})
+        self.assertEqual(set(Appointment.objects.values_list('status', flat=True)), {ARRIVED})
+
+    def test_checking_in_twice_is_refused(self):
+        CheckInService().check_in(7, self.appointments)
+        with self.assertRaises(AlreadyCheckedIn):
+            CheckInService().check_in(7, self.appointments)
+        self.assertEqual(Visit.objects.count(), 2)
+        self.assertEqual(OutboxMutation.objects.count(), 1)
+
+    def test_only_pending_appointments_are_checked_in(self):
+        CheckInService().check_in(7, self.appointments[:1])
+        self.assertEqual(CheckInService.pending(self.appointments), self.appointments[1:])
+        visits = CheckInService().check_in(7, self.appointments)
+        self.assertEqual([visit.appointment_id for visit in visits], [2])
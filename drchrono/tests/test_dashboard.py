@@ -0,0 +1,51 @@
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.utils import timezone
+from drchrono.dashboard import render_section
+from drchrono.models import Visit
+from drchrono.stats import record_visit_transition
+
+from .base import FakeAPITestCase
+
+
+class DashboardSectionTests(FakeAPITestCase):
+    def setUp(self):
+        super(DashboardSectionTests, self).setUp()
+        self.addCleanup(cache.clear)
+        self.client.force_login(self.user)
+
+    def finish_visit(self, appointment_id, arrival_time):
+        visit = Visit.objects.create(appointment_id=appointment_id, patient_id=appointment_id,
+                                     status=Visit.Status.FINISHED, arrival_time=arrival_time,
+                                     start_time=arrival_time + timedelta(minutes=5),
+                                     end_time=arrival_time + timedelta(minutes=20))
+        record_visit_transition(visit)
+
+    def test_unchanged_sections_answer_not_modified(self):
+        response = self.client.get('/welcome/sections/statistics/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get('/welcome/sections/statistics/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        self.finish_visit(1, timezone.now() - timedelta(hours=1))
+        response = self.client.get('/welcome/sections/statistics/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['statistics']['visit']['count'], 1)
+
+    def test_unknown_sections_are_not_found(self):
+        self.assertEqual(self.client.get('/welcome/sections/nope/').status_code, 404)
+
+    def test_recent_statistics_follow_their_window(self):
+        now = timezone.now()
+        # about to fall out of the last 30 days
+        self.finish_visit(1, now - timedelta(days=30) + timedelta(minutes=30))
+        with self.settings(DASHBOARD_PERCENTILE_DAYS=30):
+            self.assertEqual(json.loads(render_section('statistics')[0])['recent']['count'], 1)
+            with mock.patch('django.utils.timezone.now', return_value=now + timedelta(hours=1)):
+                self.assertEqual(json.loads(render_section('statistics')[0])['recent']['count'], 0)
@@ -0,0 +1,164 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from drchrono.endpoints import NotFound, PagePrefetcher, PatientEndpoint, TooManyRequests, Unauthorized
+from drchrono.ratelimit import SharedTokenBucket, TokenBucket, get_rate_limiter, reset_rate_limiter
+from drchrono.tokens import get_token_manager
+from social_django.models import UserSocialAuth
+
+from .base import FakeAPITestCase, patient
+
+
+def refreshed_to(access_token):
+    """
+    Stands in for UserSocialAuth.refresh_token, which would ask drchrono.com for a new token
+    """
+    def refresh_token(social, strategy, *args, **kwargs):
+        social.extra_data['access_token'] = access_token
+        social.save()
+    return refresh_token
+
+
+class PagePrefetcherTests(SimpleTestCase):
+    def test_pages_come_out_in_order(self):
+        self.assertEqual(list(PagePrefetcher(iter(range(50)), 3)), list(range(50)))
+
+    def test_errors_are_raised_where_they_happened(self):
+        def pages():
+            yield 1
+            yield 2
+            raise ValueError("page 3 failed")
+
+        prefetcher = PagePrefetcher(pages(), 2)
+        self.assertEqual([next(prefetcher), next(prefetcher)], [1, 2])
+        with self.assertRaises(ValueError):
+            next(prefetcher)
+        self.assertEqual(list(prefetcher), [])
+
+    def test_close_stops_the_background_thread(self):
+        produced = []
+
+        def pages():
+            for number in range(1000):
+                produced.append(number)
+                yield number
+
+        prefetcher = PagePrefetcher(pages(), 2)
+        self.assertEqual(next(prefetcher), 0)
+        prefetcher.close()
+        prefetcher._thread.join(timeout=2)
+        self.assertFalse(prefetcher._thread.is_alive())
+        # it got no further than the pages it had room to hold
+        self.assertLess(len(produced), 10)
+        self.assertEqual(list(prefetcher), [])
+
+    def test_pages_are_fetched_ahead_of_the_caller(self):
+        fetched = threading.Event()
+
+        def pages():
+            yield 1
+            yield 2
+            fetched.set()
+
+        prefetcher = PagePrefetcher(pages(), 2)
+        self.assertEqual(next(prefetcher), 1)
+        self.assertTrue(fetched.wait(timeout=2))
+
+
+class EndpointTests(FakeAPITestCase):
+    resources = {'patients': [patient(id) for id in range(1, 6)]}
+
+    def test_list_walks_every_page(self):
+        self.assertEqual([record['id'] for record in PatientEndpoint().list(page_size=2)], [1, 2, 3, 4, 5])
+        self.assertEqual(len(self.requests_for('/api/patients')), 3)
+
+    def test_list_without_prefetching(self):
+        self.assertEqual([record['id'] for record in PatientEndpoint().list(page_size=2, prefetch=0)], [1, 2, 3, 4, 5])
+
+    def test_abandoned_lists_stop_fetching(self):
+        records = PatientEndpoint().list(page_size=1, prefetch=1)
+        self.assertEqual(next(records)['id'], 1)
+        records.close()
+        self.assertLess(len(self.requests_for('/api/patients')), 5)
+
+    def test_fetch_many_fetches_each_id_once_and_skips_missing_ones(self):
+        found = PatientEndpoint().fetch_many([1, 2, 2, 99, None])
+        self.assertEqual(sorted(found), [1, 2])
+        self.assertEqual(len(self.requests_for('/api/patients/2')), 1)
+        with self.assertRaises(NotFound):
+            PatientEndpoint().fetch(99)
+
+    def test_fetch_many_serves_what_the_cache_has(self):
+        self.addCleanup(cache.clear)
+        PatientEndpoint().fetch_many([1, 2], cache=cache)
+        found = PatientEndpoint().fetch_many([1, 2, 3], cache=cache)
+        self.assertEqual(sorted(found), [1, 2, 3])
+        self.assertEqual(len(self.requests_for('/api/patients/1')), 1)
+        self.assertEqual(len(self.requests_for('/api/patients/3')), 1)
+
+    def test_fetch_many_fetches_concurrently(self):
+        self.api.latency = 0.2
+        started = time.monotonic()
+        self.assertEqual(len(PatientEndpoint().fetch_many([1, 2, 3, 4, 5], max_workers=5)), 5)
+        self.assertLess(time.monotonic() - started, 0.6)
+
+
+class ReplayTests(FakeAPITestCase):
+    resources = {'patients': [patient(1)]}
+
+    def test_a_rejected_token_is_refreshed_and_the_request_replayed(self):
+        self.api.accepted_tokens = {'refreshed'}
+        with mock.patch.object(UserSocialAuth, 'refresh_token', refreshed_to('refreshed')):
+            self.assertEqual(PatientEndpoint().fetch(1)['id'], 1)
+        self.assertEqual(len(self.requests_for('/api/patients/1')), 2)
+        self.assertEqual(get_token_manager().get_token(), 'refreshed')
+
+    def test_a_token_that_cant_be_refreshed_is_given_up_on(self):
+        self.api.accepted_tokens = set()
+        with mock.patch.object(UserSocialAuth, 'refresh_token', side_effect=ValueError("refresh token revoked")):
+            with self.assertRaises(Unauthorized), self.assertLogs('drchrono.endpoints', 'WARNING'):
+                PatientEndpoint().fetch(1)
+        self.assertEqual(len(self.requests_for('/api/patients/1')), 1)
+
+    def test_throttled_requests_wait_out_retry_after(self):
+        self.addCleanup(reset_rate_limiter)
+        with self.settings(DRCHRONO_API_RATE_LIMIT={'rate': 100, 'burst': 100}):
+            reset_rate_limiter()
+            self.api.faults.append((429, {'Retry-After': '0.3'}))
+            started = time.time()
+            with self.assertLogs('drchrono.endpoints', 'WARNING'):
+                self.assertEqual(PatientEndpoint().fetch(1)['id'], 1)
+            self.assertGreaterEqual(time.time() - started, 0.3)
+            self.assertEqual(len(self.requests_for('/api/patients/1')), 2)
+            # the whole bucket was paused, so every other request was held back too
+            self.assertGreaterEqual(get_rate_limiter()._bucket['paused_until'], started + 0.3)
+
+    def test_throttled_requests_are_replayed_a_limited_number_of_times(self):
+        self.api.faults.extend([(429, {'Retry-After': '0'})] * 3)
+        with self.assertRaises(TooManyRequests), self.assertLogs('drchrono.endpoints', 'WARNING'):
+            PatientEndpoint().fetch(1)
+        self.assertEqual(len(self.requests_for('/api/patients/1')), 3)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_bursts_then_keeps_to_the_rate(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertIsNone(bucket._take())
+        self.assertIsNone(bucket._take())
+        self.assertAlmostEqual(bucket._take(), 0.1, delta=0.02)
+
+    def test_processes_share_a_bucket_through_its_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'ratelimit.state')
+        first, second = SharedTokenBucket(10, 2, path), SharedTokenBucket(10, 2, path)
+        self.assertIsNone(first._take())
+        self.assertIsNone(second._take())
+        self.assertIsNotNone(first._take())
+        second.pause(5)
+        self.assertGreater(first._take(), 4)
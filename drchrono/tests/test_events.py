@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+from drchrono import events
+from drchrono.models import DashboardEvent
+
+from .base import FakeAPITestCase
+
+
+class EventStreamTests(TestCase):
+    def test_returns_as_soon_as_there_are_events(self):
+        first = events.publish(events.ARRIVAL, patient_id=1)
+        events.publish(events.ARRIVAL, patient_id=2)
+        started = time.monotonic()
+        sent = list(events.stream(first.id, poll_interval=0.01, duration=60))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(len(sent), 2)
+        self.assertIn('"patient_id": 2', sent[1])
+
+    def test_returns_empty_after_the_timeout(self):
+        sent = list(events.stream(events.latest_event_id(), poll_interval=0.01, duration=0.05))
+        self.assertEqual(sent, ["retry: 10\n\n"])
+
+    def test_prune_forgets_old_events(self):
+        old = events.publish(events.ARRIVAL, patient_id=1)
+        DashboardEvent.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(days=2))
+        new = events.publish(events.ARRIVAL, patient_id=2)
+        with self.settings(DASHBOARD_EVENTS_RETENTION=60 * 60 * 24):
+            self.assertEqual(events.prune(), 1)
+        self.assertEqual(list(DashboardEvent.objects.values_list('id', flat=True)), [new.id])
+
+
+class DashboardEventsViewTests(FakeAPITestCase):
+    resources = {'doctors': [{'id': 1, 'first_name': 'Doc', 'last_name': 'Tor'}]}
+
+    def setUp(self):
+        super(DashboardEventsViewTests, self).setUp()
+        self.client.force_login(self.user)
+
+    def events_sent(self, url, **headers):
+        with self.settings(DASHBOARD_EVENTS_POLL_INTERVAL=0.01, DASHBOARD_EVENTS_STREAM_DURATION=0.05):
+            response = self.client.get(url, **headers)
+            return b''.join(response.streaming_content).decode()
+
+    def test_the_dashboard_listens_from_when_it_was_rendered(self):
+        seen = events.publish(events.ARRIVAL, patient_id=1)
+        response = self.client.get('/welcome/')
+        self.assertEqual(response.context['last_event_id'], seen.id)
+        self.assertContains(response, f'/welcome/events/?last_event_id={seen.id}')
+
+        # published after the page was rendered, but before its EventSource connected
+        missed = events.publish(events.ARRIVAL, patient_id=2)
+        sent = self.events_sent(f'/welcome/events/?last_event_id={seen.id}')
+        self.assertIn(f'id: {missed.id}\n', sent)
+        self.assertNotIn(f'id: {seen.id}\n', sent)
+
+    def test_reconnects_resume_from_the_last_event_seen(self):
+        first = events.publish(events.ARRIVAL, patient_id=1)
+        second = events.publish(events.ARRIVAL, patient_id=2)
+        sent = self.events_sent('/welcome/events/?last_event_id=0', HTTP_LAST_EVENT_ID=str(first.id))
+        self.assertEqual(sent.count('id: '), 1)
+        self.assertIn(f'id: {second.id}\n', sent)
+        # without either, only new events
+        self.assertEqual(self.events_sent('/welcome/events/').count('id: '), 0)
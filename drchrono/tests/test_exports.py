@@ -0,0 +1,94 @@
+import csv
+import json
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from django.utils import timezone
+from drchrono import tenancy
+from drchrono.exports import export_visits
+from drchrono.models import Visit
+
+from .base import sign_in
+
+
+def export(*args):
+    out = StringIO()
+    call_command('export_visits', *args, stdout=out)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+class ExportVisitsCommandTests(TestCase):
+    def setUp(self):
+        _, self.practice = sign_in('practice')
+        with tenancy.using(self.practice):
+            Visit.objects.create(appointment_id=1, patient_id=1)
+
+    def test_exports_the_only_practices_visits(self):
+        self.assertEqual([row['appointment_id'] for row in export()], [1])
+
+    def test_several_practices_need_one_picked(self):
+        _, other = sign_in('other')
+        with tenancy.using(other):
+            Visit.objects.create(appointment_id=2, patient_id=2)
+        with self.assertRaisesMessage(CommandError, '--practice'):
+            export()
+        self.assertEqual([row['appointment_id'] for row in export('--practice', 'other')], [2])
+        with self.assertRaises(CommandError):
+            export('--practice', 'nobody')
+
+
+class ExportVisitsTests(TestCase):
+    def setUp(self):
+        self.user, practice = sign_in('practice')
+        scope = tenancy.using(practice)
+        scope.__enter__()
+        self.addCleanup(scope.__exit__, None, None, None)
+        self.arrived = timezone.make_aware(datetime(2020, 1, 2, 9, 0))
+        Visit.objects.create(appointment_id=1, patient_id=1, doctor_id=7, status=Visit.Status.FINISHED,
+                             arrival_time=self.arrived, start_time=self.arrived + timedelta(minutes=5),
+                             end_time=self.arrived + timedelta(minutes=35))
+        Visit.objects.create(appointment_id=2, patient_id=2, status=Visit.Status.ARRIVED,
+                             arrival_time=self.arrived + timedelta(days=1))
+
+    def test_ndjson_rows_carry_status_labels_and_durations(self):
+        rows = [json.loads(line) for line in ''.join(export_visits('ndjson')).splitlines()]
+        self.assertEqual([row['appointment_id'] for row in rows], [1, 2])
+        self.assertEqual(rows[0]['status'], 'Finished')
+        self.assertEqual((rows[0]['wait_duration'], rows[0]['visit_duration']), (300, 1800))
+        self.assertEqual(rows[0]['arrival_time'], self.arrived.isoformat().replace('+00:00', 'Z'))
+        self.assertEqual((rows[1]['status'], rows[1]['wait_duration']), ('Arrived', None))
+
+    def test_csv_has_a_header_and_empty_cells_for_missing_values(self):
+        rows = list(csv.DictReader(StringIO(''.join(export_visits('csv')))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual((rows[0]['status'], rows[0]['visit_duration']), ('Finished', '1800.0'))
+        self.assertEqual((rows[1]['doctor_id'], rows[1]['start_time']), ('', ''))
+        # no visits, just the header
+        self.assertEqual(''.join(export_visits('csv', statuses=[Visit.Status.IN_SESSION])).count('\n'), 1)
+
+    def test_filters_by_day_of_arrival_and_status(self):
+        day = self.arrived.date()
+        self.assertEqual(''.join(export_visits(start=day, end=day)).count('\n'), 1)
+        self.assertEqual(''.join(export_visits(start=day + timedelta(days=1))).count('\n'), 1)
+        self.assertIn('"appointment_id": 2', ''.join(export_visits(statuses=[Visit.Status.ARRIVED])))
+
+    def test_output_comes_a_chunk_of_lines_at_a_time(self):
+        for appointment_id in range(3, 7):
+            Visit.objects.create(appointment_id=appointment_id, patient_id=appointment_id)
+        with mock.patch('drchrono.exports.CHUNK_SIZE', 2):
+            chunks = list(export_visits())
+        self.assertEqual([chunk.count('\n') for chunk in chunks], [2, 2, 2])
+
+    def test_the_view_streams_a_download(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/visits/export/?format=csv&status=finished')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="visits.csv"')
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['appointment_id'] for row in rows], ['1'])
+
+        response = self.client.get('/visits/export/?start=2020-02-01&end=2020-01-01')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,39 @@
+import json
+import re
+
+from django.utils import timezone
+
+from .base import FakeAPITestCase, patient
+
+
+class RequestMetricsTests(FakeAPITestCase):
+    resources = {'patients': [patient(1), patient(2)],
+                 'appointments': [{'id': id, 'patient': id, 'doctor': 1, 'status': '',
+                                   'scheduled_time': f"{timezone.localdate().isoformat()}T09:00:00"}
+                                  for id in (1, 2)]}
+
+    def setUp(self):
+        super(RequestMetricsTests, self).setUp()
+        self.client.force_login(self.user)
+
+    def test_server_timing_reports_queries_api_calls_and_sections(self):
+        with self.assertLogs('drchrono.middleware', 'INFO') as logs:
+            response = self.client.get('/welcome/sections/appointments/')
+        timing = {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+        self.assertRegex(timing['total'], r'^total;dur=\d+\.\d$')
+        queries = int(re.search(r'"(\d+) queries"', timing['db']).group(1))
+        self.assertGreater(queries, 0)
+        self.assertIn('desc="1 calls', timing['api-appointments'])
+        self.assertIn('desc="1 calls', timing['api-patients'])
+
+        # the same numbers, logged as one JSON line
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['path'], record['status']), ('/welcome/sections/appointments/', 200))
+        self.assertEqual(record['db']['queries'], queries)
+        self.assertEqual(sum(totals['calls'] for totals in record['api'].values()), len(self.api.request_log))
+        self.assertEqual(len(record['api_calls']), len(self.api.request_log))
+
+    def test_server_timing_can_be_turned_off(self):
+        with self.settings(REQUEST_METRICS_SERVER_TIMING=False):
+            response = self.client.get('/welcome/sections/appointments/')
+        self.assertFalse(response.has_header('Server-Timing'))
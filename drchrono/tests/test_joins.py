@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+from drchrono.joins import enrich, index_by
+
+
+class EnrichTests(SimpleTestCase):
+    def setUp(self):
+        self.patients = index_by([{'id': 1, 'first_name': 'Ada', 'last_name': 'Lovelace'},
+                                  {'id': 2, 'first_name': 'Alan', 'last_name': 'Turing'}])
+
+    def test_copies_fields_onto_dicts_and_objects(self):
+        appointment = {'id': 10, 'patient': 2}
+        visit = SimpleNamespace(appointment_id=11, patient_id=1)
+        self.assertEqual(enrich([appointment], self.patients, 'patient', ('first_name', 'last_name')), [])
+        self.assertEqual(enrich([visit], self.patients, 'patient_id', ('first_name',)), [])
+        self.assertEqual((appointment['first_name'], appointment['last_name']), ('Alan', 'Turing'))
+        self.assertEqual(visit.first_name, 'Ada')
+        self.assertFalse(hasattr(visit, 'last_name'))
+
+    def test_rows_with_unknown_references_get_the_default(self):
+        rows = [{'patient': 1}, {'patient': 99}, {'patient': None}]
+        missing = enrich(rows, self.patients, 'patient', ('first_name',), default='')
+        self.assertEqual(missing, rows[1:])
+        self.assertEqual([row['first_name'] for row in rows], ['Ada', '', ''])
+
+    def test_index_by_another_key(self):
+        self.assertEqual(list(index_by([SimpleNamespace(patient_id=5)], 'patient_id')), [5])
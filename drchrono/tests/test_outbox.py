@@ -0,0 +1,112 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.utils import timezone
+from drchrono import outbox, tenancy
+from drchrono.models import OutboxMutation, Patient
+from drchrono.outbox import Outbox
+from drchrono.tokens import get_token_manager
+
+from .base import FakeAPITestCase, patient, sign_in
+
+
+class StopPolling(Exception):
+    pass
+
+
+class OutboxTests(FakeAPITestCase):
+    resources = {'patients': [patient(1), patient(2)]}
+
+    def test_sends_queued_changes(self):
+        outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0100'})
+        self.assertEqual(Outbox().drain(), 1)
+        self.assertEqual(self.api.resources['patients'][1]['cell_phone'], '555-0100')
+        self.assertEqual(OutboxMutation.objects.get().status, OutboxMutation.Status.SENT)
+
+    def test_claimed_changes_arent_sent_by_another_worker(self):
+        outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0100'})
+        outbox.enqueue('patients', 2, 2, {'cell_phone': '555-0200'})
+        # another worker read the same changes, but this one claimed them first
+        read_by_other = list(OutboxMutation.objects.all())
+        self.assertEqual(len(Outbox().due()), 2)
+        self.assertFalse(any(Outbox._claim(queued, queued.next_attempt_at) for queued in read_by_other))
+        self.assertEqual(Outbox().due(), [])
+
+    def test_expired_claims_are_picked_up_again(self):
+        outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0100'})
+        with self.settings(OUTBOX_CLAIM_TIMEOUT=0):
+            self.assertEqual(len(Outbox().due()), 1)
+            self.assertEqual(len(Outbox().due()), 1)
+
+    def test_a_patient_whose_change_failed_is_fetched_again(self):
+        Patient.objects.create(patient_id=3, first_name='Local')
+        outbox.enqueue('patients', 3, 3, {'cell_phone': '555-0300'})
+        with self.assertLogs('drchrono.outbox', 'ERROR'):
+            Outbox().drain()
+        self.assertEqual(OutboxMutation.objects.get().status, OutboxMutation.Status.FAILED)
+        self.assertTrue(Patient.objects.get(patient_id=3).stale)
+
+    def test_failed_changes_are_retried_with_backoff(self):
+        queued = outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0100'})
+        self.api.faults.append((503, {}))
+        with self.assertLogs('drchrono.outbox', 'WARNING'):
+            self.assertEqual(Outbox().drain(), 0)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (OutboxMutation.Status.PENDING, 1))
+        self.assertGreater(queued.next_attempt_at, timezone.now())
+
+        OutboxMutation.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(Outbox().drain(), 1)
+        self.assertEqual(self.api.resources['patients'][1]['cell_phone'], '555-0100')
+
+    def test_gives_up_after_max_attempts(self):
+        outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0100'})
+        self.api.faults.extend([(503, {})] * 2)
+        with self.assertLogs('drchrono.outbox', 'WARNING'):
+            for attempt in range(2):
+                OutboxMutation.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+                Outbox(max_attempts=2).process()
+        queued = OutboxMutation.objects.get()
+        self.assertEqual((queued.status, queued.attempts), (OutboxMutation.Status.FAILED, 2))
+
+    def test_each_patients_changes_are_sent_in_order(self):
+        first = outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0101'})
+        second = outbox.enqueue('patients', 1, 1, {'cell_phone': '555-0102'})
+        other = outbox.enqueue('patients', 2, 2, {'cell_phone': '555-0200'})
+        # one change per patient at a time, oldest first
+        self.assertEqual([queued.id for queued in Outbox().due()], [first.id, other.id])
+        OutboxMutation.objects.update(next_attempt_at=timezone.now())
+
+        # while the first change is being retried, the patient's later change waits for it
+        self.api.faults.append((503, {}))
+        with self.assertLogs('drchrono.outbox', 'WARNING'):
+            self.assertEqual(Outbox(max_workers=1).process(), 1)
+        self.assertEqual(Outbox().due(), [])
+        self.assertEqual(OutboxMutation.objects.get(pk=second.pk).attempts, 0)
+
+        OutboxMutation.objects.filter(pk=first.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(Outbox().drain(), 2)
+        self.assertEqual(self.api.resources['patients'][1]['cell_phone'], '555-0102')
+        patches = [request for request in self.api.request_log if request == ('PATCH', '/api/patients/1')]
+        self.assertEqual(len(patches), 3)
+
+    def test_the_worker_keeps_going_when_a_practice_fails(self):
+        _, other = sign_in('other')
+        self.addCleanup(get_token_manager('other').invalidate)
+        with tenancy.using(other):
+            outbox.enqueue('patients', 2, 2, {'cell_phone': '555-0200'})
+        drained = []
+
+        def drain(outbox, limit):
+            drained.append(tenancy.current())
+            if tenancy.current() == self.practice:
+                raise OperationalError("database is locked")
+            return 0
+
+        with mock.patch.object(Outbox, 'drain', drain), self.assertLogs('drchrono.management', 'ERROR'), \
+                mock.patch('drchrono.management.commands.process_outbox.time.sleep', side_effect=StopPolling):
+            with self.assertRaises(StopPolling):
+                call_command('process_outbox')
+        self.assertEqual(sorted(practice.uid for practice in drained), ['other', 'practice'])
@@ -0,0 +1,87 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from drchrono.endpoints import NotFound
+from drchrono.models import Patient, SyncState, Visit, normalize_name
+from drchrono.patients import AmbiguousPatient, PatientDirectory
+
+from .base import FakeAPITestCase, patient
+
+
+class PatientDirectoryTests(FakeAPITestCase):
+    resources = {'patients': [patient(1), patient(2),
+                              patient(3, first_name='First1', last_name='Last1', date_of_birth='1990-05-05')]}
+
+    def test_full_sync_loads_every_patient(self):
+        self.assertEqual(PatientDirectory().sync(full=True), 3)
+        self.assertEqual(Patient.objects.count(), 3)
+
+    def test_full_sync_drops_deleted_patients(self):
+        PatientDirectory().sync(full=True)
+        del self.api.resources['patients'][2]
+        PatientDirectory().sync(full=True)
+        self.assertFalse(Patient.objects.filter(patient_id=2).exists())
+
+    def test_lookup_by_name_and_date_of_birth(self):
+        directory = PatientDirectory()
+        directory.sync(full=True)
+        self.assertEqual(directory.lookup('first2', ' LAST2 ')['id'], 2)
+        with self.assertRaises(AmbiguousPatient):
+            directory.lookup('First1', 'Last1')
+        self.assertEqual(directory.lookup('First1', 'Last1', '1990-05-05')['id'], 3)
+        self.assertIsNone(directory.lookup('Nobody', 'Here'))
+
+    def test_lookups_ignore_accents(self):
+        self.assertEqual(normalize_name(' José ', 'DE  la Cruz'), 'jose de la cruz')
+        self.assertEqual(normalize_name('Zoë', 'Ångström'), normalize_name('zoe', 'angstrom'))
+        self.api.resources['patients'][4] = patient(4, first_name='José', last_name='Núñez')
+        directory = PatientDirectory()
+        directory.sync(full=True)
+        self.assertEqual(directory.lookup('Jose', 'NUNEZ')['id'], 4)
+        self.assertEqual(directory.lookup('José', 'Núñez')['id'], 4)
+
+    def test_the_first_lookup_loads_the_directory_once(self):
+        self.assertEqual(PatientDirectory().lookup('First2', 'Last2')['id'], 2)
+        self.assertEqual(PatientDirectory().lookup('First1', 'Last1', '1980-01-01')['id'], 1)
+        self.assertEqual(len(self.requests_for('/api/patients')), 1)
+        self.assertEqual(Patient.objects.count(), 3)
+
+    def test_a_failed_first_load_is_tried_again(self):
+        self.api.faults.append((404, {}))
+        with self.assertRaises(NotFound):
+            PatientDirectory().lookup('First2', 'Last2')
+        self.assertEqual(PatientDirectory().lookup('First2', 'Last2')['id'], 2)
+
+    def test_a_first_load_in_progress_isnt_started_again(self):
+        directory = PatientDirectory()
+        state = directory._state()
+        self.assertTrue(directory._claim(state))
+        self.assertFalse(PatientDirectory().refresh())
+        self.assertEqual(self.requests_for('/api/patients'), [])
+
+    def test_check_in_on_a_directory_never_synced(self):
+        self.api.resources['appointments'][10] = {
+            'id': 10, 'patient': 2, 'doctor': 1, 'status': '',
+            'scheduled_time': f"{timezone.localdate().isoformat()}T09:00:00"}
+        self.client.force_login(self.user)
+        response = self.client.post('/check-in/', {'first_name': 'First2', 'last_name': 'Last2'})
+        self.assertRedirects(response, '/demographics/?patient_id=2', fetch_redirect_response=False)
+        self.assertEqual(Visit.objects.get().appointment_id, 10)
+
+    def test_a_stale_directory_is_synced_once(self):
+        PatientDirectory().sync(full=True)
+        SyncState.objects.update(synced_at=timezone.now() - timedelta(days=1))
+        stale = PatientDirectory()
+        state = stale._state()
+        # another request got there first
+        self.assertTrue(PatientDirectory().refresh())
+        self.assertFalse(stale._claim(state))
+
+    def test_invalidated_patients_are_fetched_again(self):
+        directory = PatientDirectory()
+        directory.sync(full=True)
+        self.api.resources['patients'][2]['first_name'] = 'Changed'
+        self.assertEqual(directory.get(2)['first_name'], 'First2')
+        directory.invalidate(2)
+        self.assertEqual(directory.get(2)['first_name'], 'Changed')
+        self.assertFalse(Patient.objects.get(patient_id=2).stale)
@@ -0,0 +1,47 @@
+from unittest import mock
+
+from django.core.cache import cache
+from drchrono import response_cache
+from drchrono.endpoints import DoctorEndpoint
+from drchrono.response_cache import get_response_cache
+
+from .base import FakeAPITestCase
+
+
+class ResponseCacheTests(FakeAPITestCase):
+    resources = {'doctors': [{'id': 1, 'first_name': 'Doc', 'last_name': 'Tor'}]}
+
+    def stats(self):
+        return get_response_cache(DoctorEndpoint).stats.as_dict()
+
+    def expire(self):
+        get_response_cache(DoctorEndpoint).ttl = 0
+
+    def test_fresh_responses_are_served_from_the_cache(self):
+        self.assertEqual(DoctorEndpoint().fetch(1)['first_name'], 'Doc')
+        self.assertEqual(DoctorEndpoint().fetch(1)['first_name'], 'Doc')
+        self.assertEqual(len(self.requests_for('/api/doctors/1')), 1)
+        self.assertEqual(self.stats(), {'hits': 1, 'revalidated': 0, 'misses': 1})
+
+    def test_stale_responses_are_revalidated(self):
+        DoctorEndpoint().fetch(1)
+        self.expire()
+        # unchanged: the API answers 304 and the cached body is used
+        self.assertEqual(DoctorEndpoint().fetch(1)['first_name'], 'Doc')
+        self.assertEqual(self.stats()['revalidated'], 1)
+
+        # changed: the ETag no longer matches, and the new record comes back
+        self.api.resources['doctors'][1]['first_name'] = 'Who'
+        self.assertEqual(DoctorEndpoint().fetch(1)['first_name'], 'Who')
+        self.assertEqual(self.stats(), {'hits': 0, 'revalidated': 1, 'misses': 2})
+        self.assertEqual(len(self.requests_for('/api/doctors/1')), 3)
+
+    def test_shared_between_processes_through_the_django_cache(self):
+        self.addCleanup(cache.clear)
+        with self.settings(DRCHRONO_API_RESPONSE_CACHE={'backend': 'django'}):
+            DoctorEndpoint().fetch(1)
+            # another process has response caches of its own, but the same Django cache behind them
+            with mock.patch.dict(response_cache._caches, clear=True):
+                DoctorEndpoint().fetch(1)
+                self.assertEqual(self.stats()['hits'], 1)
+        self.assertEqual(len(self.requests_for('/api/doctors/1')), 1)
@@ -0,0 +1,112 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from drchrono import tenancy
+from drchrono.dashboard import statistics_section
+from drchrono.models import Practice, Visit
+from drchrono.stats import chart_points, record_visit_transition
+
+
+class StatisticsSectionTests(TestCase):
+    def setUp(self):
+        scope = tenancy.using(Practice.objects.create(uid='stats'))
+        scope.__enter__()
+        self.addCleanup(scope.__exit__, None, None, None)
+
+    def finish_visit(self, appointment_id, wait, duration, days_ago=0):
+        arrival_time = timezone.now() - timedelta(days=days_ago, hours=1)
+        visit = Visit.objects.create(appointment_id=appointment_id, patient_id=appointment_id,
+                                     status=Visit.Status.FINISHED, arrival_time=arrival_time,
+                                     start_time=arrival_time + timedelta(seconds=wait),
+                                     end_time=arrival_time + timedelta(seconds=wait + duration))
+        record_visit_transition(visit)
+
+    def test_shows_averages_and_recent_percentiles(self):
+        for appointment_id in range(1, 11):
+            self.finish_visit(appointment_id, wait=appointment_id * 10, duration=appointment_id * 60)
+        # too old for the percentiles, but still in the averages
+        self.finish_visit(11, wait=10000, duration=10000, days_ago=400)
+
+        with self.settings(DASHBOARD_PERCENTILE_DAYS=30):
+            section = statistics_section()
+        self.assertEqual(section['statistics']['visit']['count'], 11)
+        self.assertEqual(section['recent']['count'], 10)
+        self.assertEqual(section['recent']['wait']['median'], 50)
+        self.assertEqual(section['recent']['wait']['p90'], 90)
+        self.assertEqual(section['recent']['visit']['median'], 300)
+        self.assertEqual(section['recent']['visit']['p90'], 540)
+        self.assertEqual(section['recent_days'], 30)
+
+    def test_no_visits(self):
+        section = statistics_section()
+        self.assertEqual(section['recent']['count'], 0)
+        self.assertIsNone(section['recent']['wait']['median'])
+        self.assertEqual(section['avg_wait_duration'], 0)
+        self.assertEqual(section['daily'], [])
+
+    def test_shows_recent_days(self):
+        self.finish_visit(1, wait=10, duration=60, days_ago=2)
+        self.finish_visit(2, wait=10, duration=60)
+        self.finish_visit(3, wait=10, duration=120)
+        self.finish_visit(4, wait=10, duration=60, days_ago=400)
+
+        with self.settings(DASHBOARD_PERCENTILE_DAYS=30):
+            daily = statistics_section()['daily']
+        self.assertEqual([(day['count'], day['avg_visit']) for day in daily], [(1, 60), (2, 90)])
+        self.assertEqual(daily[-1]['day'], timezone.localdate(timezone.now() - timedelta(hours=1)).isoformat())
+
+
+class ChartPointsTests(TestCase):
+    def visit(self, appointment_id, days_ago, wait, duration):
+        arrival_time = timezone.now() - timedelta(days=days_ago, hours=1)
+        visit = Visit.objects.create(appointment_id=appointment_id, patient_id=appointment_id,
+                                     status=Visit.Status.IN_SESSION, arrival_time=arrival_time,
+                                     start_time=arrival_time + timedelta(seconds=wait))
+        record_visit_transition(visit)
+        visit.status, visit.end_time = Visit.Status.FINISHED, visit.start_time + timedelta(seconds=duration)
+        visit.save()
+        record_visit_transition(visit)
+
+    def test_few_visits_are_plotted_one_by_one(self):
+        self.visit(1, days_ago=1, wait=10, duration=60)
+        self.visit(2, days_ago=0, wait=20, duration=120)
+        points = chart_points(5)
+        self.assertEqual([(point['count'], point['wait_duration'], point['visit_duration']) for point in points],
+                         [(1, 10, 60), (1, 20, 120)])
+
+    def test_many_visits_are_binned_by_day(self):
+        # two visits a day for six days
+        for day in range(6):
+            self.visit(day * 2, days_ago=day, wait=10, duration=60)
+            self.visit(day * 2 + 1, days_ago=day, wait=30, duration=60 * (day + 1))
+        points = chart_points(6)
+        self.assertEqual(len(points), 6)
+        self.assertEqual([point['count'] for point in points], [2] * 6)
+        self.assertEqual(points[0]['wait_duration'], 20)
+        # oldest day first
+        self.assertEqual(points[0]['visit_duration'], (60 + 360) / 2)
+
+    def test_more_days_than_points_are_merged_into_wider_bins(self):
+        for day in range(6):
+            self.visit(day, days_ago=day, wait=10 * (day + 1), duration=60)
+        points = chart_points(3)
+        self.assertEqual([point['count'] for point in points], [2, 2, 2])
+        # averages weighted by visit count: the two oldest days waited 60s and 50s
+        self.assertEqual(points[0]['wait_duration'], 55)
+        self.assertLess(points[0]['start_time'], points[1]['start_time'])
+
+
+class ConvertVisitStatusesTests(TestCase):
+    def test_text_statuses_are_converted(self):
+        visits = [Visit.objects.create(appointment_id=id, patient_id=id) for id in range(1, 5)]
+        # as saved before status was a number
+        for visit, status in zip(visits, ['Arrived', 'In Session', 'Finished', '']):
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE drchrono_visit SET status = %s WHERE id = %s", [status, visit.pk])
+        call_command('convert_visit_statuses', stdout=StringIO())
+        self.assertEqual(list(Visit.objects.order_by('appointment_id').values_list('status', flat=True)),
+                         [Visit.Status.ARRIVED, Visit.Status.IN_SESSION, Visit.Status.FINISHED, None])
@@ -0,0 +1,99 @@
+import asyncio
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from drchrono import events, tenancy
+from drchrono.async_endpoints import AsyncDoctorEndpoint
+from drchrono.endpoints import BaseEndpoint
+from drchrono.fake_api import FakeDrchronoAPI
+from drchrono.management.commands._practices import signed_in_practices
+from drchrono.models import DashboardEvent, Patient
+from drchrono.tokens import get_token_manager
+from social_django.models import UserSocialAuth
+
+from .base import sign_in
+
+
+@override_settings(DASHBOARD_EVENTS_POLL_INTERVAL=0.01, DASHBOARD_EVENTS_STREAM_DURATION=0.01)
+class TenantIsolationTests(TestCase):
+    def setUp(self):
+        self.user_a, self.practice_a = sign_in('a')
+        self.user_b, self.practice_b = sign_in('b')
+        for practice, name in ((self.practice_a, 'Alice'), (self.practice_b, 'Bob')):
+            with tenancy.using(practice):
+                # the same drchrono id in both practices
+                Patient.objects.create(patient_id=1, first_name=name)
+                events.publish(events.ARRIVAL, patient_id=1, first_name=name)
+
+    def tearDown(self):
+        for uid in ('a', 'b'):
+            get_token_manager(uid).invalidate()
+
+    def events_seen(self, client):
+        response = client.get('/welcome/events/?last_event_id=0')
+        return response.status_code, b''.join(response.streaming_content) if response.streaming else b''
+
+    def test_queries_only_see_the_current_practice(self):
+        with tenancy.using(self.practice_a):
+            self.assertEqual([patient.first_name for patient in Patient.objects.all()], ['Alice'])
+        with tenancy.using(self.practice_b):
+            self.assertEqual(Patient.objects.get(patient_id=1).first_name, 'Bob')
+            self.assertEqual(DashboardEvent.objects.count(), 1)
+
+    def test_no_current_practice_only_sees_unassigned_rows(self):
+        Patient.objects.create(patient_id=1, first_name='Legacy')
+        self.assertEqual([patient.first_name for patient in Patient.objects.all()], ['Legacy'])
+        with tenancy.using(self.practice_a):
+            self.assertEqual(Patient.objects.get(patient_id=1).first_name, 'Alice')
+
+    def test_each_practice_uses_its_own_token(self):
+        with tenancy.using(self.practice_a):
+            self.assertEqual(get_token_manager().get_token(), 'token-a')
+        with tenancy.using(self.practice_b):
+            self.assertEqual(get_token_manager().get_token(), 'token-b')
+
+    def test_async_endpoints_keep_the_current_practice(self):
+        # on an executor thread without the practice, there'd be two accounts to pick the token from
+        with FakeDrchronoAPI(doctors=[{'id': 1}]) as api, self.settings(DRCHRONO_API_RATE_LIMIT=None):
+            base_url, BaseEndpoint.BASE_URL = BaseEndpoint.BASE_URL, api.base_url
+            try:
+                with tenancy.using(self.practice_a):
+                    doctor = asyncio.run(AsyncDoctorEndpoint().first())
+            finally:
+                BaseEndpoint.BASE_URL = base_url
+        self.assertEqual(doctor['id'], 1)
+
+    def test_workers_skip_practices_whose_account_is_gone(self):
+        UserSocialAuth.objects.filter(uid='b').delete()
+        with self.assertLogs('drchrono.management.commands._practices', 'WARNING'):
+            self.assertEqual([practice.uid for practice in signed_in_practices()], ['a'])
+
+    def test_nobody_sees_and_saves_nothing(self):
+        with tenancy.using(tenancy.NOBODY):
+            self.assertFalse(Patient.objects.exists())
+            with self.assertRaises(tenancy.NoPractice):
+                Patient.objects.create(patient_id=2)
+            with self.assertRaises(tenancy.NoPractice):
+                get_token_manager()
+
+    def test_signed_in_user_only_gets_their_practices_events(self):
+        self.client.force_login(self.user_a)
+        status, content = self.events_seen(self.client)
+        self.assertEqual(status, 200)
+        self.assertIn(b'Alice', content)
+        self.assertNotIn(b'Bob', content)
+
+    def test_anonymous_requests_get_no_events(self):
+        status, content = self.events_seen(self.client)
+        self.assertEqual(status, 302)
+        self.assertNotIn(b'Alice', content)
+
+    def test_user_without_a_practice_gets_no_events(self):
+        self.client.force_login(User.objects.create(username='admin'))
+        status, content = self.events_seen(self.client)
+        self.assertEqual(status, 200)
+        self.assertNotIn(b'Alice', content)
+        self.assertNotIn(b'Bob', content)
+
+    def test_anonymous_kiosk_pages_need_a_practice(self):
+        self.assertEqual(self.client.get('/welcome/').status_code, 404)
@@ -0,0 +1,107 @@
+import threading
+import time
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from drchrono.endpoints import PatientEndpoint
+from drchrono.tokens import TokenManager, get_token_manager, request_scope
+from social_django.models import UserSocialAuth
+
+from .base import FakeAPITestCase, patient, sign_in
+
+
+class TokenManagerTests(TransactionTestCase):
+    """
+    Refreshes run in other threads, which only see committed rows
+    """
+
+    def setUp(self):
+        refreshes = self.refreshes = []
+
+        def refresh_token(social, strategy, *args, **kwargs):
+            # stands in for asking drchrono.com for a new token; slow enough for other callers to pile up behind it
+            refreshes.append(social.uid)
+            time.sleep(0.05)
+            social.extra_data.update(access_token=f"refreshed-{len(refreshes)}", auth_time=int(time.time()),
+                                     expires_in=36000)
+            social.save()
+
+        patcher = mock.patch.object(UserSocialAuth, 'refresh_token', refresh_token)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_a_fresh_token_is_handed_out_as_it_is(self):
+        sign_in('account', expires_in=36000)
+        self.assertEqual(TokenManager(uid='account', refresh_ahead=300).get_token(), 'token-account')
+        self.assertEqual(self.refreshes, [])
+
+    def test_a_token_about_to_expire_is_refreshed_in_the_background(self):
+        sign_in('account', expires_in=120)
+        manager = TokenManager(uid='account', refresh_ahead=300)
+        # the caller doesn't wait for the refresh
+        self.assertEqual(manager.get_token(), 'token-account')
+        deadline = time.monotonic() + 5
+        while manager._refreshing or not self.refreshes:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(manager.get_token(), 'refreshed-1')
+        self.assertEqual(self.refreshes, ['account'])
+
+    def test_an_expired_token_is_refreshed_once_for_every_caller(self):
+        sign_in('account', expires_in=0)
+        manager = TokenManager(uid='account', refresh_ahead=300)
+        # cache the expired token, so the callers all find it expired at once
+        with manager._lock:
+            manager._remember(UserSocialAuth.objects.get(uid='account'))
+
+        tokens = []
+        callers = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(8)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join(timeout=10)
+        self.assertEqual(tokens, ['refreshed-1'] * 8)
+        self.assertEqual(self.refreshes, ['account'])
+
+    def test_a_rejected_token_is_only_replaced_once(self):
+        sign_in('account')
+        manager = TokenManager(uid='account')
+        self.assertEqual(manager.refresh(rejected='token-account'), 'refreshed-1')
+        # someone else still holding the old token finds it replaced already
+        self.assertEqual(manager.refresh(rejected='token-account'), 'refreshed-1')
+        self.assertEqual(self.refreshes, ['account'])
+
+
+def token_reads(queries):
+    return [query for query in queries if '"social_auth_usersocialauth"."extra_data"' in query['sql']]
+
+
+class RequestScopeTests(TestCase):
+    def test_a_scope_reads_the_token_once(self):
+        sign_in('account')
+        # re-read from the database every time, outside of a scope
+        manager = TokenManager(uid='account', max_age=-1)
+        with CaptureQueriesContext(connection) as queries:
+            manager.get_token()
+            manager.get_token()
+        self.assertEqual(len(token_reads(queries)), 2)
+
+        with CaptureQueriesContext(connection) as queries, request_scope():
+            self.assertEqual([manager.get_token() for _ in range(3)], ['token-account'] * 3)
+        self.assertEqual(len(token_reads(queries)), 1)
+
+
+class RequestTokenTests(FakeAPITestCase):
+    resources = {'patients': [patient(id) for id in range(1, 6)]}
+
+    def test_worker_threads_share_the_requests_token(self):
+        manager = get_token_manager('practice')
+        with mock.patch.object(manager, 'max_age', -1), \
+                mock.patch.object(manager, '_account', wraps=manager._account) as account, request_scope():
+            manager.get_token()
+            found = PatientEndpoint().fetch_many(range(1, 6), max_workers=5)
+        self.assertEqual(len(found), 5)
+        # fetched from five threads, with the token read once
+        self.assertEqual(account.call_count, 1)
@@ -0,0 +1,30 @@
+from drchrono.endpoints import APIException, PatientEndpoint
+from drchrono.transport import Transport
+
+from .base import FakeAPITestCase, patient
+
+
+class TransportTests(FakeAPITestCase):
+    resources = {'patients': [patient(1)]}
+
+    def setUp(self):
+        super(TransportTests, self).setUp()
+        self.transport = Transport(retries=2, backoff_factor=0)
+        self.addCleanup(self.transport.close)
+
+    def test_connections_are_kept_alive_between_calls(self):
+        endpoint = PatientEndpoint(transport=self.transport)
+        for _ in range(5):
+            endpoint.fetch(1)
+        self.assertEqual(self.transport.stats.as_dict(), {'requests': 5, 'opened': 1, 'reused': 4})
+
+    def test_server_errors_are_retried_except_for_writes(self):
+        endpoint = PatientEndpoint(transport=self.transport)
+        self.api.faults.append((503, {}))
+        self.assertEqual(endpoint.fetch(1)['id'], 1)
+        self.assertEqual(len(self.requests_for('/api/patients/1')), 2)
+
+        self.api.faults.append((503, {}))
+        with self.assertRaises(APIException):
+            endpoint.update(1, {'cell_phone': '555-0100'})
+        self.assertEqual(len(self.requests_for('/api/patients/1', 'PATCH')), 1)
@@ -0,0 +1,220 @@
+"""
+The drchrono OAuth access token, shared by every API client in the process.
+
+Social Auth stores the token (and its refresh token) in UserSocialAuth.extra_data. Reading it there on every request,
+and refreshing it inline once it's about to expire, costs a query per request and makes whoever is unlucky wait on
+drchrono.com/o/token/. Instead, TokenManager keeps the token in memory, and refreshes it in a background thread once
+it's within DRCHRONO_TOKEN_REFRESH_AHEAD seconds of expiring.
+
+Within a request (see drchrono.middleware.CredentialsMiddleware and request_scope()), the first token handed out is
+reused for the rest of the request, so a request reads UserSocialAuth at most once however many clients it builds.
+Saving or deleting the UserSocialAuth row, e.g. when Social Auth refreshes the token or someone signs in again,
+updates the cached token in this process straight away.
+
+Each practice (see drchrono.tenancy) has its own TokenManager, for its own drchrono account. get_token_manager()
+returns the current practice's.
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from social_django.models import UserSocialAuth
+from social_django.utils import load_strategy
+from drchrono import tenancy
+from drchrono.models import Practice
+
+logger = logging.getLogger(__name__)
+
+# the tokens handed out in the current request, by account uid, in a dict shared with the request's worker threads
+_request_token = contextvars.ContextVar('drchrono_request_token', default=None)
+
+
+@contextmanager
+def request_scope():
+    """
+    Hands out the same access token for the rest of the block, once get_token() has been called
+    """
+    token = _request_token.set({})
+    try:
+        yield
+    finally:
+        _request_token.reset(token)
+
+
+class TokenManager(object):
+    """
+    Hands out the current access token for a Social Auth provider, refreshing it ahead of expiry.
+
+    The token is cached in memory, and re-read from the database every `max_age` seconds so refreshes done by other
+    processes are picked up. Once it's within `refresh_ahead` seconds of expiring, the next get_token() starts a
+    refresh in the background and carries on with the current token. Only if it has already expired does the caller
+    wait for the refresh.
+
+    Refreshes are serialized: within the process by a lock, and across processes by locking the UserSocialAuth row.
+    Whoever gets the lock second finds the token already refreshed and just picks it up.
+
+    `uid` picks the account, when several have signed in with the provider.
+    """
+    # a token this close to expiring is treated as expired, as Social Auth does
+    EXPIRED_THRESHOLD = UserSocialAuth.ACCESS_TOKEN_EXPIRED_THRESHOLD
+
+    def __init__(self, provider='drchrono', refresh_ahead=None, max_age=None, uid=None):
+        self.provider = provider
+        self.uid = uid
+        self.refresh_ahead = settings.DRCHRONO_TOKEN_REFRESH_AHEAD if refresh_ahead is None else refresh_ahead
+        self.max_age = settings.DRCHRONO_TOKEN_CACHE_TIMEOUT if max_age is None else max_age
+        self._lock = threading.Lock()  # guards the cached token
+        self._refresh_lock = threading.Lock()  # one refresh at a time
+        self._refreshing = False
+        self._token = None
+        self._expires_at = None
+        self._loaded_at = None
+
+    @staticmethod
+    def expires_at(extra_data):
+        """
+        When the token in a UserSocialAuth's extra_data expires, as a unix timestamp. None if we can't tell.
+        """
+        try:
+            return int(extra_data['auth_time']) + int(extra_data['expires_in'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _remember(self, social):
+        self._token = social.extra_data['access_token']
+        self._expires_at = self.expires_at(social.extra_data)
+        self._loaded_at = time.time()
+        scoped = _request_token.get()
+        if scoped is not None:
+            scoped[self.uid] = self._token
+
+    def _account(self):
+        accounts = UserSocialAuth.objects.filter(provider=self.provider)
+        return accounts if self.uid is None else accounts.filter(uid=self.uid)
+
+    def remember(self, social):
+        """
+        Caches the token of a UserSocialAuth that was just saved, instead of reading it again later
+        """
+        with self._lock:
+            self._remember(social)
+
+    def _is_due(self, extra_data):
+        expires_at = self.expires_at(extra_data)
+        return expires_at is not None and expires_at - time.time() <= self.refresh_ahead
+
+    def get_token(self):
+        """
+        Returns the current access token. Raises UserSocialAuth.DoesNotExist if nobody has signed in yet.
+        """
+        scoped = _request_token.get()
+        if scoped is not None and scoped.get(self.uid) is not None:
+            return scoped[self.uid]
+        with self._lock:
+            if self._token is None or time.time() - self._loaded_at > self.max_age:
+                self._remember(self._account().get())
+            token, expires_at = self._token, self._expires_at
+
+        if expires_at is not None:
+            seconds_left = expires_at - time.time()
+            if seconds_left <= self.EXPIRED_THRESHOLD:
+                return self.refresh()
+            if seconds_left <= self.refresh_ahead:
+                self.refresh_in_background()
+        if scoped is not None:
+            scoped[self.uid] = token
+        return token
+
+    def refresh(self, rejected=None):
+        """
+        Refreshes the token if it's due to expire, or if it's `rejected` (a token the API turned down), unless another
+        thread or process has replaced it already. Returns the current token.
+        """
+        with self._refresh_lock:
+            with transaction.atomic():
+                social = self._account().select_for_update().get()
+                if social.extra_data['access_token'] == rejected or self._is_due(social.extra_data):
+                    social.refresh_token(load_strategy())
+                    logger.info("refreshed the %s access token", self.provider)
+            with self._lock:
+                self._remember(social)
+                return self._token
+
+    def refresh_in_background(self):
+        """
+        Starts refresh() in a background thread, unless one is running already
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("refreshing the %s access token failed", self.provider)
+        finally:
+            with self._lock:
+                self._refreshing = False
+            # the thread had its own database connection
+            connection.close()
+
+    def invalidate(self):
+        """
+        Forgets the cached token, so the next get_token() reads it from the database again
+        """
+        with self._lock:
+            self._token = None
+            scoped = _request_token.get()
+            if scoped is not None:
+                scoped.pop(self.uid, None)
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(uid=None):
+    """
+    Returns the TokenManager of an account (by Social Auth uid), by default the current practice's, creating it on
+    first use. With neither, the one for the only account there is. Raises tenancy.NoPractice while NOBODY is current.
+    """
+    if uid is None and tenancy.denied():
+        raise tenancy.NoPractice("no drchrono account to use")
+    if uid is None:
+        practice = tenancy.current()
+        uid = practice.uid if practice is not None else None
+    if uid not in _token_managers:
+        with _token_managers_lock:
+            if uid not in _token_managers:
+                _token_managers[uid] = TokenManager(uid=uid)
+    return _token_managers[uid]
+
+
+def _managers_for(social):
+    return [manager for uid, manager in list(_token_managers.items())
+            if manager.provider == social.provider and uid in (None, social.uid)]
+
+
+@receiver(post_save, sender=UserSocialAuth)
+def _social_auth_saved(sender, instance, created, **kwargs):
+    # Social Auth saves the row whenever it refreshes the token, or someone signs in again
+    if instance.provider == 'drchrono' and created:
+        Practice.objects.get_or_create(uid=instance.uid)
+    if (instance.extra_data or {}).get('access_token'):
+        for manager in _managers_for(instance):
+            manager.remember(instance)
+
+
+@receiver(post_delete, sender=UserSocialAuth)
+def _social_auth_deleted(sender, instance, **kwargs):
+    for manager in _managers_for(instance):
+        manager.invalidate()
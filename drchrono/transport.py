@@ -0,0 +1,184 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+class ConnectionStats(object):
+    """
+    Thread-safe counters for the connections behind a Transport.
+
+    `requests` counts every connection checkout from the pool (retries included), `opened` counts the ones that
+    needed a brand new TCP (and TLS) handshake. Everything else was served by a kept-alive connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.opened = 0
+
+    def connection_requested(self):
+        with self._lock:
+            self.requests += 1
+
+    def connection_opened(self):
+        with self._lock:
+            self.opened += 1
+
+    @property
+    def reused(self):
+        return max(self.requests - self.opened, 0)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'opened': self.opened,
+                'reused': max(self.requests - self.opened, 0),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.opened = 0
+
+
+def _counting_pool(pool_class, stats):
+    """
+    Returns a subclass of the given urllib3 pool class that reports checkouts and new connections to `stats`
+    """
+
+    class CountingPool(pool_class):
+        def _get_conn(self, *args, **kwargs):
+            stats.connection_requested()
+            return super(CountingPool, self)._get_conn(*args, **kwargs)
+
+        def _new_conn(self):
+            stats.connection_opened()
+            return super(CountingPool, self)._new_conn()
+
+    CountingPool.__name__ = "Counting{}".format(pool_class.__name__)
+    return CountingPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection pools keep track of how many connections were opened vs. reused
+    """
+
+    def __init__(self, stats, **kwargs):
+        # must be set before HTTPAdapter.__init__, which builds the pool manager
+        self.stats = stats
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self.stats),
+            'https': _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+
+class EndpointRetry(Retry):
+    """
+    urllib3's Retry, except that it leaves 429 alone even when the response has a Retry-After header. Otherwise a
+    throttled GET would be retried in here, and the endpoints would never get to pause the shared rate limiter.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+
+class Transport(object):
+    """
+    A shared, connection-pooled HTTP session for talking to the drchrono API.
+
+    Connections are kept alive between calls, so only the first request to a host pays for the TCP+TLS handshake.
+
+     - pool_connections: how many per-host pools to keep around
+     - pool_maxsize: how many connections to keep open to a single host
+     - pool_block: when True, never open more than pool_maxsize connections to a host; callers wait for a free one
+     - timeout: default (connect, read) timeout, in seconds, for requests that don't pass their own
+     - retries: how many times to retry connection errors and 5xx responses
+     - backoff_factor: exponential backoff between retries. A Retry-After header on the response takes precedence.
+
+    POST and PATCH are not retried on 5xx, since they are not idempotent. 429 is left to the endpoints, which pause
+    the shared rate limiter (see drchrono.ratelimit) rather than have each connection back off on its own.
+    """
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, timeout=(3.05, 30), retries=3,
+                 backoff_factor=0.5, status_forcelist=RETRY_STATUSES):
+        self.timeout = timeout
+        self.stats = ConnectionStats()
+        max_retries = EndpointRetry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            raise_on_status=False,  # hand the last response back, so the endpoint can map it to an exception
+        )
+        self.adapter = PooledHTTPAdapter(
+            self.stats,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=max_retries,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, *args, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def _configured_options():
+    """
+    Transport options from the DRCHRONO_API_TRANSPORT setting, if we're running under Django
+    """
+    try:
+        from django.conf import settings
+        return dict(getattr(settings, 'DRCHRONO_API_TRANSPORT', {}))
+    except Exception:  # django isn't installed, or settings aren't configured
+        return {}
+
+
+def get_transport():
+    """
+    Returns the process-wide Transport, creating it on first use
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = Transport(**_configured_options())
+    return _transport
+
+
+def set_transport(transport):
+    """
+    Replaces the process-wide Transport, e.g. with an instrumented one in a benchmark. Returns the one it replaced.
+    """
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+    return previous
+
+
+def reset_transport():
+    """
+    Closes the process-wide Transport. The next call to get_transport() builds a new one from the current settings.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = None
@@ -8,6 +8,9 @@ admin.autodiscover()
 urlpatterns = [
     url(r'^setup/$', views.SetupView.as_view(), name='setup'),
     url(r'^welcome/$', views.DoctorWelcome.as_view(), name='welcome'),
+    url(r'^welcome/sections/(?P<section>[a-z-]+)/$', views.DashboardSectionView.as_view(), name='dashboard-section'),
+    url(r'^welcome/events/$', views.DashboardEventsView.as_view(), name='dashboard-events'),
+    url(r'^visits/export/$', views.VisitExportView.as_view(), name='visit-export'),
     url(r'^toggle-timer/$', views.VisitTimerView.as_view(), name='timer'),
     url(r'^check-in/$', views.CheckInView.as_view(), name='check-in'),
     url(r'^demographics/$', views.DemographicView.as_view(), name='demographics'),
@@ -1,20 +1,47 @@
+import json
+import logging
 import math
-import time
-from datetime import datetime, timedelta
 
-import altair as alt
-import pandas as pd
-from django.http import HttpResponseRedirect
-from django.shortcuts import get_object_or_404, render
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseRedirect, StreamingHttpResponse)
+from django.shortcuts import render
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views import View
 from django.views.generic import TemplateView
-from drchrono.endpoints import (APIException, AppointmentEndpoint,
-                                DoctorEndpoint, PatientEndpoint)
-from drchrono.forms import CheckInForm, DemographicForm, TimerForm
+from drchrono import events, outbox, tenancy
+from drchrono.appointments import AppointmentSchedule
+from drchrono.charts import dashboard_chart
+from drchrono.checkin import AlreadyCheckedIn, CheckInService
+from drchrono.dashboard import SECTIONS, render_section
+from drchrono.endpoints import APIException, DoctorEndpoint
+from drchrono.exports import CONTENT_TYPES, export_visits
+from drchrono.forms import CheckInForm, DemographicForm, TimerForm, VisitExportForm
+from drchrono.instrumentation import section
+from drchrono.joins import enrich
 from drchrono.models import Visit
+from drchrono.patients import (PATIENT_DETAIL_FIELDS, PATIENT_NAME_FIELDS,
+                               PatientDirectory)
+from drchrono.stats import record_visit_transition
+from drchrono.tokens import get_token_manager
 from social_django.models import UserSocialAuth
-from social_django.utils import load_strategy
+
+logger = logging.getLogger(__name__)
+
+
+def get_access_token():
+    """
+    The current practice's drchrono access token. 404s if nobody has signed in through /setup/ yet, or if there are
+    several practices and the request isn't for one of them.
+    """
+    try:
+        return get_token_manager().get_token()
+    except UserSocialAuth.DoesNotExist:
+        raise Http404("No drchrono account is set up yet.")
+    except (UserSocialAuth.MultipleObjectsReturned, tenancy.NoPractice):
+        raise Http404("Sign in through /setup/ to pick a practice.")
 
 
 class SetupView(TemplateView):
@@ -33,12 +60,11 @@ class KioskEndView(TemplateView):
 
 class DemographicView(View):
     def get(self, request):
-        oauth_provider = get_object_or_404(UserSocialAuth, provider='drchrono')
-        access_token = oauth_provider.extra_data['access_token']
-        patient_client = PatientEndpoint(access_token) 
-        patient = patient_client.list()[0]
+        access_token = get_access_token()
+        patient_id = request.GET.get('patient_id')
+        patient = PatientDirectory(access_token).get(patient_id) if patient_id else None
         return render(request, 'demographics.html',
-                      {'form': DemographicForm(initial=patient), 'patient_id': request.GET.get('patient_id')})
+                      {'form': DemographicForm(initial=patient), 'patient_id': patient_id})
 
     def post(self, request):
         # create a form instance and populate it with data from the request:
@@ -46,12 +72,14 @@ class DemographicView(View):
         patient_id = request.POST.get('patient_id')
 
         if form.is_valid():
-            oauth_provider = get_object_or_404(UserSocialAuth, provider='drchrono')
-            access_token = oauth_provider.extra_data['access_token'] 
-            patient_client = PatientEndpoint(access_token)
-            patient_client.update(patient_id, form.cleaned_data)
+            if not (patient_id or '').isdigit():
+                return HttpResponseBadRequest("patient_id is required")
+            # update our local copy straight away, and queue the change for `manage.py process_outbox` to send
+            with transaction.atomic():
+                PatientDirectory().apply(int(patient_id), form.cleaned_data)
+                outbox.enqueue('patients', int(patient_id), int(patient_id), form.cleaned_data)
             return HttpResponseRedirect('/finished/')
-        return render(request, 'demographics.html', {'form': form})
+        return render(request, 'demographics.html', {'form': form, 'patient_id': patient_id})
 
 
 class CheckInView(View):
@@ -63,17 +91,20 @@ class CheckInView(View):
         form = CheckInForm(request.POST)
 
         if form.is_valid():
-            oauth_provider = UserSocialAuth.objects.get(provider='drchrono')
-            access_token = oauth_provider.extra_data['access_token']
-            appointments_client = AppointmentEndpoint(access_token) 
-            appointments_client.update(form.cleaned_data.get('appointment_id'), {'status': 'Arrived'})
-
-            # locally set status to Arrived, and arrival_time to right now
-            visit = Visit.objects.filter(appointment_id=form.cleaned_data.get('appointment_id'),
-                                      patient_id=form.cleaned_data.get('patient_id')) 
-            visit.arrival_time = timezone.now()
-            visit.status = 'Arrived'
-            visit.save()
+            # mark each of today's appointments Arrived locally, and queue the change for drchrono
+            patient = form.cleaned_data['patient']
+            try:
+                visits = CheckInService().check_in(form.cleaned_data['patient_id'], form.cleaned_data['appointments'])
+            except AlreadyCheckedIn:
+                form.add_error(None, "You already checked in for your appointment today.")
+                return render(request, 'check_in.html', {'form': form})
+
+            # let open dashboards know
+            for visit in visits:
+                events.arrival_event(visit, patient)
+                events.appointment_event({'id': visit.appointment_id, 'patient': visit.patient_id,
+                                          'scheduled_time': visit.scheduled_time,
+                                          'status': Visit.Status.ARRIVED.label}, patient)
 
             # redirect to demographics page
             return HttpResponseRedirect(f'/demographics/?patient_id={form.cleaned_data.get("patient_id")}')
@@ -91,8 +122,7 @@ class DoctorWelcome(TemplateView):
         Social Auth module is configured to store our access tokens. This will fetch it for us if we've
         already signed in.
         """
-        oauth_provider = get_object_or_404(UserSocialAuth, provider='drchrono')
-        return oauth_provider.extra_data['access_token']
+        return get_access_token()
 
     def make_api_request(self):
         """
@@ -109,35 +139,6 @@ class DoctorWelcome(TemplateView):
 
         return doctor  
 
-    def is_access_token_expired(self, access_token):
-        oauth_provider = get_object_or_404(UserSocialAuth, provider='drchrono')
-        difference = None
-        if oauth_provider.extra_data and 'expires_in' in oauth_provider.extra_data:
-            try:
-                expires = int(oauth_provider.extra_data.get('expires_in'))
-            except (ValueError, TypeError):
-                return None
-
-            now = timezone.now() 
-
-            # Detect if expires is a timestamp
-            if expires > time.mktime(now.timetuple()):
-                # expires is a datetime, return the remaining difference
-                difference = datetime.utcfromtimestamp(expires) - now 
-
-            else:
-                # expires is the time to live seconds since creation,
-                # check against auth_time if present, otherwise return
-                # the value
-                auth_time = oauth_provider.extra_data.get('auth_time')
-                if auth_time:
-                    reference = timezone.make_aware(datetime.utcfromtimestamp(auth_time))
-                    difference = (reference + timedelta(seconds=expires)) - now
-                else:
-                    difference = timedelta(seconds=expires) 
-
-        return difference and difference.total_seconds() <= oauth_provider.ACCESS_TOKEN_EXPIRED_THRESHOLD 
-
     def get_context_data(self, **kwargs):
         """
 
@@ -146,127 +147,168 @@ class DoctorWelcome(TemplateView):
         """
         kwargs = super(DoctorWelcome, self).get_context_data(**kwargs)
 
-        # look for oauth user, so we can use it's access_token
-        oauth_provider = get_object_or_404(UserSocialAuth, provider='drchrono')
-
-        # check if token is about to expire, and refresh it if so
-        if self.is_access_token_expired(oauth_provider.extra_data['access_token']):
-            oauth_provider.refresh_token(load_strategy())
+        # the token manager keeps our access token refreshed ahead of expiry
+        access_token = self.get_token()
 
-        access_token = oauth_provider.extra_data['access_token'] 
-        patient_client = PatientEndpoint(access_token)
-        appointments_client = AppointmentEndpoint(access_token)
+        # the page's event stream picks up from here, so changes made while the page is built aren't missed
+        kwargs['last_event_id'] = events.latest_event_id()
 
         # information about the doctor
-        kwargs['doctor'] = next(DoctorEndpoint(access_token).list()) 
-
-        # list of patients
-        patients = list(patient_client.list())
-
-        # list of today's appointments
-        today_str = timezone.now().strftime('%m-%d-%y')
-        todays_appointments = list(appointments_client.list({}, start=today_str, end=today_str)) 
-        for appointment in todays_appointments:
-            patient = [patient for patient in patients if patient.get('id') == appointment.get('patient')][0]
-            appointment['first_name'] = patient.get('first_name') 
-            appointment['last_name'] = patient.get('last_name')
+        with section('doctor'):
+            kwargs['doctor'] = next(DoctorEndpoint(access_token).list(), None)
+
+        # list of today's appointments, from the local copy kept up to date by `manage.py sync_appointments`
+        with section('appointments'):
+            todays_appointments = AppointmentSchedule(access_token).for_day()
         kwargs['appointments'] = todays_appointments
 
-        # fetch information about patients who have checked in
-        visits = Visit.objects.filter(status='Arrived', arrival_time__isnull=False, start_time__isnull=True).all()
+        # patients who have checked in
+        with section('visits'):
+            visits = list(Visit.objects.filter(status=Visit.Status.ARRIVED, arrival_time__isnull=False,
+                                               start_time__isnull=True))
         for visit in visits:
             visit.wait_since_arrived = visit.get_wait_duration().seconds
-            patient = [patient for patient in patients if patient.get('id') == visit.patient_id][0]
-            visit.first_name = patient.get('first_name')
-            visit.last_name = patient.get('last_name')
         kwargs['arrived'] = visits
 
-        # fetch information about our current appointment
-        current_appointment = Visit.objects.filter(status='In Session', arrival_time__isnull=False,
-                                                   start_time__isnull=False).first()
+        # our current appointment
+        with section('visits'):
+            current_appointment = Visit.objects.filter(status=Visit.Status.IN_SESSION, arrival_time__isnull=False,
+                                                       start_time__isnull=False).first()
         if current_appointment:
             kwargs['current_appointment'] = current_appointment
             current_appointment.visit_duration = current_appointment.get_visit_duration().seconds
-            patient = [patient for patient in patients if patient.get('id') == current_appointment.patient_id][0]
-            current_appointment.first_name = patient.get('first_name')
-            current_appointment.last_name = patient.get('last_name')
-            current_appointment.date_of_birth = patient.get('date_of_birth')
-            current_appointment.date_of_last_appointment = patient.get('date_of_last_appointment')
-            current_appointment.race = patient.get('race')
-            current_appointment.gender = patient.get('gender')
-            current_appointment.ethnicity = patient.get('ethnicity')
-
-        # create list of past visit, and use it to generate average wait and visit duration
-        past_visits = Visit.objects.filter(status="Finished", arrival_time__isnull=False,
-                                           start_time__isnull=False).all() 
-        if len(past_visits) > 0:
-            avg_wait_time = sum([(visit.start_time - visit.arrival_time).seconds for visit in past_visits]) / len(
-                past_visits)
-            kwargs['avg_wait_duration'] = math.ceil(avg_wait_time)
-
-            avg_visit_duration = sum([(visit.end_time - visit.start_time).seconds for visit in past_visits]) / len(
-                past_visits)
-            kwargs['avg_visit_duration'] = math.ceil(avg_visit_duration)
-            kwargs['avg_wait_duration'] = "You have no arrivals! - 0"
-            kwargs['avg_visit_duration'] = "You have no visits! - 0"
+
+        # fetch just the patients on the dashboard, rather than the whole patient directory
+        patient_ids = [appointment.get('patient') for appointment in todays_appointments]
+        patient_ids += [visit.patient_id for visit in visits]
+        if current_appointment:
+            patient_ids.append(current_appointment.patient_id)
+        with section('patients'):
+            patients_by_id = PatientDirectory(access_token).fetch_many(patient_ids)
+
+        missing = enrich(todays_appointments, patients_by_id, 'patient', PATIENT_NAME_FIELDS)
+        missing += enrich(visits, patients_by_id, 'patient_id', PATIENT_NAME_FIELDS)
+        if current_appointment:
+            missing += enrich([current_appointment], patients_by_id, 'patient_id', PATIENT_DETAIL_FIELDS)
+
+        if missing:
+            logger.warning("dashboard rows reference unknown patients: %s", missing)
+
+        # average wait and visit durations, from the running totals kept by VisitTimerView, and recent percentiles.
+        # Read through the statistics section's cache, so they're only recomputed after a visit changed
+        with section('statistics'):
+            statistics_section = json.loads(render_section('statistics', access_token)[0])
+        statistics = kwargs['statistics'] = statistics_section['statistics']
+        kwargs['recent'] = statistics_section['recent']
+        kwargs['percentile_days'] = statistics_section['recent_days']
+        kwargs['daily_statistics'] = statistics_section['daily']
+        if statistics['wait']['count']:
+            kwargs['avg_wait_duration'] = math.ceil(statistics['wait']['avg'])
         else:
             kwargs['avg_wait_duration'] = "You have no arrivals! - 0"
+        if statistics['visit']['count']:
+            kwargs['avg_visit_duration'] = math.ceil(statistics['visit']['avg'])
+        else:
             kwargs['avg_visit_duration'] = "You have no visits! - 0"
 
-        # creating altair visualization
-
-        # create a df with list of times and durations
-        visit_data = [{
-            'start_time': visit.arrival_time,
-            'arrival_time': visit.start_time,
-            'wait_duration': visit.get_visit_duration().seconds,
-            'visit_duration': visit.get_wait_duration().seconds,
-        } for visit in past_visits]
-        visit_data_df = pd.DataFrame(visit_data)
-
-        # https://altair-viz.github.io/user_guide/interactions.html#selections-building-blocks-of-interactions
-        brush = alt.selection_interval(encodings=['x'])
-        chart = alt.Chart(visit_data_df).mark_bar().properties(
-            width=300,
-            height=150
-        ).add_selection(
-            brush
-        )
-
-        # combine two charts one with wait duration and one with visit duration
-        kwargs['chart'] = alt.hconcat(chart.encode(
-            x=alt.X('start_time:T', axis=alt.Axis(title='Time the visit started')),
-            y=alt.Y('wait_duration:Q', axis=alt.Axis(title='Wait Duration')),
-            color=alt.condition(brush, alt.value('black'), alt.value('lightgray'))
-        ), chart.encode(
-            x=alt.X('start_time:T', axis=alt.Axis(title='Time the visit started')),
-            y=alt.Y('visit_duration:Q', axis=alt.Axis(title='Visit Duration')),
-            color=alt.condition(brush, alt.value('black'), alt.value('lightgray'))
-        )).resolve_scale(
-            y='shared'
-        )
+        # chart of past wait and visit durations; only rebuilt when a visit changed
+        kwargs['chart'] = dashboard_chart()
 
         return kwargs 
 
 
 class VisitTimerView(View):
-    def toggle_timer(self, appointment_id):
+    @transaction.atomic
+    def toggle_timer(self, appointment_id, patient_directory=None):
+        # lock the row with a write before reading it. SQLite ignores select_for_update(), and a SQLite transaction
+        # that reads and then writes fails with "database is locked" if another one wrote in between, rather than
+        # waiting its turn.
+        Visit.objects.filter(appointment_id=appointment_id).update(updated_at=timezone.now())
         visit = Visit.objects.get(appointment_id=appointment_id)
 
-        if visit.status == "Arrived":
+        if visit.status == Visit.Status.ARRIVED:
             visit.start_time = timezone.now()
-            visit.status = "In Session"
+            visit.status = Visit.Status.IN_SESSION
             visit.save()
-        elif visit.status == "In Session":
+        elif visit.status == Visit.Status.IN_SESSION:
             visit.end_time = timezone.now()
-            visit.status = "Finished"
+            visit.status = Visit.Status.FINISHED
             visit.save()
         else:
             raise Exception(f"{visit} has an invalid status of: {visit.status} {type(visit.status)}")
 
+        # keep the dashboard's running wait/visit totals up to date, in the same transaction
+        record_visit_transition(visit)
+
+        # and let open dashboards know
+        if visit.status == Visit.Status.IN_SESSION:
+            patient = patient_directory.get(visit.patient_id) if patient_directory else None
+            events.visit_started_event(visit, patient or {})
+        else:
+            events.visit_finished_event(visit)
+
     def post(self, request):
         form = TimerForm(request.POST)
 
         if form.is_valid(): 
-            self.toggle_timer(appointment_id=form.cleaned_data.get('appointment_id'))
+            self.toggle_timer(appointment_id=form.cleaned_data.get('appointment_id'),
+                              patient_directory=PatientDirectory(get_access_token()))
         return HttpResponseRedirect(f'/welcome/')
+
+
+class DashboardEventsView(LoginRequiredMixin, View):
+    """
+    Streams dashboard updates (arrivals, visits starting and finishing, appointment changes) as server-sent events
+    """
+
+    def get(self, request):
+        # EventSource sends the id of the last event it saw when it reconnects. On the first connect, the page passes
+        # the latest id as of when it was rendered; without either, start from now.
+        last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+        last_id = int(last_id) if last_id and last_id.isdigit() else events.latest_event_id()
+
+        response = StreamingHttpResponse(tenancy.bind(events.stream(last_id)), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class DashboardSectionView(LoginRequiredMixin, View):
+    """
+    One section of the dashboard as JSON (see drchrono.dashboard.SECTIONS). Answers 304 Not Modified when the
+    client's If-None-Match still matches the section's ETag.
+    """
+
+    def get(self, request, section):
+        if section not in SECTIONS:
+            raise Http404("No such dashboard section.")
+        content, etag = render_section(section, get_access_token())
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        # the browser may keep the section, but has to check with us before using it again
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class VisitExportView(LoginRequiredMixin, View):
+    """
+    Streams visit history as NDJSON (the default) or CSV. Takes the same filters as `manage.py export_visits`:
+    ?format=csv&start=2020-01-01&end=2020-01-31&status=finished
+    """
+
+    def get(self, request):
+        form = VisitExportForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text(), content_type='text/plain')
+
+        format = form.cleaned_data['format']
+        chunks = export_visits(format, form.cleaned_data['start'], form.cleaned_data['end'],
+                               form.cleaned_data['status'])
+        # the chunks are queried for as they're sent, after the middleware has returned
+        response = StreamingHttpResponse(tenancy.bind(chunks), content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = f'attachment; filename="visits.{format}"'
+        return response
+
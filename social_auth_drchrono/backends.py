@@ -17,7 +17,9 @@ class drchronoOAuth2(BaseOAuth2):
         ('expires_in', 'expires_in')
     ]
 
-    # TODO: setup proper token refreshing
+    # Tokens are refreshed with BaseOAuth2.refresh_token, ahead of expiry, by drchrono.tokens.TokenManager
+    REFRESH_TOKEN_URL = ACCESS_TOKEN_URL
+    REFRESH_TOKEN_METHOD = 'POST'
 
     def get_user_details(self, response):
         """